@@ -1,9 +1,11 @@
 import collections
 from dataclasses import dataclass, field
 from datetime import MINYEAR, datetime
-from typing import Any, ClassVar, Dict, List, Optional, Tuple, Type, TypeVar, cast
+from time import monotonic
+from typing import Any, ClassVar, Dict, List, Optional, Sequence, Tuple, Type, TypeVar, Union, cast
 from uuid import UUID
 
+import gevent
 import marshmallow
 import pkg_resources
 import structlog
@@ -30,12 +32,14 @@ from pathfinding_service.constants import (
     DEFAULT_INFO_MESSAGE,
     DEFAULT_MAX_PATHS,
     MAX_AGE_OF_IOU_REQUESTS,
+    MAX_PATH_REQUESTS_PER_BATCH,
     MAX_PATHS_PER_REQUEST,
     MIN_IOU_EXPIRY,
 )
 from pathfinding_service.model import IOU
 from pathfinding_service.model.feedback import FeedbackToken
-from pathfinding_service.model.token_network import Path, TokenNetwork
+from pathfinding_service.model.token_network import Path, RoutingSnapshot, TokenNetwork
+from pathfinding_service.routing_pool import PathResult
 from pathfinding_service.service import PathfindingService
 from raiden.exceptions import InvalidSignature
 from raiden.network.transport.matrix.utils import UserPresence
@@ -108,6 +112,9 @@ class PathRequest:
     iou: Optional[IOU] = None
     diversity_penalty: Optional[float] = None
     fee_penalty: Optional[float] = None
+    max_hops: Optional[int] = field(
+        default=None, metadata=dict(validate=marshmallow.validate.Range(min=1))
+    )
     Schema: ClassVar[Type[marshmallow.Schema]]
 
 
@@ -119,88 +126,304 @@ class PathsResource(PathfinderResource):
     def post(self, token_network_address: str) -> Tuple[dict, int]:
         token_network = self._validate_token_network_argument(token_network_address)
         path_req = self._parse_post(PathRequest)
-        process_payment(
-            iou=path_req.iou,
-            pathfinding_service=self.pathfinding_service,
-            service_fee=self.api.service_fee,
-            one_to_n_address=self.api.one_to_n_address,
-        )
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.IOU):
+            process_payment(
+                iou=path_req.iou,
+                pathfinding_service=self.pathfinding_service,
+                service_fee=self.api.service_fee,
+                one_to_n_address=self.api.one_to_n_address,
+            )
 
-        # check for common error cases to provide clear error messages
-        error = token_network.check_path_request_errors(
-            source=path_req.from_,
-            target=path_req.to,
-            value=path_req.value,
-            reachability_state=self.pathfinding_service.matrix_listener.user_manager,
-        )
+        return self._get_paths(token_network, path_req), 200
 
-        if error:
-            # this is for assertion via the scenario player
-            if self.debug_mode:
-                last_failed_requests.append(
-                    dict(
-                        token_network_address=to_checksum_address(token_network_address),
-                        source=to_checksum_address(path_req.from_),
-                        target=to_checksum_address(path_req.to),
-                        routes=[],
-                    )
+    def _get_paths(
+        self,
+        token_network: TokenNetwork,
+        path_req: PathRequest,
+        snapshot: Optional[RoutingSnapshot] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        """Returns the response for a single path request.
+
+        The search takes at most `--path-search-budget` seconds, or ends at
+        the `deadline` shared with other requests if given.
+
+        Raises `NoRouteFound` if no paths can be found.
+        """
+        time_budget = self.pathfinding_service.path_search_budget
+        if deadline is not None:
+            time_budget = deadline - monotonic()
+            if time_budget <= 0:
+                raise exceptions.PathSearchTimeout(
+                    from_=to_checksum_address(path_req.from_),
+                    to=to_checksum_address(path_req.to),
+                    value=path_req.value,
                 )
 
-            # There is no synchronization on the block number updates and the
-            # query performed above, so this may be higher than the original
-            # value.
-            approximate_error_block = (
-                self.pathfinding_service.blockchain_state.latest_committed_block
-            )
-            msg = (
-                f"{error}. Approximate block at the time of the request {approximate_error_block}"
-            )
-            raise exceptions.NoRouteFound(
-                from_=to_checksum_address(path_req.from_),
-                to=to_checksum_address(path_req.to),
-                value=path_req.value,
-                msg=msg,
-            )
+        self._check_path_request_errors(token_network, path_req)
+        token_network.record_path_request(path_req.value)
 
         # only add optional args if not None, so we can use defaults
         optional_args = {}
-        for arg in ["diversity_penalty", "fee_penalty"]:
+        for arg in ["diversity_penalty", "fee_penalty", "max_hops"]:
             value = getattr(path_req, arg)
             if value is not None:
                 optional_args[arg] = value
 
-        paths = token_network.get_paths(
-            source=path_req.from_,
-            target=path_req.to,
-            value=path_req.value,
-            reachability_state=self.pathfinding_service.matrix_listener.user_manager,
-            max_paths=path_req.max_paths,
-            **optional_args,
+        # Requests with a snapshot, e.g. of a batch, are answered in this process
+        routing_pool = self.pathfinding_service.routing_pool
+        use_routing_pool = (
+            snapshot is None
+            and routing_pool is not None
+            and routing_pool.is_published(token_network.address)
         )
-        # this is for assertion via the scenario player
-        if len(paths) == 0:
-            if self.debug_mode:
-                last_failed_requests.append(
-                    dict(
-                        token_network_address=to_checksum_address(token_network_address),
-                        source=to_checksum_address(path_req.from_),
-                        target=to_checksum_address(path_req.to),
-                        routes=[],
-                    )
+        if snapshot is None and not use_routing_pool:
+            # Keeps the token network unmodified for the whole request
+            with metrics.time_path_request_phase(metrics.PathRequestPhase.PRUNING):
+                snapshot = RoutingSnapshot(
+                    token_network,
+                    self.pathfinding_service.matrix_listener.user_manager,
+                    nodes=token_network.connectivity.component(path_req.from_),
+                )
+
+        paths: Sequence[Union[Path, PathResult]]
+        try:
+            if use_routing_pool:
+                assert routing_pool is not None
+                paths = routing_pool.get_paths(
+                    token_network_address=token_network.address,
+                    source=path_req.from_,
+                    target=path_req.to,
+                    value=path_req.value,
+                    max_paths=path_req.max_paths,
+                    time_budget=time_budget,
+                    **optional_args,
                 )
+            else:
+                paths = token_network.get_paths(
+                    source=path_req.from_,
+                    target=path_req.to,
+                    value=path_req.value,
+                    reachability_state=self.pathfinding_service.matrix_listener.user_manager,
+                    max_paths=path_req.max_paths,
+                    snapshot=snapshot,
+                    time_budget=time_budget,
+                    **optional_args,
+                )
+        except exceptions.PathSearchBudgetExceeded:
+            raise exceptions.PathSearchTimeout(
+                from_=to_checksum_address(path_req.from_),
+                to=to_checksum_address(path_req.to),
+                value=path_req.value,
+            )
+        if len(paths) == 0:
+            self._record_failed_request(token_network, path_req)
             raise exceptions.NoRouteFound(
                 from_=to_checksum_address(path_req.from_),
                 to=to_checksum_address(path_req.to),
                 value=path_req.value,
             )
         # Create a feedback token and store it to the DB
-        feedback_token = create_and_store_feedback_tokens(
-            pathfinding_service=self.pathfinding_service,
-            token_network_address=token_network.address,
-            routes=paths,
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.FEEDBACK_TOKEN):
+            feedback_token = create_and_store_feedback_tokens(
+                pathfinding_service=self.pathfinding_service,
+                token_network_address=token_network.address,
+                routes=paths,
+            )
+        return {"result": [p.to_dict() for p in paths], "feedback_token": feedback_token.uuid.hex}
+
+    def _check_path_request_errors(
+        self,
+        token_network: TokenNetwork,
+        path_req: Union[PathRequest, "PaymentSplitRequest"],
+        split: bool = False,
+    ) -> None:
+        """ Raises `NoRouteFound` with a clear error message for common error cases """
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.CHECK_ERRORS):
+            error = token_network.check_path_request_errors(
+                source=path_req.from_,
+                target=path_req.to,
+                value=path_req.value,
+                reachability_state=self.pathfinding_service.matrix_listener.user_manager,
+                split=split,
+            )
+        if not error:
+            return
+
+        self._record_failed_request(token_network, path_req)
+        # There is no synchronization on the block number updates and the
+        # query performed above, so this may be higher than the original
+        # value.
+        approximate_error_block = self.pathfinding_service.blockchain_state.latest_committed_block
+        msg = f"{error}. Approximate block at the time of the request {approximate_error_block}"
+        raise exceptions.NoRouteFound(
+            from_=to_checksum_address(path_req.from_),
+            to=to_checksum_address(path_req.to),
+            value=path_req.value,
+            msg=msg,
         )
+
+    def _record_failed_request(
+        self, token_network: TokenNetwork, path_req: Union[PathRequest, "PaymentSplitRequest"]
+    ) -> None:
+        # this is for assertion via the scenario player
+        if self.debug_mode:
+            last_failed_requests.append(
+                dict(
+                    token_network_address=to_checksum_address(token_network.address),
+                    source=to_checksum_address(path_req.from_),
+                    target=to_checksum_address(path_req.to),
+                    routes=[],
+                )
+            )
+
+
+@add_schema
+@dataclass
+class BatchPathRequest:
+    """A HTTP request to BatchPathsResource"""
+
+    requests: List[PathRequest] = field(
+        metadata=dict(validate=marshmallow.validate.Length(min=1, max=MAX_PATH_REQUESTS_PER_BATCH))
+    )
+    iou: Optional[IOU] = None
+    Schema: ClassVar[Type[marshmallow.Schema]]
+
+
+class BatchPathsResource(PathsResource):
+    """Handles multiple path requests for one token network at once.
+
+    The IOU is checked once and has to pay the service fee for all requests.
+    All requests share one `--path-search-budget`, requests which are left
+    when it is used up fail with `PathSearchTimeout`. They are answered by the
+    routing workers if enabled, otherwise all requests are computed on the
+    same routing snapshot. The results are returned in the order of the
+    requests, failed requests return the error instead of their paths.
+    """
+
+    def post(self, token_network_address: str) -> Tuple[dict, int]:
+        token_network = self._validate_token_network_argument(token_network_address)
+        batch_req = self._parse_post(BatchPathRequest)
+        if any(path_req.iou is not None for path_req in batch_req.requests):
+            raise exceptions.InvalidRequest(
+                msg="The IOU has to be given once for the whole batch, not per request"
+            )
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.IOU):
+            process_payment(
+                iou=batch_req.iou,
+                pathfinding_service=self.pathfinding_service,
+                service_fee=TokenAmount(self.api.service_fee * len(batch_req.requests)),
+                one_to_n_address=self.api.one_to_n_address,
+            )
+
+        time_budget = self.pathfinding_service.path_search_budget
+        deadline = monotonic() + time_budget if time_budget is not None else None
+        routing_pool = self.pathfinding_service.routing_pool
+        snapshot = None
+        if routing_pool is None or not routing_pool.is_published(token_network.address):
+            with metrics.time_path_request_phase(metrics.PathRequestPhase.PRUNING):
+                snapshot = RoutingSnapshot(
+                    token_network,
+                    self.pathfinding_service.matrix_listener.user_manager,
+                    batch=True,
+                )
+        results = []
+        for path_req in batch_req.requests:
+            # Allow answering other requests in between
+            gevent.sleep(0)
+            try:
+                results.append(self._get_paths(token_network, path_req, snapshot, deadline))
+            except ApiException as ex:
+                results.append(
+                    {
+                        "errors": ex.msg,
+                        "error_code": ex.error_code,
+                        "error_details": ex.error_details,
+                    }
+                )
+        return {"results": results}, 200
+
+
+@add_schema
+@dataclass
+class PaymentSplitRequest:
+    """A HTTP request to PaymentSplitResource"""
+
+    from_: Address = field(
+        metadata=dict(marshmallow_field=ChecksumAddress(required=True, data_key="from"))
+    )
+    to: Address = field(metadata=dict(marshmallow_field=ChecksumAddress(required=True)))
+    value: PaymentAmount = field(metadata=dict(validate=marshmallow.validate.Range(min=1)))
+    max_paths: int = field(
+        default=DEFAULT_MAX_PATHS,
+        metadata=dict(validate=marshmallow.validate.Range(min=1, max=MAX_PATHS_PER_REQUEST)),
+    )
+    iou: Optional[IOU] = None
+    fee_penalty: Optional[float] = None
+    Schema: ClassVar[Type[marshmallow.Schema]]
+
+
+class PaymentSplitResource(PathsResource):
+    """Splits a payment over multiple paths with distinct channels.
+
+    Each returned path contains the `amount` which should be sent over it.
+    The amounts add up to the requested value, the estimated fees have to be
+    paid on top of them. The request is checked and limited like a path
+    request.
+    """
+
+    def post(self, token_network_address: str) -> Tuple[dict, int]:
+        token_network = self._validate_token_network_argument(token_network_address)
+        split_req = self._parse_post(PaymentSplitRequest)
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.IOU):
+            process_payment(
+                iou=split_req.iou,
+                pathfinding_service=self.pathfinding_service,
+                service_fee=self.api.service_fee,
+                one_to_n_address=self.api.one_to_n_address,
+            )
+
+        self._check_path_request_errors(token_network, split_req, split=True)
+        token_network.record_path_request(split_req.value)
+
+        optional_args = {}
+        if split_req.fee_penalty is not None:
+            optional_args["fee_penalty"] = split_req.fee_penalty
+        try:
+            paths = token_network.get_payment_split(
+                source=split_req.from_,
+                target=split_req.to,
+                value=split_req.value,
+                max_paths=split_req.max_paths,
+                reachability_state=self.pathfinding_service.matrix_listener.user_manager,
+                time_budget=self.pathfinding_service.path_search_budget,
+                **optional_args,
+            )
+        except exceptions.PathSearchBudgetExceeded:
+            raise exceptions.PathSearchTimeout(
+                from_=to_checksum_address(split_req.from_),
+                to=to_checksum_address(split_req.to),
+                value=split_req.value,
+            )
+        if not paths:
+            self._record_failed_request(token_network, split_req)
+            raise exceptions.NoRouteFound(
+                from_=to_checksum_address(split_req.from_),
+                to=to_checksum_address(split_req.to),
+                value=split_req.value,
+            )
+
+        with metrics.time_path_request_phase(metrics.PathRequestPhase.FEEDBACK_TOKEN):
+            feedback_token = create_and_store_feedback_tokens(
+                pathfinding_service=self.pathfinding_service,
+                token_network_address=token_network.address,
+                routes=paths,
+            )
         return (
-            {"result": [p.to_dict() for p in paths], "feedback_token": feedback_token.uuid.hex},
+            {
+                "result": [dict(path.to_dict(), amount=path.value) for path in paths],
+                "feedback_token": feedback_token.uuid.hex,
+            },
             200,
         )
 
@@ -208,7 +431,7 @@ class PathsResource(PathfinderResource):
 def create_and_store_feedback_tokens(
     pathfinding_service: PathfindingService,
     token_network_address: TokenNetworkAddress,
-    routes: List[Path],
+    routes: Sequence[Union[Path, PathResult]],
 ) -> FeedbackToken:
     feedback_token = FeedbackToken(token_network_address=token_network_address)
 
@@ -654,6 +877,18 @@ class PFSApi:
                 dict(debug_mode=debug_mode),
                 "paths",
             ),
+            (
+                "/v1/<token_network_address>/paths/batch",
+                BatchPathsResource,
+                dict(debug_mode=debug_mode),
+                "paths_batch",
+            ),
+            (
+                "/v1/<token_network_address>/paths/split",
+                PaymentSplitResource,
+                dict(debug_mode=debug_mode),
+                "paths_split",
+            ),
             ("/v1/<token_network_address>/payment/iou", IOUResource, {}, "payments"),
             ("/v1/<token_network_address>/feedback", FeedbackResource, {}, "feedback"),
             (
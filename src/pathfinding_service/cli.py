@@ -12,7 +12,14 @@ from web3 import Web3
 from web3.contract import Contract
 
 from pathfinding_service.api import PFSApi
-from pathfinding_service.constants import DEFAULT_INFO_MESSAGE, PFS_DISCLAIMER, PFS_START_TIMEOUT
+from pathfinding_service.constants import (
+    DEFAULT_CHANNEL_FLUSH_INTERVAL,
+    DEFAULT_INFO_MESSAGE,
+    DEFAULT_PATH_SEARCH_BUDGET,
+    PFS_DISCLAIMER,
+    PFS_START_TIMEOUT,
+)
+from pathfinding_service.model.shortest_paths import RoutingEngine
 from pathfinding_service.service import PathfindingService
 from raiden.settings import DEFAULT_NUMBER_OF_BLOCK_CONFIRMATIONS
 from raiden.utils.typing import BlockNumber, BlockTimeout, TokenAmount
@@ -73,6 +80,31 @@ log = structlog.get_logger(__name__)
     multiple=True,
     help="Use this matrix server instead of the default ones. Include protocol in argument.",
 )
+@click.option(
+    "--routing-engine",
+    default=RoutingEngine.NETWORKX.value,
+    type=click.Choice([engine.value for engine in RoutingEngine]),
+    help="Implementation used to search the k shortest paths for a route request",
+)
+@click.option(
+    "--routing-workers",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Number of worker processes computing routes, 0 to compute them in the main process",
+)
+@click.option(
+    "--path-search-budget",
+    default=DEFAULT_PATH_SEARCH_BUDGET,
+    type=click.FloatRange(min=0),
+    help="Seconds a path request may search for routes, 0 for no limit",
+)
+@click.option(
+    "--channel-flush-interval",
+    default=DEFAULT_CHANNEL_FLUSH_INTERVAL,
+    type=click.FloatRange(min=0),
+    help="Seconds after which channel updates are written to the database at the latest, "
+    "0 to write them immediately",
+)
 @click.option(
     "--accept-disclaimer",
     type=bool,
@@ -95,6 +127,10 @@ def main(  # pylint: disable=too-many-arguments,too-many-locals
     info_message: str,
     enable_debug: bool,
     matrix_server: List[str],
+    routing_engine: str,
+    routing_workers: int,
+    path_search_budget: float,
+    channel_flush_interval: float,
     accept_disclaimer: bool,
 ) -> int:
     """ The Pathfinding service for the Raiden Network. """
@@ -120,6 +156,10 @@ def main(  # pylint: disable=too-many-arguments,too-many-locals
             poll_interval=DEFAULT_POLL_INTERVALL,
             db_filename=state_db,
             matrix_servers=matrix_server,
+            routing_engine=RoutingEngine(routing_engine),
+            routing_workers=routing_workers,
+            path_search_budget=path_search_budget or None,
+            channel_flush_interval=channel_flush_interval,
         )
         service.start()
         log.debug("Waiting for service to start before accepting API requests")
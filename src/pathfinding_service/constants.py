@@ -4,6 +4,9 @@ from datetime import timedelta
 from raiden.utils.typing import BlockTimeout
 
 PFS_START_TIMEOUT = 300  # in seconds
+DEFAULT_PATH_SEARCH_BUDGET = 5.0  # in seconds, time a path request may spend searching
+DEFAULT_CHANNEL_FLUSH_INTERVAL = 0.0  # in seconds, time channel updates may stay unwritten
+CHANNEL_FLUSH_SIZE: int = 1000  # number of unwritten channel updates which are written at once
 API_PATH: str = "/api"
 
 WEB3_PROVIDER_DEFAULT: str = "http://127.0.0.1:8545"
@@ -11,7 +14,20 @@ WEB3_PROVIDER_DEFAULT: str = "http://127.0.0.1:8545"
 DIVERSITY_PEN_DEFAULT: int = 5
 FEE_PEN_DEFAULT: int = 100
 MAX_PATHS_PER_REQUEST: int = 25
+MAX_PATH_REQUESTS_PER_BATCH: int = 100
 DEFAULT_MAX_PATHS: int = 5  # number of paths return when no `max_path` argument is given
+ROUTE_CACHE_SIZE: int = 1000  # number of cached `get_paths` results per token network
+ROUTE_WARMER_INTERVAL: int = 60  # in seconds, between precomputations of popular routes
+ROUTE_WARMER_PAIRS: int = 50  # most requested source/target pairs per token network to precompute
+ROUTE_WARMER_VALUES: int = 3  # most requested value buckets to precompute per pair
+ROUTE_WARMER_WINDOW: timedelta = timedelta(hours=24)  # age of the considered path requests
+ROUTING_LANDMARKS: int = 8  # landmarks for the hop bounds of hop limited path searches
+# Changed channels and nodes per channel above which routing workers get a full snapshot
+ROUTING_MAX_UPDATE_SHARE: float = 0.1
+DEADLINE_CHECK_INTERVAL: int = 1000  # steps of a path search between checks of its time budget
+# Share of all channel views a single path request has to weigh before the fees
+# of all channel views are estimated at once
+FEE_ESTIMATE_MIN_SHARE: float = 0.25
 
 DEFAULT_REVEAL_TIMEOUT: BlockTimeout = BlockTimeout(50)
 
@@ -1,14 +1,15 @@
 import json
 import os
 from datetime import datetime
-from typing import Dict, Iterator, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from uuid import UUID
 
 import structlog
 from eth_utils import to_canonical_address, to_checksum_address
 
+from pathfinding_service.constants import CHANNEL_FLUSH_SIZE
 from pathfinding_service.model import IOU
-from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.channel import Channel, FeeSchedule
 from pathfinding_service.model.feedback import FeedbackToken
 from pathfinding_service.model.token_network import TokenNetwork
 from pathfinding_service.typing import DeferableMessage
@@ -40,11 +41,19 @@ class PFSDatabase(BaseDatabase):
         pfs_address: Address,
         sync_start_block: BlockNumber = BlockNumber(0),
         allow_create: bool = False,
+        channel_flush_interval: float = 0,
         **contract_addresses: Address,
     ):
         super().__init__(filename, allow_create=allow_create)
         self.pfs_address = pfs_address
 
+        # Channel updates are written behind, see `defer_channel_updates`
+        self.channel_flush_interval = channel_flush_interval
+        self._dirty_channels: Dict[Tuple[TokenNetworkAddress, ChannelID], Channel] = {}
+        self._dirty_capacity_updates: Dict[
+            Tuple[TokenNetworkAddress, ChannelID, Address], PFSCapacityUpdate
+        ] = {}
+
         # Keep the journal around and skip inode updates.
         # References:
         # https://sqlite.org/atomiccommit.html#_persistent_rollback_journals
@@ -58,8 +67,22 @@ class PFSDatabase(BaseDatabase):
             **contract_addresses,
         )
 
-    def upsert_capacity_update(self, message: PFSCapacityUpdate) -> None:
-        capacity_update_dict = dict(
+        # Latest capacities per updating participant and channel, kept in
+        # memory so that capacity updates don't have to read them from the db.
+        self._capacity_updates: Dict[
+            Tuple[Address, TokenNetworkAddress, int], Tuple[TokenAmount, TokenAmount]
+        ] = {
+            (
+                to_canonical_address(row["updating_participant"]),
+                to_canonical_address(row["token_network_address"]),
+                row["channel_id"],
+            ): (row["updating_capacity"], row["other_capacity"])
+            for row in self.conn.execute("SELECT * FROM capacity_update")
+        }
+
+    @staticmethod
+    def _capacity_update_dict(message: PFSCapacityUpdate) -> Dict[str, str]:
+        return dict(
             updating_participant=to_checksum_address(message.updating_participant),
             token_network_address=to_checksum_address(
                 message.canonical_identifier.token_network_address
@@ -68,7 +91,30 @@ class PFSDatabase(BaseDatabase):
             updating_capacity=hex256(message.updating_capacity),
             other_capacity=hex256(message.other_capacity),
         )
-        self.upsert("capacity_update", capacity_update_dict)
+
+    def index_capacity_update(self, message: PFSCapacityUpdate) -> None:
+        """Makes `message` visible to `get_capacity_updates` without writing it.
+
+        The update has to be written with `upsert_capacity_updates` or
+        `defer_channel_updates` later.
+        """
+        key = (
+            message.updating_participant,
+            TokenNetworkAddress(message.canonical_identifier.token_network_address),
+            message.canonical_identifier.channel_identifier,
+        )
+        self._capacity_updates[key] = (message.updating_capacity, message.other_capacity)
+
+    def upsert_capacity_update(self, message: PFSCapacityUpdate) -> None:
+        self.upsert_capacity_updates([message])
+
+    def upsert_capacity_updates(self, messages: Iterable[PFSCapacityUpdate]) -> None:
+        messages = list(messages)
+        self.upsert_many(
+            "capacity_update", [self._capacity_update_dict(message) for message in messages]
+        )
+        for message in messages:
+            self.index_capacity_update(message)
 
     def get_capacity_updates(
         self,
@@ -76,32 +122,27 @@ class PFSDatabase(BaseDatabase):
         token_network_address: TokenNetworkAddress,
         channel_id: int,
     ) -> Tuple[TokenAmount, TokenAmount]:
-        capacity_list = self.conn.execute(
-            """
-            SELECT updating_capacity, other_capacity
-            FROM capacity_update WHERE updating_participant=?
-            AND token_network_address=?
-            AND channel_id=?
-        """,
-            [
-                to_checksum_address(updating_participant),
-                to_checksum_address(token_network_address),
-                hex256(channel_id),
-            ],
+        return self._capacity_updates.get(
+            (updating_participant, token_network_address, channel_id),
+            (TokenAmount(0), TokenAmount(0)),
         )
-        try:
-            return next(capacity_list)
-        except StopIteration:
-            return TokenAmount(0), TokenAmount(0)
 
     def get_latest_committed_block(self) -> BlockNumber:
         return self.conn.execute("SELECT latest_committed_block FROM blockchain").fetchone()[0]
 
     def update_lastest_committed_block(self, latest_committed_block: BlockNumber) -> None:
+        """Stores the block up to which all events have been processed.
+
+        The deferred channel updates are written in the same transaction, so
+        that the state at the latest committed block is complete after a
+        restart.
+        """
         log.info("Updating latest_committed_block", latest_committed_block=latest_committed_block)
-        self.conn.execute(
-            "UPDATE blockchain SET latest_committed_block = ?", [latest_committed_block]
-        )
+        with self.transaction():
+            self._write_dirty_channels()
+            self.conn.execute(
+                "UPDATE blockchain SET latest_committed_block = ?", [latest_committed_block]
+            )
 
     def upsert_iou(self, iou: IOU) -> None:
         iou_dict = IOU.Schema(exclude=["receiver", "chain_id"]).dump(iou)
@@ -171,7 +212,8 @@ class PFSDatabase(BaseDatabase):
         except StopIteration:
             return None
 
-    def upsert_channel(self, channel: Channel) -> None:
+    @staticmethod
+    def _channel_dict(channel: Channel) -> Dict[str, Any]:
         channel_dict = Channel.Schema().dump(channel)
         for key in (
             "channel_id",
@@ -186,15 +228,134 @@ class PFSDatabase(BaseDatabase):
             channel_dict[key] = hex256(int(channel_dict[key]))
         channel_dict["fee_schedule1"] = json.dumps(channel_dict["fee_schedule1"])
         channel_dict["fee_schedule2"] = json.dumps(channel_dict["fee_schedule2"])
-        self.upsert("channel", channel_dict)
+        return channel_dict
+
+    def upsert_channel(self, channel: Channel) -> None:
+        self.upsert("channel", self._channel_dict(channel))
+
+    def upsert_channels(self, channels: Iterable[Channel]) -> None:
+        self.upsert_many("channel", [self._channel_dict(channel) for channel in channels])
+
+    def defer_channel_updates(
+        self, channels: Iterable[Channel], capacity_updates: Iterable[PFSCapacityUpdate] = ()
+    ) -> None:
+        """Marks the `channels` as changed without writing them immediately.
+
+        The changed channels are written together by `flush_channels`, which
+        the service calls every `channel_flush_interval` seconds, or as soon
+        as `CHANNEL_FLUSH_SIZE` channels are waiting. With an interval of 0,
+        they are written immediately. Channels are only serialized when they
+        are written, so repeated changes of a channel are written once.
+
+        The `capacity_updates` which lead to the channel changes are written
+        in the same transaction as the channels, so that both agree after a
+        crash. They must already be indexed, see `index_capacity_update`.
+        """
+        for channel in channels:
+            self._dirty_channels[(channel.token_network_address, channel.channel_id)] = channel
+        for message in capacity_updates:
+            key = (
+                TokenNetworkAddress(message.canonical_identifier.token_network_address),
+                message.canonical_identifier.channel_identifier,
+                message.updating_participant,
+            )
+            self._dirty_capacity_updates[key] = message
+
+        num_dirty = len(self._dirty_channels) + len(self._dirty_capacity_updates)
+        if self.channel_flush_interval == 0 or num_dirty >= CHANNEL_FLUSH_SIZE:
+            self.flush_channels()
+
+    def flush_channels(self) -> None:
+        """ Writes all deferred channel and capacity updates in a single transaction """
+        if not self._dirty_channels and not self._dirty_capacity_updates:
+            return
+        with self.transaction():
+            self._write_dirty_channels()
+
+    def _write_dirty_channels(self) -> None:
+        if not self._dirty_channels and not self._dirty_capacity_updates:
+            return
+        log.debug(
+            "Writing changed channels",
+            num_channels=len(self._dirty_channels),
+            num_capacity_updates=len(self._dirty_capacity_updates),
+        )
+        self.upsert_many(
+            "capacity_update",
+            [
+                self._capacity_update_dict(message)
+                for message in self._dirty_capacity_updates.values()
+            ],
+        )
+        self.upsert_channels(self._dirty_channels.values())
+        self._dirty_capacity_updates.clear()
+        self._dirty_channels.clear()
 
     def get_channels(self) -> Iterator[Channel]:
+        self.flush_channels()
         for row in self.conn.execute("SELECT * FROM channel"):
             channel_dict = dict(zip(row.keys(), row))
             channel_dict["fee_schedule1"] = json.loads(channel_dict["fee_schedule1"])
             channel_dict["fee_schedule2"] = json.loads(channel_dict["fee_schedule2"])
             yield Channel.Schema().load(channel_dict)
 
+    def load_channels(self) -> Iterator[Channel]:
+        """Returns the same channels as `get_channels`, but much faster.
+
+        Used to load all channels on startup. The rows are read as plain
+        tuples and converted without running the channel schema for each of
+        them. Addresses and fee schedules repeat a lot, so each distinct value
+        is only converted once and the results are shared. This is fine since
+        fee schedules are replaced instead of modified on updates.
+        """
+        self.flush_channels()
+        addresses: Dict[str, Address] = {}
+        fee_schedules: Dict[str, FeeSchedule] = {}
+        fee_schedule_field = Channel.Schema().fields["fee_schedule1"]
+
+        def to_address(checksum_address: str) -> Address:
+            address = addresses.get(checksum_address)
+            if address is None:
+                address = addresses[checksum_address] = Address(
+                    to_canonical_address(checksum_address)
+                )
+            return address
+
+        def to_fee_schedule(fee_schedule_json: str) -> FeeSchedule:
+            fee_schedule = fee_schedules.get(fee_schedule_json)
+            if fee_schedule is None:
+                fee_schedule = fee_schedules[fee_schedule_json] = fee_schedule_field.deserialize(
+                    json.loads(fee_schedule_json)
+                )
+            return fee_schedule
+
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            """
+            SELECT token_network_address, channel_id, participant1, participant2,
+                settle_timeout, fee_schedule1, fee_schedule2, capacity1, capacity2,
+                update_nonce1, update_nonce2, reveal_timeout1, reveal_timeout2
+            FROM channel
+            """
+        )
+        for row in cursor:
+            yield Channel(
+                token_network_address=TokenNetworkAddress(to_address(row[0])),
+                channel_id=row[1],
+                participant1=to_address(row[2]),
+                participant2=to_address(row[3]),
+                settle_timeout=row[4],
+                fee_schedule1=to_fee_schedule(row[5]),
+                fee_schedule2=to_fee_schedule(row[6]),
+                capacity1=row[7],
+                capacity2=row[8],
+                update_nonce1=row[9],
+                update_nonce2=row[10],
+                reveal_timeout1=row[11],
+                reveal_timeout2=row[12],
+            )
+
     def delete_channel(
         self, token_network_address: TokenNetworkAddress, channel_id: ChannelID
     ) -> bool:
@@ -206,6 +367,8 @@ class PFSDatabase(BaseDatabase):
 
         Returns: `True` if the channel was deleted, `False` if it did not exist
         """
+        # Must not be written again
+        self._dirty_channels.pop((token_network_address, channel_id), None)
         cursor = self.conn.execute(
             "DELETE FROM channel WHERE token_network_address = ? AND channel_id = ?",
             [to_checksum_address(token_network_address), hex256(channel_id)],
@@ -293,6 +456,26 @@ class PFSDatabase(BaseDatabase):
             route["route"] = json.loads(route["route"])
             yield route
 
+    def get_most_requested_pairs(
+        self, token_network_address: TokenNetworkAddress, limit: int, since: datetime
+    ) -> List[Tuple[Address, Address]]:
+        """ Returns the source/target pairs with most path requests since `since` """
+        rows = self.conn.execute(
+            """
+            SELECT source_address, target_address
+            FROM feedback
+            WHERE token_network_address = ? AND creation_time >= ?
+            GROUP BY source_address, target_address
+            ORDER BY COUNT(DISTINCT token_id) DESC, source_address, target_address
+            LIMIT ?
+            """,
+            [to_checksum_address(token_network_address), since, limit],
+        )
+        return [
+            (Address(to_canonical_address(row[0])), Address(to_canonical_address(row[1])))
+            for row in rows
+        ]
+
     def get_feedback_token(
         self, token_id: UUID, token_network_address: TokenNetworkAddress, route: List[Address]
     ) -> Optional[FeedbackToken]:
@@ -328,16 +511,22 @@ class PFSDatabase(BaseDatabase):
 
         return self.conn.execute(f"SELECT COUNT(*) FROM feedback {where_clause};").fetchone()[0]
 
-    def insert_waiting_message(self, message: DeferableMessage) -> None:
-        self.insert(
-            "waiting_message",
-            dict(
-                token_network_address=to_checksum_address(
-                    message.canonical_identifier.token_network_address
-                ),
-                channel_id=hex256(message.canonical_identifier.channel_identifier),
-                message=JSONSerializer.serialize(message),
+    @staticmethod
+    def _waiting_message_dict(message: DeferableMessage) -> Dict[str, str]:
+        return dict(
+            token_network_address=to_checksum_address(
+                message.canonical_identifier.token_network_address
             ),
+            channel_id=hex256(message.canonical_identifier.channel_identifier),
+            message=JSONSerializer.serialize(message),
+        )
+
+    def insert_waiting_message(self, message: DeferableMessage) -> None:
+        self.insert("waiting_message", self._waiting_message_dict(message))
+
+    def insert_waiting_messages(self, messages: Iterable[DeferableMessage]) -> None:
+        self.insert_many(
+            "waiting_message", [self._waiting_message_dict(message) for message in messages]
         )
 
     def pop_waiting_messages(
@@ -19,6 +19,10 @@ class UndefinedFee(Exception):
     This should be handled by excluding the route from the results"""
 
 
+class PathSearchBudgetExceeded(Exception):
+    """The path search ran out of time before it found any path"""
+
+
 # ### Generic Service Exceptions 20xx ###
 
 
@@ -125,3 +129,9 @@ class AddressNotOnline(ApiException):
     error_code = 2203
     http_code = 404
     msg = "There is no user found online for given address."
+
+
+class PathSearchTimeout(ApiException):
+    error_code = 2204
+    http_code = 503
+    msg = "The search for routes took too long. Please try again later."
@@ -1,4 +1,10 @@
-from prometheus_client import Gauge
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import DefaultDict, Iterator, List
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.context_managers import Timer
 
 from raiden_libs.metrics import (  # noqa: F401, pylint: disable=unused-import
     ERRORS_LOGGED,
@@ -34,3 +40,138 @@ IOU_CLAIMS_TOKEN = Gauge(
     labelnames=[IouStatus.label_name()],
     registry=REGISTRY,
 )
+
+
+TOKEN_NETWORK_NODES = Gauge(
+    "token_network_nodes",
+    "The number of nodes in the graph of a token network",
+    labelnames=["token_network_address"],
+    registry=REGISTRY,
+)
+
+TOKEN_NETWORK_CHANNELS = Gauge(
+    "token_network_channels",
+    "The number of open channels in a token network",
+    labelnames=["token_network_address"],
+    registry=REGISTRY,
+)
+
+
+MESSAGE_BATCH_SIZE = Histogram(
+    "messages_batch_size",
+    "The number of messages received in one Matrix sync and handled together",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    registry=REGISTRY,
+)
+
+MESSAGE_BATCH_DURATION = Histogram(
+    "messages_batch_duration_seconds",
+    "The time to handle and persist a batch of messages",
+    registry=REGISTRY,
+)
+
+
+class MessageType(MetricsEnum):
+    PFS_CAPACITY_UPDATE = "PFSCapacityUpdate"
+    PFS_FEE_UPDATE = "PFSFeeUpdate"
+
+
+MESSAGES_COALESCED = Counter(
+    "messages_coalesced_total",
+    "The number of updates which were dropped because a later update of the same batch "
+    "superseded them",
+    labelnames=[MessageType.label_name()],
+    registry=REGISTRY,
+)
+
+
+PATH_SEARCH_BUDGET = Gauge(
+    "path_search_budget_seconds",
+    "The time after which path searches are stopped, 0 if they are not limited",
+    registry=REGISTRY,
+)
+
+PATH_SEARCHES_TRUNCATED = Counter(
+    "path_searches_truncated_total",
+    "The number of path searches which were stopped because they ran out of time",
+    registry=REGISTRY,
+)
+
+
+class PathRequestPhase(MetricsEnum):
+    IOU = "iou"
+    CHECK_ERRORS = "check_errors"
+    PRUNING = "pruning"
+    WEIGHTS = "weights"
+    SEARCH = "search"
+    FEES = "fees"
+    MATRIX_USERS = "matrix_users"
+    FEEDBACK_TOKEN = "feedback_token"
+
+
+PATH_REQUEST_PHASE_DURATION = Histogram(
+    "path_requests_phase_duration_seconds",
+    "The time a path request spends in each phase of its processing",
+    labelnames=[PathRequestPhase.label_name()],
+    registry=REGISTRY,
+)
+
+
+def time_path_request_phase(phase: PathRequestPhase) -> Timer:
+    return get_metrics_for_label(PATH_REQUEST_PHASE_DURATION, phase).time()
+
+
+class PathCandidate(MetricsEnum):
+    DUPLICATE = "duplicate"
+    INVALID = "invalid"
+    VALID = "valid"
+
+
+PATH_REQUEST_CANDIDATES = Counter(
+    "path_requests_candidates_total",
+    "The number of paths examined by the path searches",
+    labelnames=[PathCandidate.label_name()],
+    registry=REGISTRY,
+)
+
+
+class PathRequestMetrics:
+    """Collects the metrics of the path searches for a single path request.
+
+    Phases can be nested, the time spent in a nested phase is not counted for
+    the outer phase. All values are reported together by `observe`, so that
+    the histograms contain one sample per phase and request.
+    """
+
+    def __init__(self) -> None:
+        self.durations: DefaultDict[PathRequestPhase, float] = defaultdict(float)
+        self.candidates: DefaultDict[PathCandidate, int] = defaultdict(int)
+        # Set if the search ran out of time
+        self.truncated = False
+        self._phases: List[PathRequestPhase] = []
+        self._started = 0.0
+
+    @contextmanager
+    def measure(self, phase: PathRequestPhase) -> Iterator[None]:
+        now = perf_counter()
+        if self._phases:
+            self.durations[self._phases[-1]] += now - self._started
+        self._phases.append(phase)
+        self._started = now
+        try:
+            yield
+        finally:
+            now = perf_counter()
+            self.durations[self._phases.pop()] += now - self._started
+            self._started = now
+
+    def add_candidate(self, candidate: PathCandidate) -> None:
+        self.candidates[candidate] += 1
+
+    def observe(self) -> None:
+        for phase, duration in self.durations.items():
+            get_metrics_for_label(PATH_REQUEST_PHASE_DURATION, phase).observe(duration)
+        for candidate, count in self.candidates.items():
+            get_metrics_for_label(PATH_REQUEST_CANDIDATES, candidate).inc(count)
+        if self.truncated:
+            PATH_SEARCHES_TRUNCATED.inc()
@@ -1,6 +1,7 @@
 from .channel import ChannelView
 from .feedback import FeedbackToken
 from .iou import IOU
+from .shortest_paths import RoutingEngine
 from .token_network import TokenNetwork
 
-__all__ = ["ChannelView", "TokenNetwork", "IOU", "FeedbackToken"]
+__all__ = ["ChannelView", "TokenNetwork", "IOU", "FeedbackToken", "RoutingEngine"]
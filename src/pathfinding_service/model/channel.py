@@ -1,6 +1,7 @@
+import copy
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
-from typing import ClassVar, Tuple, Type
+from typing import ClassVar, Dict, Tuple, Type
 
 import marshmallow
 from eth_utils import to_checksum_address
@@ -9,6 +10,7 @@ from marshmallow_dataclass import add_schema
 
 from pathfinding_service.constants import DEFAULT_REVEAL_TIMEOUT
 from pathfinding_service.exceptions import InvalidFeeUpdate
+from pathfinding_service.model.fee_estimation import FeeCurve
 from raiden.transfer.mediated_transfer.mediation_fee import FeeScheduleState as FeeScheduleRaiden
 from raiden.utils.typing import (
     Address,
@@ -59,21 +61,54 @@ class Channel:
 
     Schema: ClassVar[Type[marshmallow.Schema]]
 
+    def __post_init__(self) -> None:
+        # Compiled fee curves by `ChannelView.reverse`, see `ChannelView.fee_curve`
+        self.fee_curves: Dict[bool, FeeCurve] = {}
+
+    def copy(self) -> "Channel":
+        """Returns a copy which can be updated without affecting this channel.
+
+        Fee schedules are replaced instead of modified on updates, so the copy
+        shares them and the already compiled fee curves.
+        """
+        channel = copy.copy(self)
+        channel.fee_curves = dict(self.fee_curves)
+        return channel
+
+    def __getstate__(self) -> dict:
+        # Fee curves are compiled on demand, also by path searches on channels
+        # which are pickled in another thread, see `RoutingPool.publish`.
+        state = dict(self.__dict__)
+        del state["fee_curves"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.fee_curves = {}
+
     @property
     def views(self) -> Tuple["ChannelView", "ChannelView"]:
         return ChannelView(channel=self), ChannelView(channel=self, reverse=True)
 
 
-@dataclass
 class ChannelView:
     """
     Unidirectional view of a bidirectional channel
 
-    No data is stored inside the ChannelView.
+    No data is stored inside the ChannelView. Token networks hold two views
+    per channel, so slots are used instead of an instance dict.
     """
 
-    channel: Channel
-    reverse: bool = False
+    __slots__ = ("channel", "reverse")
+
+    def __init__(self, channel: Channel, reverse: bool = False) -> None:
+        self.channel = channel
+        self.reverse = reverse
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ChannelView):
+            return NotImplemented
+        return (self.channel, self.reverse) == (other.channel, other.reverse)
 
     @property
     def channel_id(self) -> ChannelID:
@@ -105,6 +140,7 @@ class ChannelView:
             self.channel.capacity2 = value
         else:
             self.channel.capacity1 = value
+        self.channel.fee_curves.pop(self.reverse, None)
 
     @property
     def capacity_partner(self) -> TokenAmount:
@@ -132,6 +168,18 @@ class ChannelView:
         else:
             self.channel.update_nonce1 = value
 
+    @property
+    def fee_curve(self) -> FeeCurve:
+        """Fee calculation for this view, compiled on first use.
+
+        Updating the fee schedules with `set_fee_schedule` or the capacity
+        invalidates it. Changes to the fee schedule objects are not detected.
+        """
+        fee_curve = self.channel.fee_curves.get(self.reverse)
+        if fee_curve is None:
+            fee_curve = self.channel.fee_curves[self.reverse] = FeeCurve(self)
+        return fee_curve
+
     @property
     def fee_schedule_sender(self) -> FeeSchedule:
         return self.channel.fee_schedule2 if self.reverse else self.channel.fee_schedule1
@@ -158,6 +206,8 @@ class ChannelView:
             self.channel.fee_schedule2 = fee_schedule
         else:
             self.channel.fee_schedule1 = fee_schedule
+        # The schedule is also the receiver schedule of the opposite view
+        self.channel.fee_curves.clear()
 
     def __repr__(self) -> str:
         return "<ChannelView cid={} from={} to={} capacity={}>".format(
@@ -0,0 +1,110 @@
+"""Connected components of the channel graph of a token network.
+
+Channels can be used in both directions, so a route between two nodes exists
+in the unpruned graph exactly if they are in the same connected component.
+This allows rejecting path requests between disconnected nodes without
+searching the graph, and confining the search to the component otherwise.
+"""
+from collections import deque
+from typing import AbstractSet, Deque, Dict, Set
+
+from networkx import DiGraph
+
+from raiden.utils.typing import Address
+
+
+class ConnectivityIndex:
+    """Component labels for the nodes of a channel graph.
+
+    Opening a channel between two components merges them by relabeling the
+    nodes of the smaller one. Closing a channel can split a component, which
+    is detected by searching from both participants at once until the
+    searches meet or one of them runs out of nodes. In the latter case the
+    nodes it found get a new label. This keeps both updates proportional to
+    the smaller of the affected components in most cases.
+    """
+
+    def __init__(self) -> None:
+        self._labels: Dict[Address, int] = {}
+        self._components: Dict[int, Set[Address]] = {}
+        self._next_label = 0
+
+    def __len__(self) -> int:
+        """ Returns the number of components """
+        return len(self._components)
+
+    def _add_component(self, nodes: Set[Address]) -> None:
+        label = self._next_label
+        self._next_label += 1
+        self._components[label] = nodes
+        for node in nodes:
+            self._labels[node] = label
+
+    def add_channel(self, participant1: Address, participant2: Address) -> None:
+        for node in (participant1, participant2):
+            if node not in self._labels:
+                self._add_component({node})
+
+        label1, label2 = self._labels[participant1], self._labels[participant2]
+        if label1 == label2:
+            return
+        if len(self._components[label1]) > len(self._components[label2]):
+            label1, label2 = label2, label1
+        smaller = self._components.pop(label1)
+        for node in smaller:
+            self._labels[node] = label2
+        self._components[label2] |= smaller
+
+    def remove_channel(self, graph: DiGraph, participant1: Address, participant2: Address) -> None:
+        """Splits the component of the participants if necessary.
+
+        Must be called after the channel has been removed from `graph`.
+        """
+        if participant1 == participant2 or graph.has_edge(participant1, participant2):
+            return
+
+        searches = [
+            ({participant1}, deque([participant1])),
+            ({participant2}, deque([participant2])),
+        ]
+        other_found = searches[1][0], searches[0][0]
+        while True:
+            for (found, queue), other in zip(searches, other_found):
+                if not queue:
+                    # The search found a whole component, which doesn't
+                    # contain the other participant.
+                    self._split_off(found)
+                    return
+                if self._expand(graph, found, queue, other):
+                    return
+
+    @staticmethod
+    def _expand(
+        graph: DiGraph, found: Set[Address], queue: Deque[Address], other: Set[Address]
+    ) -> bool:
+        """ Visits the next node of a search, returns whether it met the `other` search """
+        for neighbor in graph.successors(queue.popleft()):
+            if neighbor in other:
+                return True
+            if neighbor not in found:
+                found.add(neighbor)
+                queue.append(neighbor)
+        return False
+
+    def _split_off(self, nodes: Set[Address]) -> None:
+        label = self._labels[next(iter(nodes))]
+        self._components[label] -= nodes
+        self._add_component(nodes)
+
+    def component(self, node: Address) -> AbstractSet[Address]:
+        """ Returns the nodes in the component of `node`, which must not be modified """
+        label = self._labels.get(node)
+        if label is None:
+            return {node}
+        return self._components[label]
+
+    def is_connected(self, source: Address, target: Address) -> bool:
+        """ Checks if the graph contains a path from `source` to `target` """
+        if source not in self._labels or target not in self._labels:
+            return source == target
+        return self._labels[source] == self._labels[target]
@@ -0,0 +1,288 @@
+"""Batched estimation of capped mediation fees.
+
+`get_amount_with_fees` evaluates the piecewise linear fee functions of a
+single channel with `Fraction`s. For channels without imbalance penalty the
+fee functions are linear, so the amount with fees has a closed form. The
+`FeeEstimator` keeps the parameters of all channel views of a token network in
+NumPy arrays and evaluates this closed form for all of them at once. Channel
+views with imbalance penalties or unusual parameters fall back to
+`get_amount_with_fees`, so the results are always identical.
+"""
+from copy import copy
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from raiden.tests.utils.mediation_fees import get_amount_with_fees
+from raiden.utils.typing import Balance, ChannelID, FeeAmount, PaymentAmount, PaymentWithFeeAmount
+
+if TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from pathfinding_service.model.channel import ChannelView, FeeSchedule
+
+# Proportional fees are given in parts per million
+PPM = 1_000_000
+
+# Identifies a `ChannelView` within a token network
+ViewKey = Tuple[ChannelID, bool]
+
+
+def view_key(view: "ChannelView") -> ViewKey:
+    return view.channel_id, view.reverse
+
+
+class LinearFeeParameters(NamedTuple):
+    """Parameters of the closed form fee calculation for a channel view.
+
+    The closed form is only used where the fee functions are linear and the
+    fees can't get negative, so that capping them has no effect.
+    """
+
+    flat: int
+    proportional_in: int
+    proportional_out: int
+    is_linear: bool
+
+    @classmethod
+    def from_view(cls, view: "ChannelView") -> "LinearFeeParameters":
+        schedule_in = view.fee_schedule_receiver
+        schedule_out = view.fee_schedule_sender
+        return cls(
+            flat=int(schedule_in.flat) + int(schedule_out.flat),
+            proportional_in=int(schedule_in.proportional),
+            proportional_out=int(schedule_out.proportional),
+            is_linear=(
+                not schedule_in.imbalance_penalty
+                and not schedule_out.imbalance_penalty
+                and schedule_in.flat >= 0
+                and schedule_out.flat >= 0
+                and 0 <= schedule_in.proportional < PPM
+                and schedule_out.proportional >= 0
+                and view.capacity > 0
+            ),
+        )
+
+    def amount_with_fees(self, amount: PaymentAmount) -> int:
+        """Scalar version of the closed form used in `FeeEstimator.estimate`.
+
+        Must only be called if `is_linear` is set.
+        """
+        numerator = int(amount) * (PPM + self.proportional_out) + PPM * self.flat
+        quotient, remainder = divmod(numerator, PPM - self.proportional_in)
+        # Round half to even, like `round` does for `Fraction`s
+        if 2 * remainder > PPM - self.proportional_in or (
+            2 * remainder == PPM - self.proportional_in and quotient % 2 == 1
+        ):
+            quotient += 1
+        return quotient
+
+
+def get_capped_fee(view: "ChannelView", amount: PaymentAmount) -> Optional[FeeAmount]:
+    """Returns the capped fee for mediating `amount` over `view` in both directions.
+
+    Returns `None` if no fees can be calculated for this channel view.
+    """
+    # Enable fee capping for both fee schedules
+    schedule_in = copy(view.fee_schedule_receiver)
+    schedule_in.cap_fees = True
+    schedule_out = copy(view.fee_schedule_sender)
+    schedule_out.cap_fees = True
+
+    amount_with_fees = get_amount_with_fees(
+        amount_without_fees=PaymentWithFeeAmount(amount),
+        balance_in=Balance(view.capacity),
+        balance_out=Balance(view.capacity),
+        schedule_in=schedule_in,
+        schedule_out=schedule_out,
+        receivable_amount=view.capacity,
+    )
+
+    if amount_with_fees is None:
+        return None
+    return FeeAmount(amount_with_fees - amount)
+
+
+class FeeCurve:
+    """Precompiled fee calculation for mediating over a single channel view.
+
+    Holds the linear fee parameters and copies of the view's fee schedules
+    with and without fee capping, including their imbalance penalty functions.
+    These are only created once instead of for every fee calculation. The
+    penalty functions look up the amount in their breakpoints by bisection.
+
+    Curves are cached by `ChannelView.fee_curve` and dropped when a fee
+    schedule or capacity of the channel is updated.
+    """
+
+    def __init__(self, view: "ChannelView") -> None:
+        self.capacity = view.capacity
+        self.linear = LinearFeeParameters.from_view(view)
+
+        def with_cap_fees(schedule: "FeeSchedule", cap_fees: bool) -> "FeeSchedule":
+            schedule = copy(schedule)
+            schedule.cap_fees = cap_fees
+            return schedule
+
+        self.schedules: Dict[bool, Tuple["FeeSchedule", "FeeSchedule"]] = {
+            cap_fees: (
+                with_cap_fees(view.fee_schedule_receiver, cap_fees),
+                with_cap_fees(view.fee_schedule_sender, cap_fees),
+            )
+            for cap_fees in (True, False)
+        }
+
+    def get_fee(self, amount: PaymentAmount, cap_fees: bool = True) -> Optional[FeeAmount]:
+        """Returns the fee for mediating `amount`, like `get_capped_fee` if `cap_fees` is set.
+
+        Returns `None` if no fees can be calculated for this channel view.
+        """
+        if self.linear.is_linear:
+            amount_with_fees = self.linear.amount_with_fees(amount)
+            if amount_with_fees <= self.capacity:
+                return FeeAmount(amount_with_fees - amount)
+
+        schedule_in, schedule_out = self.schedules[cap_fees]
+        amount_with_fees = get_amount_with_fees(
+            amount_without_fees=PaymentWithFeeAmount(amount),
+            balance_in=Balance(self.capacity),
+            balance_out=Balance(self.capacity),
+            schedule_in=schedule_in,
+            schedule_out=schedule_out,
+            receivable_amount=self.capacity,
+        )
+
+        if amount_with_fees is None:
+            return None
+        return FeeAmount(amount_with_fees - amount)
+
+
+class FeeEstimate:
+    """Capped fees for one amount, as returned by `FeeEstimator.estimate`.
+
+    The estimated fees are only used for the channel views they have been
+    calculated for. Views which have been replaced since, e.g. by the copy of
+    an updated channel, fall back to their fee curve.
+    """
+
+    def __init__(
+        self,
+        views: List["ChannelView"],
+        view_index: Dict[ViewKey, int],
+        amount: PaymentAmount,
+        fees: np.ndarray,
+        is_exact: np.ndarray,
+    ) -> None:
+        self.views = views
+        self.view_index = view_index
+        self.amount = amount
+        self.fees = fees
+        self.is_exact = is_exact
+
+    @classmethod
+    def from_fee_curves(cls, amount: PaymentAmount) -> "FeeEstimate":
+        """ Returns an estimate which calculates the fees from the views' fee curves on demand """
+        return cls(
+            views=[],
+            view_index={},
+            amount=amount,
+            fees=np.zeros(0, dtype=object),
+            is_exact=np.zeros(0, dtype=bool),
+        )
+
+    def __getitem__(self, view: "ChannelView") -> Optional[FeeAmount]:
+        index = self.view_index.get(view_key(view))
+        if index is not None and self.views[index] is view and self.is_exact[index]:
+            return FeeAmount(self.fees[index])
+        return view.fee_curve.get_fee(self.amount)
+
+
+class FeeEstimator:
+    """Fee parameters of the given channel views in NumPy arrays.
+
+    Token networks only build an estimator when it is used and drop it when
+    channels are opened or closed, like the `CompactGraph`. The arrays are
+    built on demand. Afterwards, `update_view` has to be called whenever the
+    fee schedule or capacity of a view changes.
+
+    The estimator is shared by all epochs of a token network with the same
+    channels, see `TokenNetwork.pin_epoch`. Channels shared with pinned epochs
+    are copied before they are updated, so their views are replaced by new
+    ones here and the estimates for the pinned epochs skip them, see
+    `FeeEstimate`.
+    """
+
+    def __init__(self, views: Iterable["ChannelView"] = ()) -> None:
+        self.views: List["ChannelView"] = list(views)
+        self.view_index: Dict[ViewKey, int] = {
+            view_key(view): index for index, view in enumerate(self.views)
+        }
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.views)
+
+    def replace_view(self, view: "ChannelView") -> None:
+        """ Uses `view` instead of the view of the same channel and direction """
+        self.views[self.view_index[view_key(view)]] = view
+        self.update_view(view)
+
+    def update_view(self, view: "ChannelView") -> None:
+        """ Reads the fee schedules and capacity of `view` into the arrays """
+        index = self.view_index.get(view_key(view))
+        if self._arrays is None or index is None:
+            return
+        for name, value in self._parameters(view).items():
+            self._arrays[name][index] = value
+
+    @staticmethod
+    def _parameters(view: "ChannelView") -> Dict[str, object]:
+        parameters: Dict[str, object] = LinearFeeParameters.from_view(view)._asdict()
+        parameters["capacity"] = int(view.capacity)
+        return parameters
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            parameters = [self._parameters(view) for view in self.views]
+            names = ["flat", "proportional_in", "proportional_out", "capacity"]
+            self._arrays = {
+                name: np.array([p[name] for p in parameters], dtype=object) for name in names
+            }
+            self._arrays["is_linear"] = np.array([p["is_linear"] for p in parameters], dtype=bool)
+        return self._arrays
+
+    def estimate(self, amount: PaymentAmount) -> FeeEstimate:
+        """Calculates the capped fees for `amount` for all linear channel views at once.
+
+        The amount with fees `x` for the amount without fees `a` solves
+        ``x - a = flat_in + flat_out + x * prop_in / PPM + a * prop_out / PPM``.
+        Python ints are used as array elements, so that token amounts can't
+        overflow.
+        """
+        arrays = self.arrays
+        is_linear = arrays["is_linear"]
+        numerator = int(amount) * (PPM + arrays["proportional_out"]) + PPM * arrays["flat"]
+        denominator = np.where(is_linear, PPM - arrays["proportional_in"], 1)
+        quotient, remainder = numerator // denominator, numerator % denominator
+
+        # Round half to even, like `round` does for `Fraction`s
+        twice_remainder = 2 * remainder
+        round_up = (twice_remainder > denominator) | (
+            (twice_remainder == denominator) & (quotient % 2 == 1).astype(bool)
+        )
+        amount_with_fees = quotient + round_up
+
+        # Results which exceed the capacity are left to `get_amount_with_fees`
+        is_exact = is_linear & (amount_with_fees <= arrays["capacity"]).astype(bool)
+        return FeeEstimate(
+            views=self.views,
+            view_index=self.view_index,
+            amount=amount,
+            fees=amount_with_fees - int(amount),
+            is_exact=is_exact,
+        )
+
+    def get_fees(self, amount: PaymentAmount) -> List[Optional[FeeAmount]]:
+        """ Returns the capped fees for `amount` for all channel views, ordered like `views` """
+        fee_estimate = self.estimate(amount)
+        return [fee_estimate[view] for view in self.views]
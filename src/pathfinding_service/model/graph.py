@@ -0,0 +1,76 @@
+"""Channel graphs which can be copied without copying all edges.
+
+Routing snapshots pin the graphs of a token network, so the token network
+has to work on a copy once it is modified, see `TokenNetwork.pin_epoch`.
+Copying a `DiGraph` takes time linear in the number of channels. Usually only
+a few channels change between two snapshots, so the copies made by
+`CopyOnWriteDiGraph.copy_on_write` share the adjacency dicts of all nodes and
+only copy the ones of the nodes whose channels are modified.
+"""
+from typing import Any, Hashable, Iterable, Optional, Set
+
+from networkx import DiGraph
+
+
+class CopyOnWriteDiGraph(DiGraph):
+    """A `DiGraph` whose copies share the adjacency dicts of unmodified nodes.
+
+    Only the modifications used by `TokenNetwork` are supported, i.e. adding
+    nodes and edges and removing them. The edge attributes are replaced instead
+    of updated when an existing edge is added again, since the attribute dicts
+    can be shared with other graphs as well.
+    """
+
+    def __init__(self, incoming_graph_data: Any = None, **attr: Any) -> None:
+        # Nodes whose adjacency dicts belong to this graph, all if `None`
+        self._owned_nodes: Optional[Set[Hashable]] = None
+        super().__init__(incoming_graph_data, **attr)
+
+    def copy_on_write(self) -> "CopyOnWriteDiGraph":  # pylint: disable=protected-access
+        """Returns a copy which shares the adjacency dicts of all nodes with this graph.
+
+        This graph must not be modified anymore afterwards.
+        """
+        graph = self.__class__()
+        graph.graph.update(self.graph)
+        graph._node = dict(self._node)
+        graph._adj = graph._succ = dict(self._succ)
+        graph._pred = dict(self._pred)
+        graph._owned_nodes = set()
+        return graph
+
+    def _own(self, node: Hashable) -> None:
+        """ Copies the adjacency dicts of `node` before they are modified """
+        if self._owned_nodes is None or node in self._owned_nodes or node not in self._succ:
+            return
+        self._succ[node] = dict(self._succ[node])
+        self._pred[node] = dict(self._pred[node])
+        self._owned_nodes.add(node)
+
+    def add_edge(self, u_of_edge: Hashable, v_of_edge: Hashable, **attr: Any) -> None:
+        self._own(u_of_edge)
+        self._own(v_of_edge)
+        if self.has_edge(u_of_edge, v_of_edge):
+            datadict = {**self._succ[u_of_edge][v_of_edge], **attr}
+            self._succ[u_of_edge][v_of_edge] = datadict
+            self._pred[v_of_edge][u_of_edge] = datadict
+        else:
+            super().add_edge(u_of_edge, v_of_edge, **attr)
+
+    def add_edges_from(self, ebunch_to_add: Iterable[tuple], **attr: Any) -> None:
+        if self._owned_nodes is None:
+            super().add_edges_from(ebunch_to_add, **attr)
+            return
+        for u, v, *data in ebunch_to_add:
+            self.add_edge(u, v, **attr, **(data[0] if data else {}))
+
+    def remove_edge(self, u: Hashable, v: Hashable) -> None:
+        self._own(u)
+        self._own(v)
+        super().remove_edge(u, v)
+
+    def remove_node(self, n: Hashable) -> None:
+        if n in self._succ:
+            for neighbour in set(self._succ[n]) | set(self._pred[n]):
+                self._own(neighbour)
+        super().remove_node(n)
@@ -0,0 +1,141 @@
+"""Cache for the results of `TokenNetwork.get_paths`.
+
+Clients often request routes for the same payment repeatedly. The cache
+stores the nodes of the found paths together with the versions of all
+channels and nodes on them. An entry is only used while none of these
+versions changed and no channel has been closed since. Opening a channel or
+a node coming online only bumps the versions of the nodes which got new
+usable channels, so cached paths over other nodes are kept, even if the new
+channels would allow better paths for them. The paths are validated again
+for every cache hit, since the requested value may differ within a value
+bucket.
+"""
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import DefaultDict, Dict, Hashable, List, Optional, Tuple
+
+from raiden.utils.typing import Address, ChannelID, PaymentAmount
+
+# Values which agree in this many leading decimal digits share cache entries
+VALUE_BUCKET_DIGITS = 2
+
+
+def value_bucket(value: PaymentAmount) -> int:
+    """ Rounds `value` down to `VALUE_BUCKET_DIGITS` significant digits """
+    unit = 10 ** max(len(str(value)) - VALUE_BUCKET_DIGITS, 0)
+    return value - value % unit
+
+
+@dataclass
+class CachedRoutes:
+    paths: List[List[Address]]
+    topology_version: int
+    channel_versions: Dict[ChannelID, int]
+    node_versions: Dict[Address, int]
+
+
+class RouteCache:
+    """Bounded LRU cache of found paths with version based invalidation.
+
+    `bump_channel`, `bump_node` and `bump_topology` must be called on all
+    changes of the token network which can influence routing results.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        # Incremented on every bump, i.e. whenever routing results might change
+        self.version = 0
+        self.topology_version = 0
+        self.channel_versions: DefaultDict[ChannelID, int] = defaultdict(int)
+        self.node_versions: DefaultDict[Address, int] = defaultdict(int)
+        self._entries: "OrderedDict[Hashable, CachedRoutes]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def bump_channel(self, channel_id: ChannelID) -> None:
+        self.channel_versions[channel_id] += 1
+        self.version += 1
+
+    def bump_node(self, address: Address) -> None:
+        self.node_versions[address] += 1
+        self.version += 1
+
+    def bump_topology(self) -> None:
+        """Invalidates all entries, e.g. because a channel has been closed.
+
+        The channel and node versions are only compared for entries of the
+        current topology, so they start again from zero. This keeps them from
+        growing with closed channels and nodes which are gone.
+        """
+        self.topology_version += 1
+        self.version += 1
+        self.channel_versions.clear()
+        self.node_versions.clear()
+
+    @staticmethod
+    def make_key(  # pylint: disable=too-many-arguments
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_paths: int,
+        diversity_penalty: float,
+        fee_penalty: float,
+        max_hops: Optional[int] = None,
+    ) -> Hashable:
+        return (
+            source,
+            target,
+            value_bucket(value),
+            max_paths,
+            diversity_penalty,
+            fee_penalty,
+            max_hops,
+        )
+
+    def get(self, key: Hashable) -> Optional[List[List[Address]]]:
+        """ Returns the cached paths for `key` if they are still up to date """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        is_current = (
+            entry.topology_version == self.topology_version
+            and all(
+                self.channel_versions.get(channel_id, 0) == version
+                for channel_id, version in entry.channel_versions.items()
+            )
+            and all(
+                self.node_versions.get(address, 0) == version
+                for address, version in entry.node_versions.items()
+            )
+        )
+        if not is_current:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return entry.paths
+
+    def put(self, key: Hashable, paths: List[Tuple[List[Address], List[ChannelID]]]) -> None:
+        """ Stores the node lists of `paths` along with the channels used by them """
+        self._entries[key] = CachedRoutes(
+            paths=[nodes for nodes, _ in paths],
+            topology_version=self.topology_version,
+            channel_versions={
+                channel_id: self.channel_versions.get(channel_id, 0)
+                for _, channel_ids in paths
+                for channel_id in channel_ids
+            },
+            node_versions={
+                address: self.node_versions.get(address, 0)
+                for nodes, _ in paths
+                for address in nodes
+            },
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
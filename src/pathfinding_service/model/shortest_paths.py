@@ -0,0 +1,439 @@
+"""Native k-shortest loopless paths search.
+
+`networkx.shortest_simple_paths` works on the dict-of-dicts `DiGraph` and has
+to hash addresses for every visited node and edge. The functions in this
+module operate on a `CompactGraph` instead, which interns the addresses to
+dense integer ids and stores the adjacency in contiguous arrays (CSR layout).
+
+Searches with a hop limit are directed toward the target with A*. The
+heuristic is a lower bound for the number of hops to the target, which is
+derived from the hop distances to a few landmark nodes (ALT). Every edge has a
+weight of at least one, so the bound is admissible.
+
+All searches take an optional deadline. It is checked for every spur node of
+Yen's algorithm and every `DEADLINE_CHECK_INTERVAL` expanded nodes within the
+single searches, so that a single slow search can't exceed the time budget of
+a path request by much.
+"""
+from array import array
+from collections import deque
+from enum import Enum
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import AbstractSet, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from networkx import DiGraph
+
+from pathfinding_service.constants import DEADLINE_CHECK_INTERVAL, ROUTING_LANDMARKS
+from pathfinding_service.exceptions import PathSearchBudgetExceeded
+from pathfinding_service.typing import AddressReachabilityProtocol
+from raiden.network.transport.matrix.utils import AddressReachability
+from raiden.utils.typing import Address
+
+# Returns the weight for the edge with the given index or `None` if the edge
+# must not be used.
+EdgeWeightFunc = Callable[[int], Optional[float]]
+
+# Returns a lower bound for the number of hops from the given node to the
+# target or `None` if the target can't be reached.
+HopBoundFunc = Callable[[int], Optional[int]]
+
+
+def check_deadline(deadline: Optional[float]) -> None:
+    """ Raises `PathSearchBudgetExceeded` if the `deadline` has passed """
+    if deadline is not None and monotonic() > deadline:
+        raise PathSearchBudgetExceeded()
+
+
+class RoutingEngine(Enum):
+    """ Implementation used to find the k shortest paths in a token network """
+
+    NETWORKX = "networkx"
+    NATIVE = "native"
+
+
+class CompactGraph:
+    """Array based snapshot of the channel graph of a token network.
+
+    Node ``i`` has the address ``addresses[i]``. Its outgoing edges are stored at
+    the indices ``offsets[i]:offsets[i + 1]`` of the edge arrays ``sources``,
+    ``targets`` and ``reverse``, where ``reverse`` holds the index of the edge
+    in the opposite direction.
+
+    The graph only has to be rebuilt when channels are opened or closed. It
+    only holds the topology, the `ChannelView`s of the edges are looked up in
+    the `DiGraph`, so capacity and fee updates are visible without a rebuild.
+    """
+
+    def __init__(self, graph: DiGraph) -> None:
+        self.addresses: List[Address] = list(graph.nodes)
+        self.node_ids: Dict[Address, int] = {
+            address: node_id for node_id, address in enumerate(self.addresses)
+        }
+
+        offsets = [0]
+        sources: List[int] = []
+        targets: List[int] = []
+        for node_id, address in enumerate(self.addresses):
+            for partner in graph.adj[address]:
+                sources.append(node_id)
+                targets.append(self.node_ids[partner])
+            offsets.append(len(targets))
+
+        edge_ids = {edge: index for index, edge in enumerate(zip(sources, targets))}
+        self.offsets = array("q", offsets)
+        self.sources = array("q", sources)
+        self.targets = array("q", targets)
+        self.reverse = array(
+            "q", (edge_ids.get((target, source), -1) for source, target in zip(sources, targets))
+        )
+        self._landmarks: Optional[Landmarks] = None
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    @property
+    def number_of_edges(self) -> int:
+        return len(self.targets)
+
+    @property
+    def landmarks(self) -> "Landmarks":
+        """ Hop distances for A* searches, calculated on first use """
+        if self._landmarks is None:
+            self._landmarks = Landmarks(self)
+        return self._landmarks
+
+    def hop_distances(self, start: int) -> array:
+        """ Breadth-first search, returns the number of hops from `start` or -1 per node """
+        distances = array("q", [-1]) * len(self)
+        distances[start] = 0
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            for edge in range(self.offsets[node], self.offsets[node + 1]):
+                neighbour = self.targets[edge]
+                if distances[neighbour] == -1:
+                    distances[neighbour] = distances[node] + 1
+                    queue.append(neighbour)
+        return distances
+
+    def edge_id(self, source: Address, target: Address) -> int:
+        """ Returns the index of the edge from `source` to `target` """
+        source_id, target_id = self.node_ids[source], self.node_ids[target]
+        for edge in range(self.offsets[source_id], self.offsets[source_id + 1]):
+            if self.targets[edge] == target_id:
+                return edge
+        raise KeyError((source, target))
+
+    def reachable_nodes(
+        self,
+        reachability_state: AddressReachabilityProtocol,
+        nodes: Optional[AbstractSet[Address]] = None,
+    ) -> bytearray:
+        """Returns a mask which is set for all nodes that are currently reachable
+
+        If `nodes` is given, only these nodes are checked and all others are unset.
+        """
+        if nodes is None:
+            return bytearray(
+                reachability_state.get_address_reachability(address)
+                == AddressReachability.REACHABLE
+                for address in self.addresses
+            )
+
+        mask = bytearray(len(self))
+        for address in nodes:
+            node_id = self.node_ids.get(address)
+            if (
+                node_id is not None
+                and reachability_state.get_address_reachability(address)
+                == AddressReachability.REACHABLE
+            ):
+                mask[node_id] = True
+        return mask
+
+
+class Landmarks:
+    """Hop distances from a few landmark nodes to all nodes of a `CompactGraph`.
+
+    Channels can be used in both directions, so by the triangle inequality
+    ``|d(l, v) - d(l, t)|`` is a lower bound for the hops from `v` to `t` for
+    every landmark `l`. Landmarks are chosen to be far apart from each other,
+    starting with the node with most channels.
+    """
+
+    def __init__(self, graph: CompactGraph, num_landmarks: int = ROUTING_LANDMARKS) -> None:
+        self.distances: List[array] = []
+        if len(graph) == 0:
+            return
+
+        degrees = [graph.offsets[node + 1] - graph.offsets[node] for node in range(len(graph))]
+        landmark = max(range(len(graph)), key=degrees.__getitem__)
+        # Hops to the closest landmark, unreachable nodes are the farthest ones
+        closest = [len(graph)] * len(graph)
+        for _ in range(min(num_landmarks, len(graph))):
+            distances = graph.hop_distances(landmark)
+            self.distances.append(distances)
+            for node, distance in enumerate(distances):
+                if 0 <= distance < closest[node]:
+                    closest[node] = distance
+            landmark = max(range(len(graph)), key=closest.__getitem__)
+            if closest[landmark] == 0:
+                break
+
+    def hop_bound(self, target: int) -> HopBoundFunc:
+        """ Returns the lower bound for the hops to `target` """
+        to_target = [distances[target] for distances in self.distances]
+
+        def bound(node: int) -> Optional[int]:
+            result = 0
+            for distances, target_distance in zip(self.distances, to_target):
+                node_distance = distances[node]
+                if (node_distance == -1) != (target_distance == -1):
+                    # Only one of both is connected to the landmark
+                    return None
+                result = max(result, abs(node_distance - target_distance))
+            return result
+
+        return bound
+
+
+def shortest_path(  # pylint: disable=too-many-arguments, too-many-locals
+    graph: CompactGraph,
+    source: int,
+    target: int,
+    weight: EdgeWeightFunc,
+    enabled_nodes: bytearray,
+    ignore_nodes: Optional[Set[int]] = None,
+    ignore_edges: Optional[Set[int]] = None,
+    deadline: Optional[float] = None,
+) -> Optional[Tuple[float, List[int], List[int]]]:
+    """Dijkstra search from `source` to `target`.
+
+    Returns the total weight and the node and edge indices of the path, or
+    `None` if `target` can't be reached. Ties are broken by insertion order to
+    keep the results deterministic.
+    """
+    offsets, targets = graph.offsets, graph.targets
+    ignore_nodes = ignore_nodes or set()
+    ignore_edges = ignore_edges or set()
+
+    dist: Dict[int, float] = {source: 0.0}
+    pred_edge: Dict[int, int] = {source: -1}
+    done: Set[int] = set()
+    counter = count()
+    heap = [(0.0, next(counter), source)]
+    while heap:
+        length, _, node = heappop(heap)
+        if node in done:
+            continue
+        if node == target:
+            edges: List[int] = []
+            while pred_edge[node] != -1:
+                edges.append(pred_edge[node])
+                node = graph.sources[pred_edge[node]]
+            edges.reverse()
+            nodes = [source] + [targets[edge] for edge in edges]
+            return length, nodes, edges
+        done.add(node)
+        if len(done) % DEADLINE_CHECK_INTERVAL == 0:
+            check_deadline(deadline)
+
+        for edge in range(offsets[node], offsets[node + 1]):
+            neighbour = targets[edge]
+            if (
+                neighbour in done
+                or not enabled_nodes[neighbour]
+                or neighbour in ignore_nodes
+                or edge in ignore_edges
+            ):
+                continue
+            edge_weight = weight(edge)
+            if edge_weight is None:
+                continue
+            new_length = length + edge_weight
+            if neighbour not in dist or new_length < dist[neighbour]:
+                dist[neighbour] = new_length
+                pred_edge[neighbour] = edge
+                heappush(heap, (new_length, next(counter), neighbour))
+
+    return None
+
+
+def hop_limited_shortest_path(  # pylint: disable=too-many-arguments, too-many-locals
+    graph: CompactGraph,
+    source: int,
+    target: int,
+    weight: EdgeWeightFunc,
+    enabled_nodes: bytearray,
+    hop_bound: HopBoundFunc,
+    max_hops: int,
+    ignore_nodes: Optional[Set[int]] = None,
+    ignore_edges: Optional[Set[int]] = None,
+    deadline: Optional[float] = None,
+) -> Optional[Tuple[float, List[int], List[int]]]:
+    """A* search from `source` to `target` for paths with at most `max_hops` edges.
+
+    Same as `shortest_path`, but the search states are pairs of a node and the
+    number of hops needed to reach it, so that a lighter path with more hops
+    can't hide a path within the limit. A state is skipped if its node has
+    already been reached with no more weight and fewer hops.
+
+    `hop_bound` must return a lower bound for the hops to `target`. It directs
+    the search and prunes states which can't reach `target` in time. Edge
+    weights must be at least one for the bound to be consistent.
+    """
+    offsets, targets = graph.offsets, graph.targets
+    ignore_nodes = ignore_nodes or set()
+    ignore_edges = ignore_edges or set()
+
+    bounds: Dict[int, Optional[int]] = {}
+
+    def get_bound(node: int) -> Optional[int]:
+        if node not in bounds:
+            bounds[node] = hop_bound(node)
+        return bounds[node]
+
+    source_bound = get_bound(source)
+    if source_bound is None or source_bound > max_hops:
+        return None
+
+    dist: Dict[Tuple[int, int], float] = {(source, 0): 0.0}
+    pred_edge: Dict[Tuple[int, int], int] = {}
+    # Fewest hops of all expanded states per node
+    min_hops: Dict[int, int] = {}
+    counter = count()
+    expanded = count(1)
+    heap = [(float(source_bound), next(counter), source, 0)]
+    while heap:
+        _, _, node, hops = heappop(heap)
+        if min_hops.get(node, max_hops + 1) <= hops:
+            continue
+        if next(expanded) % DEADLINE_CHECK_INTERVAL == 0:
+            check_deadline(deadline)
+        length = dist[node, hops]
+        if node == target:
+            edges: List[int] = []
+            while hops > 0:
+                edges.append(pred_edge[node, hops])
+                node = graph.sources[edges[-1]]
+                hops -= 1
+            edges.reverse()
+            nodes = [source] + [targets[edge] for edge in edges]
+            return length, nodes, edges
+        min_hops[node] = hops
+
+        for edge in range(offsets[node], offsets[node + 1]):
+            neighbour = targets[edge]
+            if (
+                min_hops.get(neighbour, max_hops + 1) <= hops + 1
+                or not enabled_nodes[neighbour]
+                or neighbour in ignore_nodes
+                or edge in ignore_edges
+            ):
+                continue
+            bound = get_bound(neighbour)
+            if bound is None or hops + 1 + bound > max_hops:
+                continue
+            edge_weight = weight(edge)
+            if edge_weight is None:
+                continue
+            new_length = length + edge_weight
+            state = (neighbour, hops + 1)
+            if state not in dist or new_length < dist[state]:
+                dist[state] = new_length
+                pred_edge[state] = edge
+                heappush(heap, (new_length + bound, next(counter), neighbour, hops + 1))
+
+    return None
+
+
+def shortest_simple_paths(  # pylint: disable=too-many-locals
+    graph: CompactGraph,
+    source: int,
+    target: int,
+    weight: EdgeWeightFunc,
+    enabled_nodes: bytearray,
+    max_hops: Optional[int] = None,
+    hop_bound: Optional[HopBoundFunc] = None,
+    deadline: Optional[float] = None,
+) -> Iterator[List[int]]:
+    """Generates loopless paths from `source` to `target`, shortest first.
+
+    This is Yen's algorithm like in `networkx.shortest_simple_paths`, but the
+    paths consist of node ids of `graph`. Only nodes set in `enabled_nodes`
+    are used. The generator stops when no more paths exist.
+
+    If `max_hops` is given, only paths with at most `max_hops` edges are
+    generated and the searches are guided by `hop_bound`, which defaults to
+    the bound from the landmarks of `graph`.
+
+    Raises `PathSearchBudgetExceeded` if the `deadline` passes while searching.
+    """
+    if not (enabled_nodes[source] and enabled_nodes[target]):
+        return
+    if max_hops is not None and hop_bound is None:
+        hop_bound = graph.landmarks.hop_bound(target)
+
+    def search(
+        start: int, hops_left: Optional[int], ignore_nodes: Set[int], ignore_edges: Set[int]
+    ) -> Optional[Tuple[float, List[int], List[int]]]:
+        if hop_bound is None or hops_left is None:
+            return shortest_path(
+                graph, start, target, weight, enabled_nodes, ignore_nodes, ignore_edges, deadline
+            )
+        return hop_limited_shortest_path(
+            graph,
+            start,
+            target,
+            weight,
+            enabled_nodes,
+            hop_bound,
+            hops_left,
+            ignore_nodes,
+            ignore_edges,
+            deadline,
+        )
+
+    first = search(source, max_hops, set(), set())
+    if first is None:
+        return
+
+    counter = count()
+    candidates = [(first[0], next(counter), first[1], first[2])]
+    known_paths = {tuple(first[1])}
+    found: List[Tuple[List[int], List[int]]] = []
+    while candidates:
+        _, _, nodes, edges = heappop(candidates)
+        yield nodes
+        found.append((nodes, edges))
+
+        # Find the shortest deviations from `nodes` at each spur node
+        ignore_nodes: Set[int] = set()
+        root_length = 0.0
+        for i in range(1, len(nodes)):
+            check_deadline(deadline)
+            root = nodes[:i]
+            ignore_edges = {
+                found_edges[i - 1] for found_nodes, found_edges in found if found_nodes[:i] == root
+            }
+            # The root path already uses `i - 1` hops
+            hops_left = max_hops - (i - 1) if max_hops is not None else None
+            spur = search(root[-1], hops_left, ignore_nodes, ignore_edges)
+            if spur is not None:
+                spur_length, spur_nodes, spur_edges = spur
+                candidate = root[:-1] + spur_nodes
+                if tuple(candidate) not in known_paths:
+                    known_paths.add(tuple(candidate))
+                    heappush(
+                        candidates,
+                        (
+                            root_length + spur_length,
+                            next(counter),
+                            candidate,
+                            edges[: i - 1] + spur_edges,
+                        ),
+                    )
+            ignore_nodes.add(root[-1])
+            root_length += weight(edges[i - 1]) or 0.0
@@ -1,8 +1,24 @@
-from collections import defaultdict
-from copy import copy
-from datetime import datetime, timedelta
-from itertools import islice
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from itertools import count, islice
+from time import monotonic
+from typing import (
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from weakref import WeakSet
 
 import networkx as nx
 import structlog
@@ -11,12 +27,27 @@ from networkx import DiGraph
 from networkx.exception import NetworkXNoPath, NodeNotFound
 
 from pathfinding_service.constants import (
+    DEADLINE_CHECK_INTERVAL,
     DEFAULT_SETTLE_TO_REVEAL_TIMEOUT_RATIO,
     DIVERSITY_PEN_DEFAULT,
+    FEE_ESTIMATE_MIN_SHARE,
     FEE_PEN_DEFAULT,
+    ROUTE_CACHE_SIZE,
 )
-from pathfinding_service.exceptions import InconsistentInternalState, InvalidFeeUpdate
+from pathfinding_service.exceptions import InconsistentInternalState, PathSearchBudgetExceeded
+from pathfinding_service.metrics import PathCandidate, PathRequestMetrics, PathRequestPhase
 from pathfinding_service.model.channel import Channel, ChannelView, FeeSchedule
+from pathfinding_service.model.connectivity import ConnectivityIndex
+from pathfinding_service.model.fee_estimation import FeeEstimate, FeeEstimator, get_capped_fee
+from pathfinding_service.model.graph import CopyOnWriteDiGraph
+from pathfinding_service.model.route_cache import RouteCache, value_bucket
+from pathfinding_service.model.shortest_paths import (
+    CompactGraph,
+    HopBoundFunc,
+    RoutingEngine,
+    check_deadline,
+    shortest_simple_paths,
+)
 from pathfinding_service.typing import AddressReachabilityProtocol
 from raiden.messages.path_finding_service import PFSCapacityUpdate, PFSFeeUpdate
 from raiden.network.transport.matrix import UserPresence
@@ -67,21 +98,58 @@ def prune_graph(graph: DiGraph, reachability_state: AddressReachabilityProtocol)
 
 
 class Path:
+    """A route through `G`.
+
+    Creating a path is cheap, since the path searches create many candidates
+    which are rejected before their validity matters. The validity, fees and
+    Matrix users are calculated together on first access.
+    """
+
     def __init__(
         self,
         G: DiGraph,
         nodes: List[Address],
         value: PaymentAmount,
         reachability_state: AddressReachabilityProtocol,
+        request_metrics: Optional[PathRequestMetrics] = None,
     ):
         self.G = G
         self.nodes = nodes
         self.value = value
         self.reachability_state = reachability_state
-        self.fees = self._check_validity_and_calculate_fees()
-        self.matrix_users = self._get_matrix_users() if self.fees is not None else None
-        self.is_valid = self.fees is not None and self.matrix_users is not None
-        log.debug("Created Path object", nodes=nodes, is_valid=self.is_valid, fees=self.fees)
+        self.request_metrics = request_metrics or PathRequestMetrics()
+        self._is_valid: Optional[bool] = None
+        self._fees: Optional[List[FeeAmount]] = None
+        self._matrix_users: Optional[Dict[str, str]] = None
+
+    def _validate(self) -> None:
+        with self.request_metrics.measure(PathRequestPhase.FEES):
+            self._fees = self._check_validity_and_calculate_fees()
+        if self._fees is not None:
+            with self.request_metrics.measure(PathRequestPhase.MATRIX_USERS):
+                self._matrix_users = self._get_matrix_users()
+        self._is_valid = self._fees is not None and self._matrix_users is not None
+        log.debug(
+            "Validated Path object", nodes=self.nodes, is_valid=self._is_valid, fees=self._fees
+        )
+
+    @property
+    def is_valid(self) -> bool:
+        if self._is_valid is None:
+            self._validate()
+        return bool(self._is_valid)
+
+    @property
+    def fees(self) -> Optional[List[FeeAmount]]:
+        if self._is_valid is None:
+            self._validate()
+        return self._fees
+
+    @property
+    def matrix_users(self) -> Optional[Dict[str, str]]:
+        if self._is_valid is None:
+            self._validate()
+        return self._matrix_users
 
     def _calculate_fees(self) -> Optional[List[FeeAmount]]:
         """Calcluates fees backwards for this path.
@@ -90,7 +158,9 @@ class Path:
         """
         total = PaymentWithFeeAmount(self.value)
         fees: List[FeeAmount] = []
-        for prev_node, mediator, next_node in reversed(list(window(self.nodes, 3))):
+        nodes = self.nodes
+        for index in range(len(nodes) - 2, 0, -1):
+            prev_node, mediator, next_node = nodes[index - 1], nodes[index], nodes[index + 1]
             view_in: ChannelView = self.G[prev_node][mediator]["view"]
             view_out: ChannelView = self.G[mediator][next_node]["view"]
 
@@ -182,8 +252,9 @@ class Path:
         log.debug("Checking path validity", nodes=self.nodes, value=self.value)
 
         required_capacity = self.value
-        edges = reversed(list(self.edge_attrs))
-        for edge in edges:
+        nodes = self.nodes
+        for index in range(len(nodes) - 2, -1, -1):
+            edge = self.G[nodes[index]][nodes[index + 1]]
             # Check basic capacity without fees
             if edge["view"].capacity < required_capacity:
                 log.debug(
@@ -234,15 +305,219 @@ class Path:
             raise InconsistentInternalState()
 
 
+class EdgeWeights:  # pylint: disable=too-few-public-methods
+    """Edge weights for the path searches of a single path request.
+
+    The fee and refund parts of an edge's weight are only calculated when the
+    search uses the edge for the first time and are reused for all further
+    searches of the request. Only the diversity penalty from `visited` changes
+    between these searches, so it is added on each lookup.
+
+    Fees are taken from `fee_estimate` if given. Otherwise, they are calculated
+    from the fee curve of each used edge. Once more than `max_lazy_fees` edges
+    have been weighed, `estimate_fees` is used to get the fees of all remaining
+    edges at once.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        visited: Dict[ChannelID, float],
+        amount: PaymentAmount,
+        fee_penalty: float,
+        fee_estimate: Optional[FeeEstimate] = None,
+        request_metrics: Optional[PathRequestMetrics] = None,
+        estimate_fees: Optional[Callable[[PaymentAmount], FeeEstimate]] = None,
+        max_lazy_fees: int = 0,
+    ) -> None:
+        self.visited = visited
+        self.amount = amount
+        self.fee_penalty = fee_penalty
+        self.fee_estimate = fee_estimate
+        self.request_metrics = request_metrics or PathRequestMetrics()
+        self.estimate_fees = estimate_fees
+        self.max_lazy_fees = max_lazy_fees
+        self._fee_curves = FeeEstimate.from_fee_curves(amount)
+        self._cache: Dict[Hashable, Optional[Tuple[float, int]]] = {}
+
+    def get(self, key: Hashable, view: ChannelView, view_from_partner: ChannelView) -> float:
+        """ Returns the weight of the edge identified by `key` """
+        try:
+            weights = self._cache[key]
+        except KeyError:
+            with self.request_metrics.measure(PathRequestPhase.WEIGHTS):
+                if (
+                    self.fee_estimate is None
+                    and self.estimate_fees is not None
+                    and len(self._cache) >= self.max_lazy_fees
+                ):
+                    self.fee_estimate = self.estimate_fees(self.amount)
+                weights = self._cache[key] = TokenNetwork.fee_and_refund_weights(
+                    view=view,
+                    view_from_partner=view_from_partner,
+                    amount=self.amount,
+                    fee_penalty=self.fee_penalty,
+                    fee_estimate=(
+                        self._fee_curves if self.fee_estimate is None else self.fee_estimate
+                    ),
+                )
+
+        if weights is None:
+            return float("inf")
+        fee_weight, no_refund_weight = weights
+        return 1 + self.visited.get(view.channel_id, 0) + fee_weight + no_refund_weight
+
+
+class RoutingSnapshot:
+    """Reachable part of a token network for the path searches of one or more requests.
+
+    Path requests which are handled together share the pruned graph and the
+    fee estimates for equal values. The snapshot pins the current epoch of the
+    token network, so that updates of the token network are not visible to it,
+    see `TokenNetwork.pin_epoch`.
+
+    If `nodes` is given, the snapshot can be restricted to the channels between
+    these nodes. This is used to confine single requests to the connected
+    component of their source.
+
+    The fees of all channel views are only estimated at once for snapshots of
+    a `batch` of requests and for searches which weigh many edges, see
+    `EdgeWeights`. Otherwise, the fees are calculated for each used edge.
+    """
+
+    def __init__(
+        self,
+        token_network: "TokenNetwork",
+        reachability_state: AddressReachabilityProtocol,
+        nodes: Optional[AbstractSet[Address]] = None,
+        batch: bool = False,
+    ) -> None:
+        self.reachability_state = reachability_state
+        self.batch = batch
+        self.graph = token_network.G
+        self.num_views = 2 * len(token_network.channel_id_to_addresses)
+        self._token_network = token_network
+        self._topology_version = token_network.topology_version
+        self._fee_estimator: Optional[FeeEstimator] = None
+        self._fee_estimates: Dict[PaymentAmount, FeeEstimate] = {}
+
+        # The live view of reachable nodes can only be used for the tracked
+        # reachability state, all others require a snapshot of reachable nodes.
+        is_tracked = reachability_state is token_network.tracked_reachability_state
+        self.compact_graph: Optional[CompactGraph] = None
+        self.enabled_nodes = bytearray()
+        self.pruned_graph: Optional[DiGraph] = None
+        if token_network.routing_engine == RoutingEngine.NATIVE:
+            # Unreachable nodes are masked out instead of building a pruned copy of the graph
+            self.compact_graph = token_network.compact_graph
+            self.enabled_nodes = (
+                token_network.online_mask
+                if is_tracked
+                else self.compact_graph.reachable_nodes(reachability_state, nodes)
+            )
+        else:
+            self.pruned_graph = (
+                token_network.online_graph
+                if is_tracked
+                else prune_graph(
+                    graph=token_network.G if nodes is None else token_network.G.subgraph(nodes),
+                    reachability_state=reachability_state,
+                )
+            )
+        self.epoch = token_network.pin_epoch(self)
+
+    @property
+    def fee_estimator(self) -> FeeEstimator:
+        """ The token network's estimator if its channels are still the same, built on demand """
+        if self._fee_estimator is None:
+            self._fee_estimator = (
+                self._token_network.fee_estimator
+                if self._token_network.topology_version == self._topology_version
+                else FeeEstimator(view for _, _, view in self.graph.edges(data="view"))
+            )
+        return self._fee_estimator
+
+    def fee_estimate(self, value: PaymentAmount) -> FeeEstimate:
+        if value not in self._fee_estimates:
+            self._fee_estimates[value] = self.fee_estimator.estimate(value)
+        return self._fee_estimates[value]
+
+    def edge_weights(
+        self,
+        visited: Dict[ChannelID, float],
+        amount: PaymentAmount,
+        fee_penalty: float,
+        request_metrics: PathRequestMetrics,
+    ) -> EdgeWeights:
+        """ Returns the edge weights for searching paths for `amount` in this snapshot """
+        return EdgeWeights(
+            visited=visited,
+            amount=amount,
+            fee_penalty=fee_penalty,
+            fee_estimate=self.fee_estimate(amount) if self.batch else None,
+            request_metrics=request_metrics,
+            estimate_fees=self.fee_estimate,
+            max_lazy_fees=int(self.num_views * FEE_ESTIMATE_MIN_SHARE),
+        )
+
+
+@dataclass
+class NetworkChanges:
+    """ Channels and nodes of a token network changed since the last `TokenNetwork.pop_changes` """
+
+    channels: Set[ChannelID] = field(default_factory=set)
+    nodes: Set[Address] = field(default_factory=set)
+
+    def __len__(self) -> int:
+        return len(self.channels) + len(self.nodes)
+
+    def update(self, other: "NetworkChanges") -> None:
+        self.channels |= other.channels
+        self.nodes |= other.nodes
+
+
 class TokenNetwork:
     """ Manages a token network for pathfinding. """
 
-    def __init__(self, token_network_address: TokenNetworkAddress):
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        token_network_address: TokenNetworkAddress,
+        routing_engine: RoutingEngine = RoutingEngine.NETWORKX,
+    ):
         """ Initializes a new TokenNetwork. """
 
         self.address = token_network_address
+        self.routing_engine = routing_engine
         self.channel_id_to_addresses: Dict[ChannelID, Tuple[Address, Address]] = dict()
-        self.G = DiGraph()
+        # One shared object per address for the participants of all channels
+        self._addresses: Dict[Address, Address] = dict()
+        self.G = CopyOnWriteDiGraph()
+        self.topology_version = 0  # incremented when channels are opened or closed
+        self.connectivity = ConnectivityIndex()
+        self._compact_graph: Optional[CompactGraph] = None
+        self._fee_estimator: Optional[FeeEstimator] = None
+        self.route_cache = RouteCache(maxsize=ROUTE_CACHE_SIZE)
+        # Number of path requests per value bucket, see `iter_route_cache_warmup`
+        self.requested_values: "Counter[int]" = Counter()
+
+        # Reachable nodes of the tracked reachability state, see `track_reachability`
+        self.tracked_reachability_state: Optional[AddressReachabilityProtocol] = None
+        self.online_nodes: Set[Address] = set()
+        self._online_mask: Optional[bytearray] = None
+
+        # Closeness centrality of the nodes in `G`, see `iter_centrality_update`
+        self.centrality: Dict[Address, float] = {}
+        self.centrality_version: Optional[int] = None
+
+        # State pinned by routing snapshots, see `pin_epoch`
+        self.epoch = 0
+        self._readers: "WeakSet[object]" = WeakSet()
+        # Channels which aren't shared with pinned epochs, all if `None`
+        self._owned_channels: Optional[Set[ChannelID]] = None
+
+        # Recorded for the routing pool once enabled by `record_changes`
+        self._changes: Optional[NetworkChanges] = None
 
     def __repr__(self) -> str:
         return (
@@ -280,6 +555,15 @@ class TokenNetwork:
         return channel
 
     def add_channel_view(self, channel_view: ChannelView) -> None:
+        self._prepare_write()
+        channel = channel_view.channel
+        channel.participant1 = self._addresses.setdefault(
+            channel.participant1, channel.participant1
+        )
+        channel.participant2 = self._addresses.setdefault(
+            channel.participant2, channel.participant2
+        )
+
         # Only add it once per channel, not once per ChannelView
         if channel_view.participant1 < channel_view.participant2:
             self.channel_id_to_addresses[channel_view.channel_id] = (
@@ -287,6 +571,78 @@ class TokenNetwork:
                 channel_view.participant2,
             )
         self.G.add_edge(channel_view.participant1, channel_view.participant2, view=channel_view)
+        self.connectivity.add_channel(channel_view.participant1, channel_view.participant2)
+        self.topology_version += 1
+        self._compact_graph = None
+        self._fee_estimator = None
+        # Paths over the participants may be better than the cached ones
+        self.route_cache.bump_node(channel_view.participant1)
+        self._own_channel(channel_view.channel_id)
+        self._record_channel_change(channel_view.channel_id)
+        self._add_online_view(channel_view)
+
+    def _add_online_view(self, channel_view: ChannelView) -> None:
+        """ Adds the participants of the view to `online_nodes` if they are reachable """
+        if self.tracked_reachability_state is None:
+            return
+
+        get_reachability = self.tracked_reachability_state.get_address_reachability
+        self.online_nodes.update(
+            node
+            for node in (channel_view.participant1, channel_view.participant2)
+            if get_reachability(node) == AddressReachability.REACHABLE
+        )
+
+    def add_channels(self, channels: Iterable[Channel]) -> None:
+        """Adds both views of all `channels`, like `add_channel_view` but in bulk.
+
+        Used when loading the channels on startup. The graph edges are inserted
+        at once and the caches are invalidated only once for all channels.
+        """
+        self._prepare_write()
+        edges = []
+        views = []
+        for channel in channels:
+            channel.participant1 = self._addresses.setdefault(
+                channel.participant1, channel.participant1
+            )
+            channel.participant2 = self._addresses.setdefault(
+                channel.participant2, channel.participant2
+            )
+            self.channel_id_to_addresses[channel.channel_id] = (
+                channel.participant1,
+                channel.participant2,
+            )
+            self.connectivity.add_channel(channel.participant1, channel.participant2)
+            self._own_channel(channel.channel_id)
+            self._record_channel_change(channel.channel_id)
+            for view in channel.views:
+                edges.append((view.participant1, view.participant2, {"view": view}))
+                views.append(view)
+
+        if not edges:
+            return
+        self.G.add_edges_from(edges)
+        self.topology_version += 1
+        self._compact_graph = None
+        self._fee_estimator = None
+        for view in views:
+            self.route_cache.bump_node(view.participant1)
+            self._add_online_view(view)
+
+    def replace_channel(self, channel: Channel) -> None:
+        """Replaces the state of an open channel by `channel`.
+
+        Used to apply the channel states published by another process, see
+        `RoutingPool.publish`.
+        """
+        self._prepare_write()
+        channel.participant1 = self._addresses[channel.participant1]
+        channel.participant2 = self._addresses[channel.participant2]
+        self._own_channel(channel.channel_id)
+        self._replace_views(channel)
+        self.route_cache.bump_channel(channel.channel_id)
+        self._record_channel_change(channel.channel_id)
 
     def handle_channel_closed_event(self, channel_identifier: ChannelID) -> None:
         """Close a channel. This doesn't mean that the channel is settled yet, but it cannot
@@ -294,11 +650,175 @@ class TokenNetwork:
 
         Corresponds to the ChannelClosed event."""
 
+        self._prepare_write()
         # we need to unregister the channel_id here
         participant1, participant2 = self.channel_id_to_addresses.pop(channel_identifier)
+        if self._owned_channels is not None:
+            self._owned_channels.discard(channel_identifier)
 
         self.G.remove_edge(participant1, participant2)
         self.G.remove_edge(participant2, participant1)
+        self.connectivity.remove_channel(self.G, participant1, participant2)
+        self.topology_version += 1
+        self._compact_graph = None
+        self._fee_estimator = None
+        # Also drops the version of the closed channel
+        self.route_cache.bump_topology()
+        self._record_channel_change(channel_identifier)
+
+    @property
+    def fee_estimator(self) -> FeeEstimator:
+        """ Fee parameters of all channel views for batched fee estimates, built on demand """
+        if self._fee_estimator is None:
+            self._fee_estimator = FeeEstimator(view for _, _, view in self.G.edges(data="view"))
+        return self._fee_estimator
+
+    def estimate_fees(self, amount: PaymentAmount) -> FeeEstimate:
+        """ Estimates the fees for `amount` for all channel views at once """
+        return self.fee_estimator.estimate(amount)
+
+    @property
+    def online_graph(self) -> DiGraph:
+        """Live view of the channels between reachable nodes, see `track_reachability`
+
+        The view filters the nodes of `G` by `online_nodes` instead of holding
+        the edges a second time.
+        """
+        return nx.subgraph_view(self.G, filter_node=self.online_nodes.__contains__)
+
+    @property
+    def compact_graph(self) -> CompactGraph:
+        """ Array based copy of `G` for the native routing engine, rebuilt on demand """
+        if self._compact_graph is None:
+            self._compact_graph = CompactGraph(self.G)
+            self._online_mask = None
+        return self._compact_graph
+
+    @property
+    def online_mask(self) -> bytearray:
+        """ Marks the nodes of `compact_graph` which are in `online_nodes` """
+        compact_graph = self.compact_graph
+        if self._online_mask is None:
+            self._online_mask = bytearray(
+                address in self.online_nodes for address in compact_graph.addresses
+            )
+        return self._online_mask
+
+    def track_reachability(self, reachability_state: AddressReachabilityProtocol) -> None:
+        """Keep `online_graph` up to date with the reachabilities of `reachability_state`.
+
+        After the initial snapshot taken here, all reachability changes must be
+        passed to `handle_address_reachability_change`. Path requests for the
+        tracked `reachability_state` don't need to prune the graph anymore.
+        """
+        self.tracked_reachability_state = reachability_state
+        self.online_nodes = {
+            node
+            for node in self.G.nodes
+            if reachability_state.get_address_reachability(node) == AddressReachability.REACHABLE
+        }
+        self._online_mask = None
+        self.route_cache.bump_topology()
+
+    def handle_address_reachability_change(
+        self, address: Address, reachability: AddressReachability
+    ) -> None:
+        """ Add or remove `address` to/from `online_nodes`, which `online_graph` is filtered by """
+        if self.tracked_reachability_state is None or address not in self.G:
+            return
+
+        is_online = reachability == AddressReachability.REACHABLE
+        if is_online == (address in self.online_nodes):
+            return
+
+        self._prepare_write()
+        if is_online:
+            self.online_nodes.add(address)
+        else:
+            self.online_nodes.remove(address)
+        self.route_cache.bump_node(address)
+        if is_online:
+            # Paths over the partners of the node may be better than the cached ones
+            for partner in self.G.successors(address):
+                if partner in self.online_nodes:
+                    self.route_cache.bump_node(partner)
+        if self._changes is not None:
+            self._changes.nodes.add(address)
+
+        if self._online_mask is not None and self._compact_graph is not None:
+            self._online_mask[self._compact_graph.node_ids[address]] = is_online
+
+    def record_changes(self) -> None:
+        """ Starts recording the changed channels and nodes, see `pop_changes` """
+        self._changes = NetworkChanges()
+
+    def pop_changes(self) -> NetworkChanges:
+        """ Returns the changes since the last call or since `record_changes` """
+        changes = self._changes or NetworkChanges()
+        if self._changes is not None:
+            self._changes = NetworkChanges()
+        return changes
+
+    def _record_channel_change(self, channel_id: ChannelID) -> None:
+        if self._changes is not None:
+            self._changes.channels.add(channel_id)
+
+    def pin_epoch(self, reader: object) -> int:
+        """Keeps the current state unmodified for as long as `reader` exists.
+
+        Readers are e.g. `RoutingSnapshot`s or the routing pool's snapshots.
+
+        Returns the number of the pinned epoch. The next modification of the
+        token network starts a new epoch instead of changing the pinned state,
+        see `_prepare_write`.
+        """
+        self._readers.add(reader)
+        return self.epoch
+
+    def _prepare_write(self) -> None:
+        """Starts a new epoch if the current one is pinned, must precede all modifications.
+
+        The graph of the new epoch shares the adjacency of all nodes with the
+        pinned epochs, see `CopyOnWriteDiGraph`. The channels are shared as
+        well and only copied before they are modified, see `_get_writable_views`.
+        The `CompactGraph` is never modified and the `FeeEstimator` only uses
+        the estimated fees of views which are unchanged, so both are shared.
+        Only the online nodes and their mask are copied.
+        """
+        if not self._readers:
+            return
+
+        self.epoch += 1
+        self._readers = WeakSet()
+        self._owned_channels = set()
+        self.G = self.G.copy_on_write()
+        self.online_nodes = set(self.online_nodes)
+        if self._online_mask is not None:
+            self._online_mask = bytearray(self._online_mask)
+
+    def _own_channel(self, channel_id: ChannelID) -> None:
+        """ Marks the channel as not shared with pinned epochs """
+        if self._owned_channels is not None:
+            self._owned_channels.add(channel_id)
+
+    def _get_writable_views(
+        self, updating_participant: Address, other_participant: Address
+    ) -> Tuple[ChannelView, ChannelView]:
+        """ Like `get_channel_views_for_partner`, but copies channels shared with pinned epochs """
+        self._prepare_write()
+        channel = self.G[updating_participant][other_participant]["view"].channel
+        if self._owned_channels is not None and channel.channel_id not in self._owned_channels:
+            self._own_channel(channel.channel_id)
+            self._replace_views(channel.copy())
+
+        return self.get_channel_views_for_partner(updating_participant, other_participant)
+
+    def _replace_views(self, channel: Channel) -> None:
+        """ Uses the views of `channel` instead of the ones of the channel with the same id """
+        for view in channel.views:
+            self.G.add_edge(view.participant1, view.participant2, view=view)
+            if self._fee_estimator is not None:
+                self._fee_estimator.replace_view(view)
 
     def get_channel_views_for_partner(
         self, updating_participant: Address, other_participant: Address
@@ -316,7 +836,7 @@ class TokenNetwork:
         other_capacity_partner: TokenAmount,
     ) -> Channel:
         """ Sends Capacity Update to PFS including the reveal timeout """
-        (channel_view_to_partner, channel_view_from_partner) = self.get_channel_views_for_partner(
+        (channel_view_to_partner, channel_view_from_partner) = self._get_writable_views(
             updating_participant=message.updating_participant,
             other_participant=message.other_participant,
         )
@@ -329,6 +849,11 @@ class TokenNetwork:
             nonce=message.other_nonce,
             capacity=min(message.other_capacity, updating_capacity_partner),
         )
+        if self._fee_estimator is not None:
+            self._fee_estimator.update_view(channel_view_to_partner)
+            self._fee_estimator.update_view(channel_view_from_partner)
+        self.route_cache.bump_channel(channel_view_to_partner.channel_id)
+        self._record_channel_change(channel_view_to_partner.channel_id)
         log.debug(
             "Setting capacity",
             updating_participant=message.updating_capacity,
@@ -340,19 +865,21 @@ class TokenNetwork:
         return channel_view_to_partner.channel
 
     def handle_channel_fee_update(self, message: PFSFeeUpdate) -> Channel:
-        if message.timestamp > datetime.utcnow() + timedelta(hours=1):
-            # We don't really care about the time, but if we accept a time far
-            # in the future, the client will have problems sending fee updates
-            # with increasing time after fixing his clock.
-            raise InvalidFeeUpdate("Timestamp is in the future")
         channel_id = message.canonical_identifier.channel_identifier
         participants = self.channel_id_to_addresses[channel_id]
         other_participant = (set(participants) - {message.updating_participant}).pop()
-        (channel_view_to_partner, channel_view_from_partner) = self.get_channel_views_for_partner(
+        (channel_view_to_partner, channel_view_from_partner) = self._get_writable_views(
             updating_participant=message.updating_participant, other_participant=other_participant
         )
         fee_schedule = FeeSchedule.from_raiden(message.fee_schedule, timestamp=message.timestamp)
         channel_view_to_partner.set_fee_schedule(fee_schedule)
+        # The schedule is used as sender schedule of one view and as receiver
+        # schedule of the other one.
+        if self._fee_estimator is not None:
+            self._fee_estimator.update_view(channel_view_to_partner)
+            self._fee_estimator.update_view(channel_view_from_partner)
+        self.route_cache.bump_channel(channel_id)
+        self._record_channel_change(channel_id)
         return channel_view_from_partner.channel
 
     @staticmethod
@@ -364,82 +891,189 @@ class TokenNetwork:
         fee_penalty: float,
     ) -> float:
         diversity_weight = visited.get(view.channel_id, 0)
+        weights = TokenNetwork.fee_and_refund_weights(
+            view=view, view_from_partner=view_from_partner, amount=amount, fee_penalty=fee_penalty
+        )
+        if weights is None:
+            return float("inf")
+
+        fee_weight, no_refund_weight = weights
+        return 1 + diversity_weight + fee_weight + no_refund_weight
+
+    @staticmethod
+    def fee_and_refund_weights(
+        view: ChannelView,
+        view_from_partner: ChannelView,
+        amount: PaymentAmount,
+        fee_penalty: float,
+        fee_estimate: Optional[FeeEstimate] = None,
+    ) -> Optional[Tuple[float, int]]:
+        """Returns the parts of the edge weight which don't depend on previous paths.
+
+        The fee is taken from `fee_estimate` if given, which must be for `amount`.
+        Returns `None` if no fees can be calculated for this edge.
+        """
         # Fees for initiator and target are included here. This promotes routes
         # that are nice to the initiator's and target's capacities, but it's
         # inconsistent with the estimated total fee.
+        fee = get_capped_fee(view, amount) if fee_estimate is None else fee_estimate[view]
+        if fee is None:
+            return None
 
-        # Enable fee apping for both fee schedules
-        schedule_in = copy(view.fee_schedule_receiver)
-        schedule_in.cap_fees = True
-        schedule_out = copy(view.fee_schedule_sender)
-        schedule_out.cap_fees = True
-
-        amount_with_fees = get_amount_with_fees(
-            amount_without_fees=PaymentWithFeeAmount(amount),
-            balance_in=Balance(view.capacity),
-            balance_out=Balance(view.capacity),
-            schedule_in=schedule_in,
-            schedule_out=schedule_out,
-            receivable_amount=view.capacity,
-        )
-
-        if amount_with_fees is None:
-            return float("inf")
-
-        fee = FeeAmount(amount_with_fees - amount)
         fee_weight = fee / 1e18 * fee_penalty
 
         no_refund_weight = 0
         if view_from_partner.capacity < int(float(amount) * 1.1):
             no_refund_weight = 1
-        return 1 + diversity_weight + fee_weight + no_refund_weight
+        return fee_weight, no_refund_weight
 
-    def _get_single_path(  # pylint: disable=too-many-arguments, too-many-locals
+    def _get_single_path(  # pylint: disable=too-many-arguments
         self,
         graph: DiGraph,
+        channel_graph: DiGraph,
         source: Address,
         target: Address,
         value: PaymentAmount,
         reachability_state: AddressReachabilityProtocol,
-        visited: Dict[ChannelID, float],
+        edge_weights: EdgeWeights,
         disallowed_paths: List[List[Address]],
-        fee_penalty: float,
+        request_metrics: PathRequestMetrics,
+        deadline: Optional[float] = None,
     ) -> Optional[Path]:
-        # update edge weights
-        for node1, node2 in graph.edges():
-            edge = graph[node1][node2]
-            backwards_edge = graph[node2][node1]
-            edge["weight"] = self.edge_weight(
-                visited=visited,
-                view=edge["view"],
-                view_from_partner=backwards_edge["view"],
-                amount=value,
-                fee_penalty=fee_penalty,
+        """Returns the shortest valid path which isn't in `disallowed_paths`
+
+        Raises `PathSearchBudgetExceeded` if the `deadline` passes.
+        """
+        weight_lookups = count(1)
+
+        def weight(node1: Address, node2: Address, edge: dict) -> float:
+            # The only hook into the searches of networkx
+            if next(weight_lookups) % DEADLINE_CHECK_INTERVAL == 0:
+                check_deadline(deadline)
+            # `graph` may not contain the opposite edge, see `get_paths`
+            return edge_weights.get(
+                (node1, node2), edge["view"], channel_graph[node2][node1]["view"]
             )
 
-        # find next path
-        all_paths: Iterable[List[Address]] = nx.shortest_simple_paths(
-            G=graph, source=source, target=target, weight="weight"
-        )
-        try:
-            # skip duplicates and invalid paths
-            path = next(
-                p
-                for p in (Path(self.G, nodes, value, reachability_state) for nodes in all_paths)
-                if p.is_valid and p.nodes not in disallowed_paths
+        # find next path, skip duplicates and invalid paths
+        for nodes in nx.shortest_simple_paths(
+            G=graph, source=source, target=target, weight=weight
+        ):
+            path = self._check_candidate(
+                channel_graph,
+                nodes,
+                value,
+                reachability_state,
+                disallowed_paths,
+                request_metrics,
+                deadline,
             )
-            return path
-        except StopIteration:
+            if path is not None:
+                return path
+        return None
+
+    def _get_single_path_native(  # pylint: disable=too-many-arguments, too-many-locals
+        self,
+        graph: CompactGraph,
+        enabled_nodes: bytearray,
+        channel_graph: DiGraph,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        reachability_state: AddressReachabilityProtocol,
+        edge_weights: EdgeWeights,
+        disallowed_paths: List[List[Address]],
+        request_metrics: PathRequestMetrics,
+        max_hops: Optional[int] = None,
+        hop_bound: Optional[HopBoundFunc] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[Path]:
+        """Same as `_get_single_path`, but uses the native k-shortest-paths engine
+
+        Paths have at most `max_hops` channels if it is given, see
+        `shortest_simple_paths` for `hop_bound`.
+        """
+        source_id = graph.node_ids.get(source)
+        target_id = graph.node_ids.get(target)
+        if source_id is None or target_id is None:
             return None
 
+        addresses, sources, targets = graph.addresses, graph.sources, graph.targets
+        adjacency = channel_graph.adj
+
+        def weight(edge: int) -> Optional[float]:
+            node1, node2 = addresses[sources[edge]], addresses[targets[edge]]
+            view = adjacency[node1][node2]["view"]
+            # Skip channels which can't carry the payment, see `get_paths`
+            if view.capacity < value:
+                return None
+            return edge_weights.get(edge, view, adjacency[node2][node1]["view"])
+
+        # find next path, skip duplicates and invalid paths
+        for node_ids in shortest_simple_paths(
+            graph=graph,
+            source=source_id,
+            target=target_id,
+            weight=weight,
+            enabled_nodes=enabled_nodes,
+            max_hops=max_hops,
+            hop_bound=hop_bound,
+            deadline=deadline,
+        ):
+            nodes = [graph.addresses[node_id] for node_id in node_ids]
+            path = self._check_candidate(
+                channel_graph,
+                nodes,
+                value,
+                reachability_state,
+                disallowed_paths,
+                request_metrics,
+                deadline,
+            )
+            if path is not None:
+                return path
+        return None
+
+    @staticmethod
+    def _check_candidate(  # pylint: disable=too-many-arguments
+        channel_graph: DiGraph,
+        nodes: List[Address],
+        value: PaymentAmount,
+        reachability_state: AddressReachabilityProtocol,
+        disallowed_paths: List[List[Address]],
+        request_metrics: PathRequestMetrics,
+        deadline: Optional[float],
+    ) -> Optional[Path]:
+        """Returns the path for `nodes`, unless it is a duplicate or invalid
+
+        Raises `PathSearchBudgetExceeded` if the `deadline` has passed.
+        """
+        if deadline is not None and monotonic() > deadline:
+            raise PathSearchBudgetExceeded()
+        if nodes in disallowed_paths:
+            request_metrics.add_candidate(PathCandidate.DUPLICATE)
+            return None
+        path = Path(channel_graph, nodes, value, reachability_state, request_metrics)
+        if not path.is_valid:
+            request_metrics.add_candidate(PathCandidate.INVALID)
+            return None
+        request_metrics.add_candidate(PathCandidate.VALID)
+        return path
+
     def check_path_request_errors(
         self,
         source: Address,
         target: Address,
         value: PaymentAmount,
         reachability_state: AddressReachabilityProtocol,
+        split: bool = False,
     ) -> Optional[str]:
-        """ Checks for basic problems with the path requests. Returns error message or `None` """
+        """Checks for basic problems with the path requests. Returns error message or `None`
+
+        With `split`, the value may be spread over all channels of source and
+        target, see `get_payment_split`.
+        """
+        available = sum if split else max
 
         if reachability_state.get_address_reachability(source) != AddressReachability.REACHABLE:
             return "Source not online"
@@ -453,7 +1087,7 @@ class TokenNetwork:
             return "No channel to target"
 
         source_capacities = [view.capacity for _, _, view in self.G.out_edges(source, data="view")]
-        if max(source_capacities) < value:
+        if available(source_capacities) < value:
             debug_capacities = [
                 (to_checksum_address(a), to_checksum_address(b), view.capacity)
                 for a, b, view in self.G.out_edges(source, data="view")
@@ -466,20 +1100,18 @@ class TokenNetwork:
             )
             return message
         target_capacities = [view.capacity for _, _, view in self.G.in_edges(target, data="view")]
-        if max(target_capacities) < value:
+        if available(target_capacities) < value:
             return "Target does not have a channel with sufficient capacity (%s < %s)" % (
                 target_capacities,
                 value,
             )
 
-        try:
-            next(nx.shortest_simple_paths(G=self.G, source=source, target=target))
-        except NetworkXNoPath:
+        if not self.connectivity.is_connected(source, target):
             return "No route from source to target"
 
         return None
 
-    def get_paths(  # pylint: disable=too-many-arguments, too-many-locals
+    def get_paths(  # pylint: disable=too-many-arguments
         self,
         source: Address,
         target: Address,
@@ -488,16 +1120,23 @@ class TokenNetwork:
         reachability_state: AddressReachabilityProtocol,
         diversity_penalty: float = DIVERSITY_PEN_DEFAULT,
         fee_penalty: float = FEE_PEN_DEFAULT,
+        snapshot: Optional[RoutingSnapshot] = None,
+        max_hops: Optional[int] = None,
+        time_budget: Optional[float] = None,
     ) -> List[Path]:
         """Find best routes according to given preferences
 
         value: Amount of transferred tokens. Used for capacity checks
         diversity_penalty: One previously used channel is as bad as X more hops
         fee_penalty: One RDN in fees is as bad as X more hops
+        snapshot: Routing snapshot for `reachability_state` shared with other requests
+        max_hops: Maximum number of channels per path, no limit if `None`
+        time_budget: Seconds after which the search stops and returns the paths
+            found so far, no limit if `None`. Raises `PathSearchBudgetExceeded`
+            if no path has been found by then.
         """
-        visited: Dict[ChannelID, float] = defaultdict(lambda: 0)
-        paths: List[Path] = []
-
+        deadline = monotonic() + time_budget if time_budget is not None else None
+        assert snapshot is None or snapshot.reachability_state is reachability_state
         log.debug(
             "Finding paths for payment",
             source=source,
@@ -506,25 +1145,167 @@ class TokenNetwork:
             max_paths=max_paths,
             diversity_penalty=diversity_penalty,
             fee_penalty=fee_penalty,
+            max_hops=max_hops,
         )
 
-        # TODO: improve the pruning
-        # Currently we make a snapshot of the currently reachable nodes, so the searched graph
-        # becomes smaller
-        pruned_graph = prune_graph(graph=self.G, reachability_state=reachability_state)
+        if not self.connectivity.is_connected(source, target):
+            log.debug("Source and target are not connected", source=source, target=target)
+            return []
+
+        # Presence changes are only tracked for the tracked reachability state,
+        # so the route cache can't be used with other ones.
+        is_tracked = reachability_state is self.tracked_reachability_state
+        request_metrics = PathRequestMetrics()
+        cache_key = RouteCache.make_key(
+            source=source,
+            target=target,
+            value=value,
+            max_paths=max_paths,
+            diversity_penalty=diversity_penalty,
+            fee_penalty=fee_penalty,
+            max_hops=max_hops,
+        )
+        with request_metrics.measure(PathRequestPhase.SEARCH):
+            paths = (
+                self._get_cached_paths(cache_key, value, reachability_state, request_metrics)
+                if is_tracked
+                else None
+            )
+        if paths is None:
+            if snapshot is None:
+                with request_metrics.measure(PathRequestPhase.PRUNING):
+                    snapshot = RoutingSnapshot(
+                        self, reachability_state, nodes=self.connectivity.component(source)
+                    )
+            paths = self._find_paths(
+                source=source,
+                target=target,
+                value=value,
+                max_paths=max_paths,
+                diversity_penalty=diversity_penalty,
+                fee_penalty=fee_penalty,
+                snapshot=snapshot,
+                request_metrics=request_metrics,
+                max_hops=max_hops,
+                deadline=deadline,
+            )
+            # Truncated results must not be returned for later requests
+            if is_tracked and paths and not request_metrics.truncated:
+                self.route_cache.put(
+                    cache_key,
+                    [
+                        (path.nodes, [edge["view"].channel_id for edge in path.edge_attrs])
+                        for path in paths
+                    ],
+                )
+        request_metrics.observe()
+        if request_metrics.truncated and not paths:
+            raise PathSearchBudgetExceeded()
+
+        log.info(
+            "Returning paths for payment",
+            source=source,
+            target=target,
+            value=value,
+            max_paths=max_paths,
+            diversity_penalty=diversity_penalty,
+            fee_penalty=fee_penalty,
+            paths=paths,
+        )
+        return paths
+
+    def _get_cached_paths(
+        self,
+        cache_key: Hashable,
+        value: PaymentAmount,
+        reachability_state: AddressReachabilityProtocol,
+        request_metrics: PathRequestMetrics,
+    ) -> Optional[List[Path]]:
+        """Returns the paths from the route cache, if they are still valid for `value`
+
+        The cached paths were found for a value of the same bucket, so fees and
+        capacities have to be checked again.
+        """
+        cached_paths = self.route_cache.get(cache_key)
+        if cached_paths is None:
+            return None
+
+        paths = [
+            Path(self.G, nodes, value, reachability_state, request_metrics)
+            for nodes in cached_paths
+        ]
+        if not all(path.is_valid for path in paths):
+            return None
+
+        log.debug("Using cached paths for payment", value=value, paths=paths)
+        return paths
+
+    def _find_paths(  # pylint: disable=too-many-arguments, too-many-locals
+        self,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_paths: int,
+        diversity_penalty: float,
+        fee_penalty: float,
+        snapshot: RoutingSnapshot,
+        request_metrics: PathRequestMetrics,
+        max_hops: Optional[int] = None,
+        deadline: Optional[float] = None,
+    ) -> List[Path]:
+        """ Searches the paths for `get_paths` until `max_paths` are found or `deadline` passes """
+        reachability_state = snapshot.reachability_state
+        visited: Dict[ChannelID, float] = defaultdict(lambda: 0)
+        with request_metrics.measure(PathRequestPhase.WEIGHTS):
+            edge_weights = snapshot.edge_weights(visited, value, fee_penalty, request_metrics)
+        paths: List[Path] = []
+
+        find_path: Callable[..., Optional[Path]]
+        if snapshot.compact_graph is not None:
+            find_path = partial(
+                self._get_single_path_native,
+                graph=snapshot.compact_graph,
+                enabled_nodes=snapshot.enabled_nodes,
+                channel_graph=snapshot.graph,
+                max_hops=max_hops,
+            )
+        elif max_hops is not None:
+            assert snapshot.pruned_graph is not None
+            find_path = partial(
+                self._get_single_path_native,
+                channel_graph=snapshot.graph,
+                max_hops=max_hops,
+                **self._hop_limited_search_graph(
+                    snapshot.pruned_graph, source, target, value, max_hops
+                ),
+            )
+        else:
+            assert snapshot.pruned_graph is not None
+            pruned_graph: DiGraph = snapshot.pruned_graph
+            # Channels which can't carry `value` are hidden, so that the search
+            # doesn't generate paths which fail the capacity check in `Path`.
+            search_graph = nx.subgraph_view(
+                pruned_graph,
+                filter_edge=lambda node1, node2: (
+                    pruned_graph[node1][node2]["view"].capacity >= value
+                ),
+            )
+            find_path = partial(
+                self._get_single_path, graph=search_graph, channel_graph=snapshot.graph
+            )
+        find_path = partial(find_path, request_metrics=request_metrics, deadline=deadline)
 
         while len(paths) < max_paths:
             try:
-                path = self._get_single_path(
-                    graph=pruned_graph,
-                    source=source,
-                    target=target,
-                    value=value,
-                    reachability_state=reachability_state,
-                    visited=visited,
-                    disallowed_paths=[p.nodes for p in paths],
-                    fee_penalty=fee_penalty,
-                )
+                with request_metrics.measure(PathRequestPhase.SEARCH):
+                    path = find_path(
+                        source=source,
+                        target=target,
+                        value=value,
+                        reachability_state=reachability_state,
+                        edge_weights=edge_weights,
+                        disallowed_paths=[p.nodes for p in paths],
+                    )
             except (NetworkXNoPath, NodeNotFound):
                 log.info(
                     "Found no path for payment in pruned graph",
@@ -537,6 +1318,17 @@ class TokenNetwork:
                     reachabilities=reachability_state,
                 )
                 return []
+            except PathSearchBudgetExceeded:
+                log.warning(
+                    "Path search ran out of time",
+                    source=source,
+                    target=target,
+                    value=value,
+                    max_paths=max_paths,
+                    found_paths=len(paths),
+                )
+                request_metrics.truncated = True
+                break
 
             if path is None:
                 break
@@ -547,25 +1339,298 @@ class TokenNetwork:
                 channel_id = edge["view"].channel_id
                 visited[channel_id] += diversity_penalty
 
-        log.info(
-            "Returning paths for payment",
-            source=source,
-            target=target,
-            value=value,
-            max_paths=max_paths,
-            diversity_penalty=diversity_penalty,
-            fee_penalty=fee_penalty,
-            paths=paths,
-        )
         return paths
 
+    @staticmethod
+    def _hop_limited_search_graph(
+        pruned_graph: DiGraph,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_hops: int,
+    ) -> Dict[str, Any]:
+        """Prepares a hop limited search of the networkx engine.
+
+        `nx.shortest_simple_paths` has no hop limit, and filtering its results
+        can enumerate a huge number of longer paths. Instead, the nodes on a
+        path with at most `max_hops` channels that can carry `value` are copied
+        into a `CompactGraph`, which is searched with the hop limited search of
+        the native engine. The hop distances to `target` found here are exact,
+        so they are used as the hop bound of that search.
+
+        Returns the keyword arguments for `_get_single_path_native`.
+        """
+        search_graph = nx.subgraph_view(
+            pruned_graph,
+            filter_edge=lambda node1, node2: pruned_graph[node1][node2]["view"].capacity >= value,
+        )
+        nodes: Set[Address] = set()
+        to_target: Dict[Address, int] = {}
+        if source in search_graph and target in search_graph:
+            from_source = nx.single_source_shortest_path_length(
+                search_graph, source, cutoff=max_hops
+            )
+            to_target = nx.single_source_shortest_path_length(
+                search_graph.reverse(copy=False), target, cutoff=max_hops
+            )
+            nodes = {
+                node
+                for node, hops in from_source.items()
+                if node in to_target and hops + to_target[node] <= max_hops
+            }
+
+        # Both directions of the channels are kept for the weights, the ones
+        # which can't carry `value` are skipped by the search.
+        graph = CompactGraph(pruned_graph.subgraph(nodes))
+        return dict(
+            graph=graph,
+            enabled_nodes=bytearray([True]) * len(graph),
+            hop_bound=lambda node_id: to_target[graph.addresses[node_id]],
+        )
+
+    def get_payment_split(  # pylint: disable=too-many-arguments
+        self,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_paths: int,
+        reachability_state: AddressReachabilityProtocol,
+        fee_penalty: float = FEE_PEN_DEFAULT,
+        time_budget: Optional[float] = None,
+    ) -> Optional[List[Path]]:
+        """Splits a payment of `value` over up to `max_paths` channel-disjoint paths.
+
+        The paths are found by successive shortest path searches with the fee
+        aware weights of `get_paths`. Each search only uses channels which are
+        not used by previous paths and can carry an equal share of the
+        remaining value. Each path then carries as much of the remaining value
+        as its capacities allow, including the fees.
+
+        Returns the paths with their `value` set to the amount sent over them,
+        or `None` if the payment can't be split this way. Raises
+        `PathSearchBudgetExceeded` if the split takes longer than `time_budget`
+        seconds, since a partial split is of no use.
+        """
+        deadline = monotonic() + time_budget if time_budget is not None else None
+        if not self.connectivity.is_connected(source, target):
+            return None
+        request_metrics = PathRequestMetrics()
+        try:
+            return self._split_payment(
+                source=source,
+                target=target,
+                value=value,
+                max_paths=max_paths,
+                reachability_state=reachability_state,
+                fee_penalty=fee_penalty,
+                request_metrics=request_metrics,
+                deadline=deadline,
+            )
+        except PathSearchBudgetExceeded:
+            log.warning(
+                "Payment split ran out of time",
+                source=source,
+                target=target,
+                value=value,
+                max_paths=max_paths,
+            )
+            request_metrics.truncated = True
+            raise
+        finally:
+            request_metrics.observe()
+
+    def _split_payment(  # pylint: disable=too-many-arguments
+        self,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_paths: int,
+        reachability_state: AddressReachabilityProtocol,
+        fee_penalty: float,
+        request_metrics: PathRequestMetrics,
+        deadline: Optional[float],
+    ) -> Optional[List[Path]]:
+        is_tracked = reachability_state is self.tracked_reachability_state
+        with request_metrics.measure(PathRequestPhase.PRUNING):
+            graph = (
+                self.online_graph
+                if is_tracked
+                else prune_graph(
+                    self.G.subgraph(self.connectivity.component(source)), reachability_state
+                )
+            )
+        if source not in graph or target not in graph:
+            return None
+
+        used_channels: Set[ChannelID] = set()
+        paths: List[Path] = []
+        remaining = value
+        weight_lookups = count(1)
+
+        def weight(node1: Address, node2: Address, edge: dict) -> Optional[float]:
+            if next(weight_lookups) % DEADLINE_CHECK_INTERVAL == 0:
+                check_deadline(deadline)
+            view = edge["view"]
+            if view.channel_id in used_channels or view.capacity < share:
+                return None
+            edge_weight = edge_weights.get((node1, node2), view, self.G[node2][node1]["view"])
+            return edge_weight if edge_weight != float("inf") else None
+
+        while remaining > 0 and len(paths) < max_paths:
+            check_deadline(deadline)
+            share = PaymentAmount(-(-remaining // (max_paths - len(paths))))
+            with request_metrics.measure(PathRequestPhase.WEIGHTS):
+                edge_weights = EdgeWeights(
+                    visited={},
+                    amount=share,
+                    fee_penalty=fee_penalty,
+                    request_metrics=request_metrics,
+                    estimate_fees=self.estimate_fees,
+                    max_lazy_fees=int(
+                        2 * len(self.channel_id_to_addresses) * FEE_ESTIMATE_MIN_SHARE
+                    ),
+                )
+            try:
+                with request_metrics.measure(PathRequestPhase.SEARCH):
+                    nodes = nx.dijkstra_path(graph, source, target, weight=weight)
+            except NetworkXNoPath:
+                return None
+
+            path = self._get_largest_payment(nodes, remaining, reachability_state, request_metrics)
+            if path is None:
+                return None
+            paths.append(path)
+            remaining = PaymentAmount(remaining - path.value)
+            used_channels.update(edge["view"].channel_id for edge in path.edge_attrs)
+
+        log.debug("Split payment", source=source, target=target, value=value, paths=paths)
+        return paths if remaining == 0 else None
+
+    def _get_largest_payment(
+        self,
+        nodes: List[Address],
+        max_value: PaymentAmount,
+        reachability_state: AddressReachabilityProtocol,
+        request_metrics: PathRequestMetrics,
+    ) -> Optional[Path]:
+        """ Returns the valid path over `nodes` with the largest value up to `max_value` """
+        capacity = min(self.G[node1][node2]["view"].capacity for node1, node2 in window(nodes))
+        path = Path(
+            self.G,
+            nodes,
+            PaymentAmount(min(max_value, capacity)),
+            reachability_state,
+            request_metrics,
+        )
+        if path.is_valid:
+            return path
+
+        # The fees have to fit into the capacities, too, so search for the
+        # largest value which still leaves room for them.
+        best_path: Optional[Path] = None
+        lower, upper = 0, path.value  # `upper` is known to be invalid
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            path = Path(self.G, nodes, PaymentAmount(middle), reachability_state, request_metrics)
+            if path.is_valid:
+                best_path, lower = path, middle
+            else:
+                upper = middle
+        return best_path
+
+    def record_path_request(self, value: PaymentAmount) -> None:
+        """ Counts a path request for `value`, see `iter_route_cache_warmup` """
+        self.requested_values[value_bucket(value)] += 1
+
+    def iter_route_cache_warmup(
+        self,
+        pairs: Iterable[Tuple[Address, Address]],
+        num_values: int,
+        max_paths: int,
+        time_budget: Optional[float] = None,
+    ) -> Iterator[None]:
+        """Precomputes the paths between `pairs` for the most requested values.
+
+        The paths are searched for the smallest value of each of the
+        `num_values` most requested value buckets and stored in the route
+        cache, so that requests with default parameters are answered without
+        a search. Entries which are still current are only validated again.
+        Yields after each search.
+        """
+        reachability_state = self.tracked_reachability_state
+        if reachability_state is None:
+            return
+
+        values = [
+            PaymentAmount(value) for value, _ in self.requested_values.most_common(num_values)
+        ]
+        for source, target in pairs:
+            for value in values:
+                if self.check_path_request_errors(source, target, value, reachability_state):
+                    continue
+                try:
+                    self.get_paths(
+                        source=source,
+                        target=target,
+                        value=value,
+                        max_paths=max_paths,
+                        reachability_state=reachability_state,
+                        time_budget=time_budget,
+                    )
+                except PathSearchBudgetExceeded:
+                    pass
+                yield
+
+    def iter_centrality_update(self) -> Iterator[None]:
+        """Recalculates `centrality` if channels were opened or closed since the last update.
+
+        Yields after each node, so that the caller can do other work in
+        between. The calculation uses the topology at its start, which is
+        kept unmodified by the `CompactGraph`. The results are the same as for
+        `nx.closeness_centrality` on that topology. Channels opened or closed
+        meanwhile are taken into account by the next update.
+        """
+        if self.centrality_version == self.topology_version:
+            return
+
+        version = self.topology_version
+        # Channels can be used in both directions, so the distances from a
+        # node are the same as the distances to it, which closeness is based on.
+        graph = self.compact_graph
+        centrality: Dict[Address, float] = {}
+        for node_id, node in enumerate(graph.addresses):
+            distances = [distance for distance in graph.hop_distances(node_id) if distance >= 0]
+            total_distance = sum(distances)
+            centrality[node] = 0.0
+            if total_distance > 0 and len(graph) > 1:
+                # Scaled by the reachable part of the graph, like networkx does
+                reachable = len(distances) - 1
+                centrality[node] = reachable / total_distance * (reachable / (len(graph) - 1))
+            yield
+
+        self.centrality = centrality
+        self.centrality_version = version
+
+    def update_centrality(self) -> None:
+        """ Like `iter_centrality_update`, but without interruptions """
+        for _ in self.iter_centrality_update():
+            pass
+
     def suggest_partner(
         self, reachability_state: AddressReachabilityProtocol, limit: int = 5
     ) -> List[Dict[str, Any]]:
-        """ Suggest good partners for Raiden nodes joining the token network """
+        """Suggest good partners for Raiden nodes joining the token network
+
+        Uses the centralities from the last `iter_centrality_update`. If they
+        have never been calculated, they are calculated right away. Nodes
+        without known centrality, e.g. of channels opened since the last update,
+        get a score of zero.
+        """
 
         # centrality
-        centrality_of_node = nx.algorithms.centrality.closeness_centrality(self.G)
+        if self.centrality_version is None:
+            self.update_centrality()
+        centrality_of_node = defaultdict(float, self.centrality)
 
         # uptime, only include online nodes
         uptime_of_node = {}
@@ -0,0 +1,474 @@
+"""Computation of paths in worker processes.
+
+The PFS runs in a single gevent process, so a long path search blocks all
+other requests and the handling of Matrix messages. The `RoutingPool` answers
+path requests in separate processes instead.
+
+The main process keeps ingesting updates and publishes the changed token
+networks after each processed batch of updates. A `NetworkSnapshot` of the
+whole token network is only published at first and when many channels have
+changed. Otherwise, a `NetworkUpdate` with the changes since the last snapshot
+is published. Both are written to files which are atomically replaced, so
+that the workers can memory-map the latest complete version at any time.
+
+Each worker rebuilds the `TokenNetwork` of a snapshot once and applies the
+updates to it. The files are written by a dedicated native thread, so that
+the event loop of the main process is not blocked by serializing large
+networks, and writes don't wait for path requests occupying the threads
+which wait for the workers.
+"""
+import mmap
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import structlog
+from eth_utils import to_checksum_address
+from gevent.lock import Semaphore
+from gevent.threadpool import ThreadPool
+
+from pathfinding_service.constants import (
+    DIVERSITY_PEN_DEFAULT,
+    FEE_PEN_DEFAULT,
+    ROUTING_MAX_UPDATE_SHARE,
+)
+from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.shortest_paths import RoutingEngine
+from pathfinding_service.model.token_network import NetworkChanges, Path, TokenNetwork
+from pathfinding_service.typing import AddressReachabilityProtocol
+from raiden.network.transport.matrix import UserPresence
+from raiden.network.transport.matrix.utils import AddressReachability
+from raiden.utils.typing import Address, ChannelID, FeeAmount, PaymentAmount, TokenNetworkAddress
+
+log = structlog.get_logger(__name__)
+
+
+@dataclass
+class ReachabilitySnapshot:
+    """ Copy of the reachability information of all reachable nodes """
+
+    reachable_nodes: Set[Address]
+    user_ids: Dict[Address, Set[str]]
+    presences: Dict[str, UserPresence]
+
+    @classmethod
+    def from_state(
+        cls, reachability_state: AddressReachabilityProtocol, addresses: Iterable[Address]
+    ) -> "ReachabilitySnapshot":
+        reachable_nodes = {
+            address
+            for address in addresses
+            if reachability_state.get_address_reachability(address)
+            == AddressReachability.REACHABLE
+        }
+        user_ids = {
+            address: set(reachability_state.get_userids_for_address(address))
+            for address in reachable_nodes
+        }
+        return cls(
+            reachable_nodes=reachable_nodes,
+            user_ids=user_ids,
+            presences={
+                user_id: reachability_state.get_userid_presence(user_id)
+                for address_user_ids in user_ids.values()
+                for user_id in address_user_ids
+            },
+        )
+
+    def get_address_reachability(self, address: Address) -> AddressReachability:
+        if address in self.reachable_nodes:
+            return AddressReachability.REACHABLE
+        return AddressReachability.UNKNOWN
+
+    def get_userid_presence(self, user_id: str) -> UserPresence:
+        return self.presences.get(user_id, UserPresence.UNKNOWN)
+
+    def get_userids_for_address(self, address: Address) -> Set[str]:
+        return self.user_ids.get(address, set())
+
+    def update(self, other: "ReachabilitySnapshot", addresses: Iterable[Address]) -> None:
+        """Takes the state of `addresses` from `other`
+
+        The presences of the users of `addresses` are replaced, so that only
+        the presences of reachable nodes are kept.
+        """
+        for address in addresses:
+            for user_id in self.user_ids.pop(address, set()):
+                self.presences.pop(user_id, None)
+            self.reachable_nodes.discard(address)
+            if address in other.reachable_nodes:
+                self.reachable_nodes.add(address)
+                self.user_ids[address] = other.get_userids_for_address(address)
+                for user_id in self.user_ids[address]:
+                    self.presences[user_id] = other.get_userid_presence(user_id)
+
+
+def _reachability_candidates(
+    token_network: TokenNetwork, reachability_state: AddressReachabilityProtocol
+) -> Iterable[Address]:
+    """ Returns the nodes which can be reachable, i.e. the online nodes if they are tracked """
+    if reachability_state is token_network.tracked_reachability_state:
+        return token_network.online_nodes
+    return token_network.G.nodes
+
+
+@dataclass
+class NetworkSnapshot:
+    """ Everything a worker needs to answer path requests for a token network """
+
+    token_network_address: TokenNetworkAddress
+    routing_engine: RoutingEngine
+    channels: List[Channel]
+    reachability: ReachabilitySnapshot
+    # Identifies the snapshot the `NetworkUpdate`s apply to
+    snapshot_id: int = 0
+
+    @classmethod
+    def from_token_network(
+        cls,
+        token_network: TokenNetwork,
+        reachability_state: AddressReachabilityProtocol,
+        snapshot_id: int = 0,
+    ) -> "NetworkSnapshot":
+        """Takes a snapshot of `token_network`.
+
+        The snapshot pins the current epoch of the token network, so that the
+        channels stay unmodified while they are serialized, see
+        `TokenNetwork.pin_epoch`.
+        """
+        snapshot = cls(
+            token_network_address=token_network.address,
+            routing_engine=token_network.routing_engine,
+            channels=[
+                view.channel
+                for _, _, view in token_network.G.edges(data="view")
+                if not view.reverse
+            ],
+            reachability=ReachabilitySnapshot.from_state(
+                reachability_state, _reachability_candidates(token_network, reachability_state)
+            ),
+            snapshot_id=snapshot_id,
+        )
+        token_network.pin_epoch(snapshot)
+        return snapshot
+
+    def to_token_network(self) -> TokenNetwork:
+        token_network = TokenNetwork(
+            token_network_address=self.token_network_address, routing_engine=self.routing_engine
+        )
+        token_network.add_channels(self.channels)
+        token_network.track_reachability(self.reachability)
+        return token_network
+
+
+@dataclass
+class NetworkUpdate:
+    """ Changes of a token network since the `NetworkSnapshot` with `snapshot_id` """
+
+    snapshot_id: int
+    # Copies of the opened or changed channels
+    channels: List[Channel]
+    closed_channels: Set[ChannelID]
+    # Reachability of the changed nodes
+    nodes: Set[Address]
+    reachability: ReachabilitySnapshot
+
+    @classmethod
+    def from_changes(
+        cls,
+        token_network: TokenNetwork,
+        reachability_state: AddressReachabilityProtocol,
+        changes: NetworkChanges,
+        snapshot_id: int,
+    ) -> "NetworkUpdate":
+        channels = []
+        closed_channels = set()
+        for channel_id in changes.channels:
+            participants = token_network.channel_id_to_addresses.get(channel_id)
+            if participants is None:
+                closed_channels.add(channel_id)
+            else:
+                channels.append(token_network.G[participants[0]][participants[1]]["view"].channel)
+        # The participants of new channels may be unknown to the workers
+        nodes = changes.nodes.union(
+            *((channel.participant1, channel.participant2) for channel in channels)
+        )
+        return cls(
+            snapshot_id=snapshot_id,
+            channels=[channel.copy() for channel in channels],
+            closed_channels=closed_channels,
+            nodes=nodes,
+            reachability=ReachabilitySnapshot.from_state(reachability_state, nodes),
+        )
+
+    def apply(self, token_network: TokenNetwork) -> None:
+        """ Applies the changes to the `token_network` of the snapshot, can be repeated """
+        reachability = token_network.tracked_reachability_state
+        assert isinstance(reachability, ReachabilitySnapshot)
+        reachability.update(self.reachability, self.nodes)
+
+        for channel_id in self.closed_channels:
+            if channel_id in token_network.channel_id_to_addresses:
+                token_network.handle_channel_closed_event(channel_id)
+        new_channels = []
+        for channel in self.channels:
+            if channel.channel_id in token_network.channel_id_to_addresses:
+                token_network.replace_channel(channel)
+            else:
+                new_channels.append(channel)
+        token_network.add_channels(new_channels)
+
+        for address in self.nodes:
+            token_network.handle_address_reachability_change(
+                address, reachability.get_address_reachability(address)
+            )
+
+
+def write_snapshot(path: str, snapshot: Any) -> None:
+    """ Replaces the snapshot or update at `path` without exposing partially written files """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Any:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return pickle.loads(data)
+
+
+def update_path(snapshot_path: str) -> str:
+    """ Returns the path of the updates for the snapshot at `snapshot_path` """
+    return snapshot_path + ".update"
+
+
+@dataclass
+class PathResult:
+    """ The parts of a `Path` needed to answer a path request """
+
+    nodes: List[Address]
+    matrix_users: Dict[str, str]
+    estimated_fee: FeeAmount
+
+    @classmethod
+    def from_path(cls, path: Path) -> "PathResult":
+        assert path.matrix_users is not None
+        return cls(
+            nodes=path.nodes, matrix_users=path.matrix_users, estimated_fee=path.estimated_fee
+        )
+
+    def to_dict(self) -> dict:
+        return dict(
+            path=[to_checksum_address(node) for node in self.nodes],
+            matrix_users=self.matrix_users,
+            estimated_fee=self.estimated_fee,
+        )
+
+
+FileVersion = Tuple[int, int]
+
+
+@dataclass
+class _LoadedTokenNetwork:
+    snapshot_version: FileVersion
+    snapshot_id: int
+    update_version: Optional[FileVersion]
+    token_network: TokenNetwork
+
+
+# Token networks loaded by this worker process, by snapshot path
+_loaded_token_networks: Dict[str, _LoadedTokenNetwork] = {}
+
+
+def _file_version(path: str) -> Optional[FileVersion]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def load_token_network(path: str) -> TokenNetwork:
+    """Returns the token network of the snapshot at `path`, including the latest update
+
+    The token network is only rebuilt if the snapshot was replaced.
+    """
+    snapshot_version = _file_version(path)
+    assert snapshot_version is not None
+    loaded = _loaded_token_networks.get(path)
+    if loaded is None or loaded.snapshot_version != snapshot_version:
+        snapshot: NetworkSnapshot = read_snapshot(path)
+        loaded = _loaded_token_networks[path] = _LoadedTokenNetwork(
+            snapshot_version=snapshot_version,
+            snapshot_id=snapshot.snapshot_id,
+            update_version=None,
+            token_network=snapshot.to_token_network(),
+        )
+
+    update_version = _file_version(update_path(path))
+    if update_version is not None and update_version != loaded.update_version:
+        update: NetworkUpdate = read_snapshot(update_path(path))
+        # Updates for a different snapshot are skipped until it is published
+        if update.snapshot_id == loaded.snapshot_id:
+            update.apply(loaded.token_network)
+            loaded.update_version = update_version
+    return loaded.token_network
+
+
+def find_paths(  # pylint: disable=too-many-arguments
+    snapshot_path: str,
+    source: Address,
+    target: Address,
+    value: PaymentAmount,
+    max_paths: int,
+    diversity_penalty: float,
+    fee_penalty: float,
+    max_hops: Optional[int] = None,
+    time_budget: Optional[float] = None,
+) -> List[PathResult]:
+    """ Runs `TokenNetwork.get_paths` on the latest snapshot inside a worker process """
+    token_network = load_token_network(snapshot_path)
+    assert token_network.tracked_reachability_state is not None
+    paths = token_network.get_paths(
+        source=source,
+        target=target,
+        value=value,
+        max_paths=max_paths,
+        reachability_state=token_network.tracked_reachability_state,
+        diversity_penalty=diversity_penalty,
+        fee_penalty=fee_penalty,
+        max_hops=max_hops,
+        time_budget=time_budget,
+    )
+    return [PathResult.from_path(path) for path in paths]
+
+
+class RoutingPool:
+    """Answers path requests for published token networks in worker processes.
+
+    The greenlet making a request waits for the result in a native thread, so
+    that other greenlets can run in the meantime.
+    """
+
+    def __init__(self, num_workers: int) -> None:
+        self.snapshot_dir = tempfile.mkdtemp(prefix="pfs-routing-")
+        # Forking a process running gevent is not safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # Threads waiting for the results of the workers
+        self.threadpool = ThreadPool(num_workers)
+        # Thread writing the snapshots and updates, in the order of publishing
+        self.writer = ThreadPool(1)
+        # Only one greenlet may publish at a time, see `publish`
+        self._publish_lock = Semaphore()
+        # Id of the published snapshot and the changes since then, by token network
+        self.published: Dict[TokenNetworkAddress, Tuple[int, NetworkChanges]] = {}
+        self._next_snapshot_id = 0
+
+    def snapshot_path(self, token_network_address: TokenNetworkAddress) -> str:
+        return os.path.join(self.snapshot_dir, to_checksum_address(token_network_address))
+
+    def is_published(self, token_network_address: TokenNetworkAddress) -> bool:
+        return token_network_address in self.published
+
+    def publish(
+        self,
+        token_networks: Iterable[TokenNetwork],
+        reachability_state: AddressReachabilityProtocol,
+    ) -> None:
+        """Publishes all token networks changed since the last call.
+
+        The changes since the last snapshot are published as an update, unless
+        there are more than `ROUTING_MAX_UPDATE_SHARE` changes per channel.
+        Then a new snapshot is published instead. The files are written in a
+        native thread, only the calling greenlet waits for them. Other
+        greenlets publishing meanwhile wait until the files are written, so
+        that no changes are published for a replaced snapshot.
+        """
+        with self._publish_lock:
+            self._publish(token_networks, reachability_state)
+
+    def _publish(
+        self,
+        token_networks: Iterable[TokenNetwork],
+        reachability_state: AddressReachabilityProtocol,
+    ) -> None:
+        for token_network in token_networks:
+            path = self.snapshot_path(token_network.address)
+            published = self.published.get(token_network.address)
+            if published is None:
+                token_network.record_changes()
+            else:
+                snapshot_id, changes = published
+                new_changes = token_network.pop_changes()
+                if not new_changes:
+                    continue
+                changes.update(new_changes)
+                max_changes = ROUTING_MAX_UPDATE_SHARE * len(token_network.channel_id_to_addresses)
+                if len(changes) <= max_changes:
+                    update = NetworkUpdate.from_changes(
+                        token_network, reachability_state, changes, snapshot_id
+                    )
+                    self.writer.apply(write_snapshot, (update_path(path), update))
+                    log.debug(
+                        "Published routing update",
+                        token_network_address=to_checksum_address(token_network.address),
+                        snapshot_id=snapshot_id,
+                        num_changes=len(changes),
+                    )
+                    continue
+
+            snapshot_id = self._next_snapshot_id
+            self._next_snapshot_id += 1
+            # Changes made while the snapshot is written are part of the next update
+            token_network.pop_changes()
+            snapshot = NetworkSnapshot.from_token_network(
+                token_network, reachability_state, snapshot_id=snapshot_id
+            )
+            self.writer.apply(write_snapshot, (path, snapshot))
+            self.published[token_network.address] = (snapshot_id, NetworkChanges())
+            log.debug(
+                "Published routing snapshot",
+                token_network_address=to_checksum_address(token_network.address),
+                snapshot_id=snapshot_id,
+            )
+
+    def get_paths(  # pylint: disable=too-many-arguments
+        self,
+        token_network_address: TokenNetworkAddress,
+        source: Address,
+        target: Address,
+        value: PaymentAmount,
+        max_paths: int,
+        diversity_penalty: float = DIVERSITY_PEN_DEFAULT,
+        fee_penalty: float = FEE_PEN_DEFAULT,
+        max_hops: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> List[PathResult]:
+        """ Like `TokenNetwork.get_paths`, but on the latest published snapshot """
+        assert self.is_published(token_network_address)
+        future = self.executor.submit(
+            find_paths,
+            snapshot_path=self.snapshot_path(token_network_address),
+            source=source,
+            target=target,
+            value=value,
+            max_paths=max_paths,
+            diversity_penalty=diversity_penalty,
+            fee_penalty=fee_penalty,
+            max_hops=max_hops,
+            time_budget=time_budget,
+        )
+        return self.threadpool.apply(future.result)
+
+    def stop(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.threadpool.kill()
+        self.writer.kill()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
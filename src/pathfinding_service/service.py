@@ -2,17 +2,25 @@ import collections
 import sys
 import time
 from dataclasses import asdict
-from typing import Dict, Iterator, List, Optional
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import gevent
 import sentry_sdk
 import structlog
-from eth_utils import to_canonical_address
+from eth_utils import to_canonical_address, to_checksum_address
 from gevent import Timeout
 from web3 import Web3
 from web3.contract import Contract
 
 from pathfinding_service import metrics
+from pathfinding_service.constants import (
+    DEFAULT_MAX_PATHS,
+    ROUTE_WARMER_INTERVAL,
+    ROUTE_WARMER_PAIRS,
+    ROUTE_WARMER_VALUES,
+    ROUTE_WARMER_WINDOW,
+)
 from pathfinding_service.database import PFSDatabase
 from pathfinding_service.exceptions import (
     InvalidCapacityUpdate,
@@ -21,11 +29,21 @@ from pathfinding_service.exceptions import (
 )
 from pathfinding_service.model import IOU, TokenNetwork
 from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.shortest_paths import RoutingEngine
+from pathfinding_service.routing_pool import RoutingPool
 from pathfinding_service.typing import DeferableMessage
 from raiden.constants import UINT256_MAX, DeviceIDs
 from raiden.messages.abstract import Message
 from raiden.messages.path_finding_service import PFSCapacityUpdate, PFSFeeUpdate
-from raiden.utils.typing import BlockNumber, BlockTimeout, ChainID, TokenNetworkAddress
+from raiden.network.transport.matrix.utils import AddressReachability
+from raiden.utils.typing import (
+    Address,
+    BlockNumber,
+    BlockTimeout,
+    ChainID,
+    ChannelID,
+    TokenNetworkAddress,
+)
 from raiden_contracts.constants import CONTRACT_TOKEN_NETWORK_REGISTRY, CONTRACT_USER_DEPOSIT
 from raiden_contracts.utils.type_aliases import PrivateKey
 from raiden_libs.blockchain import get_blockchain_events_adaptive
@@ -54,6 +72,125 @@ class DeferMessage(Exception):
         self.deferred_message = deferred_message
 
 
+def _supersedes(
+    update: Union[PFSCapacityUpdate, PFSFeeUpdate],
+    previous: Union[PFSCapacityUpdate, PFSFeeUpdate],
+) -> bool:
+    if isinstance(update, PFSCapacityUpdate):
+        assert isinstance(previous, PFSCapacityUpdate)
+        # Of two updates with the same nonce, the later one is applied last
+        return update.updating_nonce >= previous.updating_nonce
+
+    assert isinstance(update, PFSFeeUpdate) and isinstance(previous, PFSFeeUpdate)
+    # Fee updates without increasing timestamp are rejected
+    return update.timestamp > previous.timestamp
+
+
+def coalesce_updates(
+    messages: List[Message], is_valid: Callable[[Message], bool]
+) -> List[Message]:
+    """Drops the capacity and fee updates which are superseded within `messages`.
+
+    Per channel and updating participant, only the valid capacity update with
+    the highest nonce and the valid fee update with the latest timestamp are
+    kept, at the position of the first valid update. `is_valid` is only
+    called when updates are compared, so that invalid updates can't replace
+    valid ones. Invalid updates are kept and rejected later.
+    """
+    result: List[Message] = []
+    # Position of the latest update per message type, channel and updating participant
+    latest: Dict[Tuple[str, TokenNetworkAddress, ChannelID, Address], int] = {}
+    # Positions of updates which have been validated
+    verified: Set[int] = set()
+    for message in messages:
+        is_comparable = isinstance(message, PFSCapacityUpdate) or (
+            # Timestamps with time zone can't be compared and are rejected
+            isinstance(message, PFSFeeUpdate)
+            and message.timestamp.tzinfo is None
+        )
+        if not is_comparable:
+            result.append(message)
+            continue
+
+        assert isinstance(message, (PFSCapacityUpdate, PFSFeeUpdate))
+        key = (
+            message.__class__.__name__,
+            TokenNetworkAddress(message.canonical_identifier.token_network_address),
+            message.canonical_identifier.channel_identifier,
+            message.updating_participant,
+        )
+        index = latest.get(key)
+        if index is None:
+            latest[key] = len(result)
+            result.append(message)
+            continue
+        if not is_valid(message):
+            result.append(message)
+            continue
+
+        previous = result[index]
+        assert isinstance(previous, (PFSCapacityUpdate, PFSFeeUpdate))
+        if index not in verified and not is_valid(previous):
+            latest[key] = len(result)
+            verified.add(len(result))
+            result.append(message)
+            continue
+
+        verified.add(index)
+        if _supersedes(message, previous):
+            result[index] = message
+        metrics.get_metrics_for_label(
+            metrics.MESSAGES_COALESCED, metrics.MessageType(key[0])
+        ).inc()
+
+    return result
+
+
+class MessageBatch:
+    """Collects the database writes for a batch of messages, see `handle_messages`.
+
+    Provides the same methods as `PFSDatabase` for the rows written by the
+    message handlers. Rows are kept by primary key, so only their latest
+    version is written. Capacity updates are visible to
+    `PFSDatabase.get_capacity_updates` before they are written.
+    """
+
+    def __init__(self, database: PFSDatabase) -> None:
+        self.database = database
+        self.capacity_updates: Dict[
+            Tuple[TokenNetworkAddress, ChannelID, Address], PFSCapacityUpdate
+        ] = {}
+        self.channels: Dict[Tuple[TokenNetworkAddress, ChannelID], Channel] = {}
+        self.waiting_messages: List[DeferableMessage] = []
+
+    def upsert_capacity_update(self, message: PFSCapacityUpdate) -> None:
+        key = (
+            TokenNetworkAddress(message.canonical_identifier.token_network_address),
+            message.canonical_identifier.channel_identifier,
+            message.updating_participant,
+        )
+        self.capacity_updates[key] = message
+        self.database.index_capacity_update(message)
+
+    def upsert_channel(self, channel: Channel) -> None:
+        self.channels[(channel.token_network_address, channel.channel_id)] = channel
+
+    def insert_waiting_message(self, message: DeferableMessage) -> None:
+        self.waiting_messages.append(message)
+
+    def write(self) -> None:
+        """Writes all collected rows in a single transaction.
+
+        The channels and capacity updates are written behind, together, see
+        `PFSDatabase.defer_channel_updates`.
+        """
+        with self.database.transaction():
+            self.database.insert_waiting_messages(self.waiting_messages)
+            self.database.defer_channel_updates(
+                self.channels.values(), capacity_updates=self.capacity_updates.values()
+            )
+
+
 class PathfindingService(gevent.Greenlet):
     # pylint: disable=too-many-instance-attributes
     def __init__(  # pylint: disable=too-many-arguments
@@ -66,6 +203,10 @@ class PathfindingService(gevent.Greenlet):
         required_confirmations: BlockTimeout,
         poll_interval: float,
         matrix_servers: Optional[List[str]] = None,
+        routing_engine: RoutingEngine = RoutingEngine.NETWORKX,
+        routing_workers: int = 0,
+        path_search_budget: Optional[float] = None,
+        channel_flush_interval: float = 0,
     ):
         super().__init__()
 
@@ -77,6 +218,10 @@ class PathfindingService(gevent.Greenlet):
         self.address = private_key_to_address(private_key)
         self.required_confirmations = required_confirmations
         self._poll_interval = poll_interval
+        self.routing_engine = routing_engine
+        self.routing_pool = RoutingPool(routing_workers) if routing_workers else None
+        # Seconds a single path request may search for paths, unlimited if `None`
+        self.path_search_budget = path_search_budget
         self._is_running = gevent.event.Event()
 
         log.info("PFS payment address", address=self.address)
@@ -89,6 +234,7 @@ class PathfindingService(gevent.Greenlet):
             chain_id=self.chain_id,
             user_deposit_contract_address=to_canonical_address(self.user_deposit_contract.address),
             allow_create=True,
+            channel_flush_interval=channel_flush_interval,
         )
 
         self.blockchain_state = BlockchainState(
@@ -103,11 +249,16 @@ class PathfindingService(gevent.Greenlet):
             device_id=DeviceIDs.PFS,
             message_received_callback=self.handle_message,
             servers=matrix_servers,
+            address_reachability_changed_callback=self.handle_address_reachability_change,
+            messages_received_callback=self.handle_messages,
         )
 
         self.token_networks = self._load_token_networks()
         self.updated = gevent.event.Event()  # set whenever blocks are processed
         self.startup_finished = gevent.event.AsyncResult()
+        self.centrality_updater = gevent.Greenlet(self._update_centralities)
+        self.route_warmer = gevent.Greenlet(self._warm_route_caches)
+        self.channel_flusher = gevent.Greenlet(self._flush_channels)
 
         self._init_metrics()
 
@@ -124,16 +275,52 @@ class PathfindingService(gevent.Greenlet):
         metrics.get_metrics_for_label(
             metrics.IOU_CLAIMS_TOKEN, metrics.IouStatus.SUCCESSFUL
         ).set_function(_get_total_amount_of_claimed_ious)
+        metrics.PATH_SEARCH_BUDGET.set(self.path_search_budget or 0)
+        for token_network in self.token_networks.values():
+            self._init_token_network_metrics(token_network)
+
+    @staticmethod
+    def _init_token_network_metrics(token_network: TokenNetwork) -> None:
+        token_network_address = to_checksum_address(token_network.address)
+        # `G` is replaced when it is pinned by a routing snapshot, so it is looked up each time
+        metrics.TOKEN_NETWORK_NODES.labels(token_network_address).set_function(
+            lambda: float(token_network.G.number_of_nodes())
+        )
+        metrics.TOKEN_NETWORK_CHANNELS.labels(token_network_address).set_function(
+            lambda: float(len(token_network.channel_id_to_addresses))
+        )
 
     def _iter_claimed_ious(self) -> Iterator[IOU]:
         return self.database.get_ious(claimed=True)
 
     def _load_token_networks(self) -> Dict[TokenNetworkAddress, TokenNetwork]:
+        start = time.monotonic()
         network_for_address = {n.address: n for n in self.database.get_token_networks()}
-        for channel in self.database.get_channels():
-            for cv in channel.views:
-                network_for_address[cv.token_network_address].add_channel_view(cv)
+        for token_network in network_for_address.values():
+            token_network.routing_engine = self.routing_engine
 
+        channels_for_address: Dict[TokenNetworkAddress, List[Channel]] = {
+            address: [] for address in network_for_address
+        }
+        for channel in self.database.load_channels():
+            channels_for_address[channel.token_network_address].append(channel)
+        after_read = time.monotonic()
+
+        for address, channels in channels_for_address.items():
+            network_for_address[address].add_channels(channels)
+        after_graphs = time.monotonic()
+
+        for token_network in network_for_address.values():
+            token_network.track_reachability(self.matrix_listener.user_manager)
+
+        log.info(
+            "Loaded token networks",
+            num_token_networks=len(network_for_address),
+            num_channels=sum(len(channels) for channels in channels_for_address.values()),
+            reading=round(after_read - start, 2),
+            building_graphs=round(after_graphs - after_read, 2),
+            reachability=round(time.monotonic() - after_graphs, 2),
+        )
         return network_for_address
 
     def _run(self) -> None:  # pylint: disable=method-hidden
@@ -155,10 +342,18 @@ class PathfindingService(gevent.Greenlet):
             registry_address=self.registry_address,
             start_block=self.database.get_latest_committed_block(),
         )
+        self.centrality_updater.start()
+        # The routing workers answer the path requests with their own route
+        # caches, so warming the cache of this process would be of no use.
+        if self.routing_pool is None:
+            self.route_warmer.start()
+        if self.database.channel_flush_interval > 0:
+            self.channel_flusher.start()
         while not self._is_running.is_set():
             self._process_new_blocks(
                 BlockNumber(self.web3.eth.blockNumber - self.required_confirmations)
             )
+            self._publish_token_networks()
 
             # Let tests waiting for this event know that we're done with processing
             self.updated.set()
@@ -166,7 +361,54 @@ class PathfindingService(gevent.Greenlet):
 
             # Sleep, then collect errors from greenlets
             gevent.sleep(self._poll_interval)
-            gevent.joinall({self.matrix_listener}, timeout=0, raise_error=True)
+            gevent.joinall(
+                {
+                    self.matrix_listener,
+                    self.centrality_updater,
+                    self.route_warmer,
+                    self.channel_flusher,
+                },
+                timeout=0,
+                raise_error=True,
+            )
+
+    def _publish_token_networks(self) -> None:
+        """ Makes the changes of the token networks visible to the routing workers """
+        if self.routing_pool:
+            self.routing_pool.publish(
+                self.token_networks.values(), self.matrix_listener.user_manager
+            )
+
+    def _update_centralities(self) -> None:
+        """ Keeps the centralities used by `TokenNetwork.suggest_partner` up to date """
+        while not self._is_running.is_set():
+            for token_network in list(self.token_networks.values()):
+                for _ in token_network.iter_centrality_update():
+                    gevent.idle()  # Allow answering requests in between nodes
+            gevent.sleep(self._poll_interval)
+
+    def _warm_route_caches(self) -> None:
+        """ Precomputes the routes of the most requested source/target pairs """
+        while not self._is_running.is_set():
+            since = datetime.utcnow() - ROUTE_WARMER_WINDOW
+            for token_network in list(self.token_networks.values()):
+                pairs = self.database.get_most_requested_pairs(
+                    token_network.address, limit=ROUTE_WARMER_PAIRS, since=since
+                )
+                for _ in token_network.iter_route_cache_warmup(
+                    pairs,
+                    num_values=ROUTE_WARMER_VALUES,
+                    max_paths=DEFAULT_MAX_PATHS,
+                    time_budget=self.path_search_budget,
+                ):
+                    gevent.idle()  # Allow answering requests in between searches
+            gevent.sleep(ROUTE_WARMER_INTERVAL)
+
+    def _flush_channels(self) -> None:
+        """ Writes the channel updates deferred by the database in time """
+        while not self._is_running.is_set():
+            gevent.sleep(self.database.channel_flush_interval)
+            self.database.flush_channels()
 
     def _process_new_blocks(self, latest_confirmed_block: BlockNumber) -> None:
         start = time.monotonic()
@@ -204,8 +446,14 @@ class PathfindingService(gevent.Greenlet):
 
     def stop(self) -> None:
         self.matrix_listener.kill()
+        self.centrality_updater.kill()
+        self.route_warmer.kill()
+        self.channel_flusher.kill()
         self._is_running.set()
         self.matrix_listener.join()
+        self.database.flush_channels()
+        if self.routing_pool:
+            self.routing_pool.stop()
 
     def follows_token_network(self, token_network_address: TokenNetworkAddress) -> bool:
         """ Checks if a token network is followed by the pathfinding service. """
@@ -217,6 +465,12 @@ class PathfindingService(gevent.Greenlet):
         """ Returns the `TokenNetwork` for the given address or `None` for unknown networks. """
         return self.token_networks.get(token_network_address)
 
+    def handle_address_reachability_change(
+        self, address: Address, reachability: AddressReachability
+    ) -> None:
+        for token_network in self.token_networks.values():
+            token_network.handle_address_reachability_change(address, reachability)
+
     def handle_event(self, event: Event) -> None:
         with sentry_sdk.configure_scope() as scope:
             with metrics.collect_event_metrics(event):
@@ -239,7 +493,10 @@ class PathfindingService(gevent.Greenlet):
         if not self.follows_token_network(network_address):
             log.info("Found new token network", event_=event)
 
-            self.token_networks[network_address] = TokenNetwork(network_address)
+            token_network = TokenNetwork(network_address, routing_engine=self.routing_engine)
+            token_network.track_reachability(self.matrix_listener.user_manager)
+            self._init_token_network_metrics(token_network)
+            self.token_networks[network_address] = token_network
             self.database.upsert_token_network(network_address)
 
     def handle_channel_opened(self, event: ReceiveChannelOpenedEvent) -> None:
@@ -259,11 +516,14 @@ class PathfindingService(gevent.Greenlet):
 
         # Handle messages for this channel which where received before ChannelOpened
         with self.database.conn:
-            for message in self.database.pop_waiting_messages(
-                token_network_address=token_network.address, channel_id=event.channel_identifier
-            ):
-                log.debug("Processing deferred message", message=message)
-                self.handle_message(message)
+            waiting_messages = list(
+                self.database.pop_waiting_messages(
+                    token_network_address=token_network.address,
+                    channel_id=event.channel_identifier,
+                )
+            )
+            log.debug("Processing deferred messages", messages=waiting_messages)
+            self.handle_messages(waiting_messages)
 
     def handle_channel_closed(self, event: ReceiveChannelClosedEvent) -> None:
         token_network = self.get_token_network(event.token_network_address)
@@ -286,33 +546,77 @@ class PathfindingService(gevent.Greenlet):
             metrics.get_metrics_for_label(metrics.ERRORS_LOGGED, metrics.ErrorCategory.STATE).inc()
 
     def handle_message(self, message: Message) -> None:
-        with sentry_sdk.configure_scope() as scope:
-            scope.set_extra("message", message)
+        self.handle_messages([message])
+
+    def handle_messages(self, messages: List[Message]) -> None:
+        """Handles the messages received in one Matrix sync together.
+
+        Superseded capacity and fee updates are dropped, see `coalesce_updates`.
+        The remaining messages are validated and applied to the token networks
+        one by one, but the database is only updated once for the whole batch,
+        in a single transaction. Afterwards, the changes are published to the
+        routing workers.
+        """
+        if not messages:
+            return
+
+        batch = MessageBatch(self.database)
+        with metrics.MESSAGE_BATCH_DURATION.time():
             try:
-                with metrics.collect_message_metrics(message):
-                    if isinstance(message, PFSCapacityUpdate):
-                        changed_channel: Optional[Channel] = self.on_capacity_update(message)
-                    elif isinstance(message, PFSFeeUpdate):
-                        changed_channel = self.on_fee_update(message)
-                    else:
-                        log.debug("Ignoring message", unknown_message=message)
-                        return
-
-                    if changed_channel:
-                        self.database.upsert_channel(changed_channel)
-
-            except DeferMessage as ex:
-                self.defer_message_until_channel_is_open(ex.deferred_message)
-            except InvalidGlobalMessage as ex:
-                log.info(str(ex), **asdict(message))
-
-    def defer_message_until_channel_is_open(self, message: DeferableMessage) -> None:
+                with sentry_sdk.configure_scope() as scope:
+                    for message in coalesce_updates(messages, self._is_valid_update):
+                        scope.set_extra("message", message)
+                        self._handle_message(message, batch)
+            finally:
+                # Keep the database consistent with the token networks, even
+                # if a message failed unexpectedly.
+                batch.write()
+        metrics.MESSAGE_BATCH_SIZE.observe(len(messages))
+        # Path requests answered by the routing workers use the new capacities
+        self._publish_token_networks()
+
+    def _is_valid_update(self, message: Message) -> bool:
+        try:
+            if isinstance(message, PFSCapacityUpdate):
+                self._validate_pfs_capacity_update(message)
+            elif isinstance(message, PFSFeeUpdate):
+                self._validate_pfs_fee_update(message)
+        except DeferMessage:
+            # All updates for the channel are deferred, so the latest one is kept
+            return True
+        except InvalidGlobalMessage:
+            return False
+        return True
+
+    def _handle_message(self, message: Message, batch: MessageBatch) -> None:
+        try:
+            with metrics.collect_message_metrics(message):
+                if isinstance(message, PFSCapacityUpdate):
+                    changed_channel: Optional[Channel] = self.on_capacity_update(message, batch)
+                elif isinstance(message, PFSFeeUpdate):
+                    changed_channel = self.on_fee_update(message)
+                else:
+                    log.debug("Ignoring message", unknown_message=message)
+                    return
+
+                if changed_channel:
+                    batch.upsert_channel(changed_channel)
+
+        except DeferMessage as ex:
+            self.defer_message_until_channel_is_open(ex.deferred_message, batch)
+        except InvalidGlobalMessage as ex:
+            log.info(str(ex), **asdict(message))
+
+    def defer_message_until_channel_is_open(
+        self, message: DeferableMessage, batch: Optional[MessageBatch] = None
+    ) -> None:
         log.debug(
             "Received message for unknown channel, defer until ChannelOpened is confirmed",
             channel_id=message.canonical_identifier.channel_identifier,
             message=message,
         )
-        self.database.insert_waiting_message(message)
+        storage: Union[PFSDatabase, MessageBatch] = self.database if batch is None else batch
+        storage.insert_waiting_message(message)
 
     def _validate_pfs_fee_update(self, message: PFSFeeUpdate) -> TokenNetwork:
         # check if chain_id matches
@@ -341,6 +645,11 @@ class PathfindingService(gevent.Greenlet):
         # check that timestamp has no timezone
         if message.timestamp.tzinfo is not None:
             raise InvalidFeeUpdate("Timestamp of Fee Update should not contain timezone")
+        if message.timestamp > datetime.utcnow() + timedelta(hours=1):
+            # We don't really care about the time, but if we accept a time far
+            # in the future, the client will have problems sending fee updates
+            # with increasing time after fixing his clock.
+            raise InvalidFeeUpdate("Timestamp is in the future")
 
         return token_network
 
@@ -390,10 +699,18 @@ class PathfindingService(gevent.Greenlet):
 
         return token_network
 
-    def on_capacity_update(self, message: PFSCapacityUpdate) -> Channel:
+    def on_capacity_update(
+        self, message: PFSCapacityUpdate, batch: Optional[MessageBatch] = None
+    ) -> Channel:
+        """Applies the capacity update to its token network.
+
+        The capacity update is stored in `batch` if given, otherwise it is
+        written to the database immediately.
+        """
         token_network = self._validate_pfs_capacity_update(message)
         log.debug("Received Capacity Update", message=message)
-        self.database.upsert_capacity_update(message)
+        storage: Union[PFSDatabase, MessageBatch] = self.database if batch is None else batch
+        storage.upsert_capacity_update(message)
 
         updating_capacity_partner, other_capacity_partner = self.database.get_capacity_updates(
             updating_participant=message.other_participant,
@@ -1,7 +1,8 @@
 import os
 import sqlite3
 import sys
-from typing import Any, Dict, List
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
 
 import structlog
 from eth_utils import to_canonical_address, to_checksum_address
@@ -140,6 +141,39 @@ class BaseDatabase:
     def upsert(self, table_name: str, fields_by_colname: Dict[str, Any]) -> sqlite3.Cursor:
         return self.insert(table_name, fields_by_colname, keyword="INSERT OR REPLACE")
 
+    def insert_many(
+        self, table_name: str, rows: List[Dict[str, Any]], keyword: str = "INSERT"
+    ) -> None:
+        """ Like `insert`, but for multiple rows with the same columns """
+        if not rows:
+            return
+        cols = ", ".join(rows[0].keys())
+        values = ", ".join(":" + col_name for col_name in rows[0])
+        self.conn.executemany(f"{keyword} INTO {table_name}({cols}) VALUES ({values})", rows)
+
+    def upsert_many(self, table_name: str, rows: List[Dict[str, Any]]) -> None:
+        self.insert_many(table_name, rows, keyword="INSERT OR REPLACE")
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Executes all statements within the context in a single transaction.
+
+        The connection does not manage transactions implicitly, so without this
+        each statement is committed on its own. Nested transactions are part of
+        the enclosing one.
+        """
+        if self.conn.in_transaction:
+            yield
+            return
+
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
     def get_blockchain_state(self) -> BlockchainState:
         blockchain = self.conn.execute("SELECT * FROM blockchain").fetchone()
         latest_committed_block = blockchain["latest_committed_block"]
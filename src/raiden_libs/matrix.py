@@ -32,6 +32,7 @@ from raiden.network.transport.matrix.client import (
     Room,
 )
 from raiden.network.transport.matrix.utils import (
+    AddressReachability,
     DisplayNameCache,
     join_broadcast_room,
     login,
@@ -53,7 +54,7 @@ from raiden.utils.cli import get_matrix_servers
 from raiden.utils.signer import LocalSigner
 from raiden.utils.typing import Address, ChainID, RoomID, Set
 from raiden_contracts.utils.type_aliases import PrivateKey
-from raiden_libs.utils import MultiClientUserAddressManager
+from raiden_libs.utils import MultiClientUserAddressManager, noop_reachability
 
 log = structlog.get_logger(__name__)
 
@@ -142,12 +143,18 @@ class MatrixListener(gevent.Greenlet):
         device_id: DeviceIDs,
         message_received_callback: Callable[[Message], None],
         servers: Optional[List[str]] = None,
+        address_reachability_changed_callback: Callable[
+            [Address, AddressReachability], None
+        ] = noop_reachability,
+        messages_received_callback: Optional[Callable[[List[Message]], None]] = None,
     ) -> None:
         super().__init__()
 
         self.chain_id = chain_id
         self.device_id = device_id
         self.message_received_callback = message_received_callback
+        # Receives all messages of a sync at once instead, if given
+        self.messages_received_callback = messages_received_callback
         self._displayname_cache = DisplayNameCache()
         self.startup_finished = AsyncResult()
         self._client_manager = ClientManager(
@@ -163,6 +170,7 @@ class MatrixListener(gevent.Greenlet):
         self.user_manager = MultiClientUserAddressManager(
             client=self._client,
             displayname_cache=self._displayname_cache,
+            address_reachability_changed_callback=address_reachability_changed_callback,
         )
 
         self._rate_limiter = RateLimiter(
@@ -226,6 +234,10 @@ class MatrixListener(gevent.Greenlet):
 
         log.debug("Incoming messages", messages=all_messages)
 
+        if self.messages_received_callback is not None:
+            self.messages_received_callback(all_messages)
+            return True
+
         for message in all_messages:
             self.message_received_callback(message)
 
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
 from uuid import uuid4
 
 import pkg_resources
@@ -381,6 +382,151 @@ def test_get_paths(api_url: str, addresses: List[Address], token_network_model:
         assert response.json()["error_code"] == exceptions.NoRouteFound.error_code
 
 
+@pytest.mark.usefixtures("api_sut")
+def test_get_paths_timeout(
+    api_url: str, addresses: List[Address], token_network_model: TokenNetwork
+):
+    hex_addrs = [to_checksum_address(addr) for addr in addresses]
+    url = api_url + "/v1/" + to_checksum_address(token_network_model.address) + "/paths"
+
+    data = {"from": hex_addrs[0], "to": hex_addrs[2], "value": 10}
+    with patch.object(TokenNetwork, "get_paths", side_effect=exceptions.PathSearchBudgetExceeded):
+        response = requests.post(url, json=data)
+    assert response.status_code == 503
+    assert response.json()["error_code"] == exceptions.PathSearchTimeout.error_code
+
+
+@pytest.mark.usefixtures("api_sut")
+def test_get_paths_pins_epoch(
+    api_url: str, addresses: List[Address], token_network_model: TokenNetwork
+):
+    """ Path requests are answered on a pinned state of the token network """
+    hex_addrs = [to_checksum_address(addr) for addr in addresses]
+    url = api_url + "/v1/" + to_checksum_address(token_network_model.address) + "/paths"
+
+    data = {"from": hex_addrs[0], "to": hex_addrs[2], "value": 10}
+    with patch.object(
+        TokenNetwork, "get_paths", autospec=True, side_effect=TokenNetwork.get_paths
+    ) as get_paths:
+        response = requests.post(url, json=data)
+    assert response.status_code == 200
+    snapshot = get_paths.call_args[1]["snapshot"]
+    assert snapshot.epoch == token_network_model.epoch
+
+    # Updates while the snapshot is in use start a new epoch
+    channel_id = token_network_model.G[addresses[0]][addresses[1]]["view"].channel_id
+    token_network_model.handle_channel_closed_event(channel_id)
+    assert token_network_model.epoch == snapshot.epoch + 1
+    assert snapshot.graph.has_edge(addresses[0], addresses[1])
+
+
+@pytest.mark.usefixtures("api_sut")
+def test_get_paths_batch(
+    api_url: str, addresses: List[Address], token_network_model: TokenNetwork
+):
+    hex_addrs = [to_checksum_address(addr) for addr in addresses]
+    url = api_url + "/v1/" + to_checksum_address(token_network_model.address) + "/paths/batch"
+
+    data = {
+        "requests": [
+            {"from": hex_addrs[0], "to": hex_addrs[2], "value": 10},
+            {"from": hex_addrs[0], "to": hex_addrs[5], "value": 10},  # no connection
+            {"from": hex_addrs[2], "to": hex_addrs[0], "value": 10, "max_paths": 1},
+        ]
+    }
+    response = requests.post(url, json=data)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 3
+
+    # Results match the ones of single requests
+    single_response = requests.post(url[: -len("/batch")], json=data["requests"][0])
+    assert results[0]["result"] == single_response.json()["result"]
+    assert results[0]["feedback_token"] != single_response.json()["feedback_token"]
+    assert results[1]["error_code"] == exceptions.NoRouteFound.error_code
+    assert [r["path"] for r in results[2]["result"]] == [[hex_addrs[2], hex_addrs[0]]]
+
+    # IOUs are given for the whole batch
+    data["requests"][0]["iou"] = {}
+    response = requests.post(url, json=data)
+    assert response.status_code == 400
+    assert response.json()["error_code"] == exceptions.InvalidRequest.error_code
+
+    # Empty batches are rejected
+    response = requests.post(url, json={"requests": []})
+    assert response.status_code == 400
+    assert response.json()["error_code"] == exceptions.InvalidRequest.error_code
+
+
+def test_get_paths_batch_budget(
+    api_sut: PFSApi, api_url: str, addresses: List[Address], token_network_model: TokenNetwork
+):
+    """ The requests of a batch share one budget and may be answered by the routing pool """
+    hex_addrs = [to_checksum_address(addr) for addr in addresses]
+    url = api_url + "/v1/" + to_checksum_address(token_network_model.address) + "/paths/batch"
+    data = {
+        "requests": [
+            {"from": hex_addrs[0], "to": hex_addrs[2], "value": 10},
+            {"from": hex_addrs[2], "to": hex_addrs[0], "value": 10},
+            {"from": hex_addrs[1], "to": hex_addrs[0], "value": 10},
+        ]
+    }
+    pathfinding_service = api_sut.pathfinding_service
+    pathfinding_service.path_search_budget = 5
+    # The budget is used up after the first request
+    with patch("pathfinding_service.api.monotonic", side_effect=[0.0, 1.0, 5.0, 6.0]):
+        response = requests.post(url, json=data)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert "result" in results[0]
+    assert [result.get("error_code") for result in results[1:]] == [
+        exceptions.PathSearchTimeout.error_code
+    ] * 2
+
+    pathfinding_service.path_search_budget = None
+    pathfinding_service.routing_pool = Mock()
+    pathfinding_service.routing_pool.get_paths.return_value = []
+    response = requests.post(url, json=data)
+    assert response.status_code == 200
+    assert pathfinding_service.routing_pool.get_paths.call_count == 3
+
+
+@pytest.mark.usefixtures("api_sut")
+def test_get_payment_split(
+    api_url: str, addresses: List[Address], token_network_model: TokenNetwork
+):
+    hex_addrs = [to_checksum_address(addr) for addr in addresses]
+    url = api_url + "/v1/" + to_checksum_address(token_network_model.address) + "/paths/split"
+
+    data = {"from": hex_addrs[2], "to": hex_addrs[1], "value": 100, "max_paths": 2}
+    response = requests.post(url, json=data)
+    assert response.status_code == 200
+    result = response.json()["result"]
+    assert [(r["path"], r["amount"]) for r in result] == [
+        ([hex_addrs[2], hex_addrs[0], hex_addrs[1]], 90),
+        ([hex_addrs[2], hex_addrs[1]], 10),
+    ]
+    assert all("estimated_fee" in r for r in result)
+    assert response.json()["feedback_token"]
+
+    data["max_paths"] = 1
+    response = requests.post(url, json=data)
+    assert response.status_code == 404
+    assert response.json()["error_code"] == exceptions.NoRouteFound.error_code
+
+    # The same checks as for path requests apply
+    response = requests.post(url, json=dict(data, to="0x" + "1" * 40))
+    assert response.status_code == 404
+    assert "Approximate block at the time of the request" in response.json()["errors"]
+
+    with patch.object(
+        TokenNetwork, "get_payment_split", side_effect=exceptions.PathSearchBudgetExceeded
+    ):
+        response = requests.post(url, json=data)
+    assert response.status_code == 503
+    assert response.json()["error_code"] == exceptions.PathSearchTimeout.error_code
+
+
 def test_payment_with_new_iou_rejected(  # pylint: disable=too-many-locals
     api_sut,
     api_url: str,
@@ -3,9 +3,13 @@ The tests in this module mock Capacity Updates and call on_capacity_update().
 
 The Capacity Updates show different correct and incorrect values to test all edge cases
 """
+from typing import List
+from unittest.mock import Mock, patch
+
 import pytest
 from eth_utils import decode_hex, to_canonical_address
 
+from pathfinding_service import metrics
 from pathfinding_service.exceptions import InvalidCapacityUpdate
 from pathfinding_service.model import TokenNetwork
 from pathfinding_service.service import DeferMessage, PathfindingService
@@ -23,6 +27,7 @@ from raiden.utils.typing import (
     TokenNetworkAddress,
 )
 from raiden_libs.utils import private_key_to_address
+from tests.utils import save_metrics_state
 
 DEFAULT_TOKEN_NETWORK_ADDRESS = TokenNetworkAddress(
     decode_hex("0x6e46B62a245D9EE7758B8DdCCDD1B85fF56B9Bc9")
@@ -309,3 +314,187 @@ def test_pfs_min_calculation_with_capacity_updates(
     # The capacities should be calculated out of the minimum of the two capacity updates
     assert view_to_partner.capacity == 90
     assert view_from_partner.capacity == 110
+
+
+def test_capacity_updates_handled_in_batch(pathfinding_service_web3_mock: PathfindingService):
+    """ The updates of one batch see each other and are persisted in one transaction """
+    service = pathfinding_service_web3_mock
+    service.database.upsert_token_network(DEFAULT_TOKEN_NETWORK_ADDRESS)
+    token_network = setup_channel(service)
+    messages = [
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_2_ADDRESS,
+            privkey_signer=PRIVATE_KEY_1,
+            updating_capacity=TA(90),
+            other_capacity=TA(110),
+        ),
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_2_ADDRESS,
+            other_participant=PRIVATE_KEY_1_ADDRESS,
+            privkey_signer=PRIVATE_KEY_2,
+            updating_capacity=TA(110),
+            other_capacity=TA(90),
+        ),
+        # Deferred, since the channel is unknown
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_3_ADDRESS,
+            channel_identifier=ChannelID(1),
+        ),
+    ]
+
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    statements: List[str] = []
+    service.database.conn.set_trace_callback(statements.append)
+    service.handle_messages(messages)
+    service.database.conn.set_trace_callback(None)
+    assert statements.count("BEGIN") == 1
+    assert metrics_state.get_delta("messages_batch_size_sum") == 3
+
+    view_to_partner, view_from_partner = token_network.get_channel_views_for_partner(
+        updating_participant=PRIVATE_KEY_1_ADDRESS, other_participant=PRIVATE_KEY_2_ADDRESS
+    )
+    assert view_to_partner.capacity == 90
+    assert view_from_partner.capacity == 110
+
+    assert (
+        service.database.get_capacity_updates(
+            updating_participant=PRIVATE_KEY_2_ADDRESS,
+            token_network_address=DEFAULT_TOKEN_NETWORK_ADDRESS,
+            channel_id=DEFAULT_CHANNEL_ID,
+        )
+        == (110, 90)
+    )
+    [channel] = service.database.get_channels()
+    assert (channel.capacity1, channel.capacity2) in [(90, 110), (110, 90)]
+    waiting_messages = service.database.pop_waiting_messages(
+        token_network_address=DEFAULT_TOKEN_NETWORK_ADDRESS, channel_id=ChannelID(1)
+    )
+    assert list(waiting_messages) == [messages[2]]
+
+
+def test_capacity_updates_published(pathfinding_service_web3_mock: PathfindingService):
+    """ The changes of a batch are published to the routing workers right away """
+    service = pathfinding_service_web3_mock
+    service.database.upsert_token_network(DEFAULT_TOKEN_NETWORK_ADDRESS)
+    setup_channel(service)
+    service.routing_pool = Mock()
+
+    service.handle_messages(
+        [
+            get_capacity_update_message(
+                updating_participant=PRIVATE_KEY_1_ADDRESS,
+                other_participant=PRIVATE_KEY_2_ADDRESS,
+            )
+        ]
+    )
+    service.routing_pool.publish.assert_called_once()
+
+
+def test_superseded_capacity_updates_dropped(pathfinding_service_web3_mock: PathfindingService):
+    """ Only the capacity update with the highest nonce of a batch is applied """
+    service = pathfinding_service_web3_mock
+    service.database.upsert_token_network(DEFAULT_TOKEN_NETWORK_ADDRESS)
+    token_network = setup_channel(service)
+
+    def update_from_p1(nonce: int, capacity: int, privkey_signer: bytes = PRIVATE_KEY_1):
+        return get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_2_ADDRESS,
+            privkey_signer=privkey_signer,
+            updating_nonce=Nonce(nonce),
+            updating_capacity=TA(capacity),
+            other_capacity=TA(110),
+        )
+
+    messages = [
+        update_from_p1(nonce=1, capacity=50),
+        update_from_p1(nonce=3, capacity=90),
+        update_from_p1(nonce=2, capacity=70),
+        # Not signed by P1, so it must not replace the valid updates
+        update_from_p1(nonce=5, capacity=1000, privkey_signer=PRIVATE_KEY_2),
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_2_ADDRESS,
+            other_participant=PRIVATE_KEY_1_ADDRESS,
+            privkey_signer=PRIVATE_KEY_2,
+            updating_capacity=TA(110),
+            other_capacity=TA(90),
+        ),
+    ]
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    with patch.object(
+        service, "on_capacity_update", wraps=service.on_capacity_update
+    ) as on_capacity_update:
+        service.handle_messages(messages)
+
+    assert on_capacity_update.call_count == 3
+    assert (
+        metrics_state.get_delta(
+            "messages_coalesced_total", labels={"message_type": "PFSCapacityUpdate"}
+        )
+        == 2
+    )
+    view_to_partner, view_from_partner = token_network.get_channel_views_for_partner(
+        updating_participant=PRIVATE_KEY_1_ADDRESS, other_participant=PRIVATE_KEY_2_ADDRESS
+    )
+    assert view_to_partner.capacity == 90
+    assert view_to_partner.update_nonce == 3
+    assert view_from_partner.capacity == 110
+
+
+def test_invalid_capacity_updates_not_coalesced(
+    pathfinding_service_web3_mock: PathfindingService,
+):
+    """ Invalid capacity updates with a higher nonce don't replace valid ones """
+    service = pathfinding_service_web3_mock
+    service.database.upsert_token_network(DEFAULT_TOKEN_NETWORK_ADDRESS)
+    token_network = setup_channel(service)
+
+    messages = [
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_2_ADDRESS,
+            updating_nonce=Nonce(1),
+            updating_capacity=TA(90),
+        ),
+        # Other participant is not part of the channel
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_3_ADDRESS,
+            updating_nonce=Nonce(2),
+            updating_capacity=TA(80),
+        ),
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_2_ADDRESS,
+            updating_nonce=Nonce(3),
+            updating_capacity=TA(UINT256_MAX + 1),
+        ),
+        get_capacity_update_message(
+            updating_participant=PRIVATE_KEY_1_ADDRESS,
+            other_participant=PRIVATE_KEY_2_ADDRESS,
+            chain_id=ChainID(1),
+            updating_nonce=Nonce(4),
+            updating_capacity=TA(70),
+        ),
+    ]
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    with patch.object(
+        service, "on_capacity_update", wraps=service.on_capacity_update
+    ) as on_capacity_update:
+        service.handle_messages(messages)
+
+    # The invalid updates are kept, so that they are rejected
+    assert on_capacity_update.call_count == 4
+    assert (
+        metrics_state.get_delta(
+            "messages_coalesced_total", labels={"message_type": "PFSCapacityUpdate"}
+        )
+        == 0
+    )
+    view_to_partner, _ = token_network.get_channel_views_for_partner(
+        updating_participant=PRIVATE_KEY_1_ADDRESS, other_participant=PRIVATE_KEY_2_ADDRESS
+    )
+    assert view_to_partner.capacity == 90
+    assert view_to_partner.update_nonce == 1
@@ -6,6 +6,8 @@ import pytest
 from click.testing import CliRunner
 
 from pathfinding_service.cli import main
+from pathfinding_service.constants import DEFAULT_CHANNEL_FLUSH_INTERVAL
+from pathfinding_service.model import RoutingEngine
 from raiden_contracts.constants import (
     CONTRACT_MONITORING_SERVICE,
     CONTRACT_ONE_TO_N,
@@ -116,6 +118,22 @@ def test_confirmations(default_cli_args):
         assert mocks["PathfindingService"].call_args[1]["required_confirmations"] == confirmations
 
 
+@pytest.mark.usefixtures("provider_mock")
+def test_routing_engine(default_cli_args):
+    """ The `routing-engine` parameter must reach the `PathfindingService` """
+    runner = CliRunner()
+    with patch.multiple(**PATCH_ARGS) as mocks, patch.multiple(**PATCH_INFO_ARGS):  # type: ignore
+        result = runner.invoke(main, default_cli_args, catch_exceptions=False)
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["routing_engine"] == RoutingEngine.NETWORKX
+
+        result = runner.invoke(
+            main, default_cli_args + ["--routing-engine", "native"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["routing_engine"] == RoutingEngine.NATIVE
+
+
 @pytest.mark.usefixtures("provider_mock")
 def test_shutdown(default_cli_args):
     """ Clean shutdown after KeyboardInterrupt """
@@ -144,3 +162,53 @@ def test_log_level(default_cli_args):
             # pytest already initializes logging, so basicConfig does not have
             # an effect. Use mocking to check that it's called properly.
             assert logging.getLevelName(basic_config.call_args[1]["level"] == log_level)
+
+
+@pytest.mark.usefixtures("provider_mock")
+def test_routing_workers(default_cli_args):
+    """ The `routing-workers` parameter must reach the `PathfindingService` """
+    runner = CliRunner()
+    with patch.multiple(**PATCH_ARGS) as mocks, patch.multiple(**PATCH_INFO_ARGS):  # type: ignore
+        result = runner.invoke(main, default_cli_args, catch_exceptions=False)
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["routing_workers"] == 0
+
+        result = runner.invoke(
+            main, default_cli_args + ["--routing-workers", "4"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["routing_workers"] == 4
+
+
+def test_path_search_budget(default_cli_args):
+    """ A `path-search-budget` of zero disables the limit """
+    runner = CliRunner()
+    with patch.multiple(**PATCH_ARGS) as mocks, patch.multiple(**PATCH_INFO_ARGS):  # type: ignore
+        result = runner.invoke(
+            main, default_cli_args + ["--path-search-budget", "0.5"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["path_search_budget"] == 0.5
+
+        result = runner.invoke(
+            main, default_cli_args + ["--path-search-budget", "0"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["path_search_budget"] is None
+
+
+def test_channel_flush_interval(default_cli_args):
+    runner = CliRunner()
+    with patch.multiple(**PATCH_ARGS) as mocks, patch.multiple(**PATCH_INFO_ARGS):  # type: ignore
+        result = runner.invoke(main, default_cli_args, catch_exceptions=False)
+        assert result.exit_code == 0
+        assert (
+            mocks["PathfindingService"].call_args[1]["channel_flush_interval"]
+            == DEFAULT_CHANNEL_FLUSH_INTERVAL
+        )
+
+        result = runner.invoke(
+            main, default_cli_args + ["--channel-flush-interval", "5"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert mocks["PathfindingService"].call_args[1]["channel_flush_interval"] == 5
@@ -1,12 +1,13 @@
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
+from unittest.mock import patch
 from uuid import uuid4
 
 from eth_utils import to_checksum_address
 
 from pathfinding_service.database import PFSDatabase
-from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.channel import Channel, FeeSchedule
 from pathfinding_service.model.feedback import FeedbackToken
 from raiden.constants import EMPTY_SIGNATURE
 from raiden.messages.path_finding_service import PFSCapacityUpdate, PFSFeeUpdate
@@ -20,10 +21,13 @@ from raiden.transfer.mediated_transfer.mediation_fee import FeeScheduleState
 from raiden.utils.signer import LocalSigner
 from raiden.utils.typing import (
     Address,
+    BlockNumber,
     BlockTimeout,
     ChainID,
     ChannelID,
+    FeeAmount,
     Nonce,
+    ProportionalFeeAmount,
     TokenAmount,
     TokenNetworkAddress,
 )
@@ -152,6 +156,27 @@ def test_feedback_stats(pathfinding_service_mock):
     assert database.get_num_routes_feedback(only_successful=True) == 1
 
 
+def test_most_requested_pairs(pathfinding_service_mock):
+    token_network_address = TokenNetworkAddress(b"1" * 20)
+    a, b, c, d = (Address(bytes([i]) * 20) for i in range(2, 6))
+    database = pathfinding_service_mock.database
+
+    # A request with multiple routes counts once
+    token = FeedbackToken(token_network_address)
+    database.prepare_feedback(token, [a, b], estimated_fee=0)
+    database.prepare_feedback(token, [a, c, b], estimated_fee=0)
+    database.prepare_feedback(FeedbackToken(token_network_address), [c, b], estimated_fee=0)
+    database.prepare_feedback(FeedbackToken(token_network_address), [c, d, b], estimated_fee=0)
+    database.prepare_feedback(FeedbackToken(TokenNetworkAddress(b"9" * 20)), [a, d], 0)
+
+    def get_pairs(limit=10, since=datetime.utcnow() - timedelta(minutes=1)):
+        return database.get_most_requested_pairs(token_network_address, limit, since)
+
+    assert get_pairs() == [(c, b), (a, b)]
+    assert get_pairs(limit=1) == [(c, b)]
+    assert get_pairs(since=datetime.utcnow() + timedelta(minutes=1)) == []
+
+
 def test_waiting_messages(pathfinding_service_mock):
     participant1_privkey, participant1 = make_privkey_address()
     token_network_address = TokenNetworkAddress(b"1" * 20)
@@ -213,6 +238,42 @@ def test_waiting_messages(pathfinding_service_mock):
         assert len(recovered_messages2) == 0
 
 
+def test_capacity_updates(tmp_path):
+    """ Capacity updates are read from memory and loaded from the db at startup """
+    token_network_address = TokenNetworkAddress(b"1" * 20)
+    participant1, participant2 = make_address(), make_address()
+    db_args = dict(
+        filename=str(tmp_path / "pfs.db"), chain_id=ChainID(61), pfs_address=make_address()
+    )
+    database = PFSDatabase(allow_create=True, **db_args)  # type: ignore
+    capacity_update = PFSCapacityUpdate(
+        canonical_identifier=CanonicalIdentifier(
+            chain_identifier=ChainID(61),
+            token_network_address=token_network_address,
+            channel_identifier=ChannelID(1),
+        ),
+        updating_participant=participant1,
+        other_participant=participant2,
+        updating_nonce=Nonce(1),
+        other_nonce=Nonce(1),
+        updating_capacity=TokenAmount(100),
+        other_capacity=TokenAmount(111),
+        reveal_timeout=BlockTimeout(50),
+        signature=EMPTY_SIGNATURE,
+    )
+    database.upsert_capacity_update(capacity_update)
+
+    statements: List[str] = []
+    database.conn.set_trace_callback(statements.append)
+    assert database.get_capacity_updates(participant1, token_network_address, 1) == (100, 111)
+    assert database.get_capacity_updates(participant2, token_network_address, 1) == (0, 0)
+    assert statements == []
+    database.conn.close()
+
+    database = PFSDatabase(**db_args)  # type: ignore
+    assert database.get_capacity_updates(participant1, token_network_address, 1) == (100, 111)
+
+
 def test_channels(pathfinding_service_mock):
     # Participants need to be ordered
     parts = sorted([make_address(), make_address(), make_address()])
@@ -256,6 +317,111 @@ def test_channels(pathfinding_service_mock):
     assert [chan.channel_id for chan in database.get_channels()] == [channel2.channel_id]
 
 
+def test_deferred_channel_updates(pathfinding_service_mock):
+    """Channel updates are written behind, but before the latest committed block.
+
+    The capacity updates which changed the channels are written with them.
+    """
+    parts = sorted([make_address(), make_address(), make_address()])
+    token_network_address = TokenNetworkAddress(b"1" * 20)
+    database = pathfinding_service_mock.database
+    database.upsert_token_network(token_network_address)
+    database.channel_flush_interval = 10
+    channels = [
+        Channel(
+            token_network_address=token_network_address,
+            channel_id=ChannelID(channel_id),
+            participant1=parts[channel_id],
+            participant2=parts[channel_id + 1],
+            settle_timeout=BlockTimeout(100),
+        )
+        for channel_id in range(2)
+    ]
+
+    capacity_update = PFSCapacityUpdate(
+        canonical_identifier=CanonicalIdentifier(
+            chain_identifier=ChainID(61),
+            token_network_address=token_network_address,
+            channel_identifier=ChannelID(0),
+        ),
+        updating_participant=parts[0],
+        other_participant=parts[1],
+        updating_nonce=Nonce(1),
+        other_nonce=Nonce(1),
+        updating_capacity=TokenAmount(100),
+        other_capacity=TokenAmount(111),
+        reveal_timeout=BlockTimeout(50),
+        signature=EMPTY_SIGNATURE,
+    )
+
+    def num_written_rows(table: str) -> int:
+        return database.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    database.index_capacity_update(capacity_update)
+    database.defer_channel_updates(channels, capacity_updates=[capacity_update])
+    assert num_written_rows("channel") == 0
+    assert num_written_rows("capacity_update") == 0
+    database.update_lastest_committed_block(BlockNumber(10))
+    assert num_written_rows("channel") == 2
+    assert num_written_rows("capacity_update") == 1
+
+    # Deleted channels are not written again
+    channels[0].capacity1 = TokenAmount(100)
+    database.defer_channel_updates(channels)
+    assert database.delete_channel(token_network_address, ChannelID(0))
+    database.flush_channels()
+    assert [channel.channel_id for channel in database.get_channels()] == [ChannelID(1)]
+
+    # Too many deferred channels are written immediately
+    with patch("pathfinding_service.database.CHANNEL_FLUSH_SIZE", 1):
+        database.defer_channel_updates(channels[1:])
+    assert not database._dirty_channels  # pylint: disable=protected-access
+
+
+def test_load_channels(pathfinding_service_mock):
+    """ The bulk loading of channels gives the same channels as `get_channels` """
+    parts = sorted([make_address(), make_address(), make_address()])
+    token_network_address = TokenNetworkAddress(b"1" * 20)
+    database = pathfinding_service_mock.database
+    database.upsert_token_network(token_network_address)
+    fee_schedule = FeeSchedule(
+        flat=FeeAmount(1),
+        proportional=ProportionalFeeAmount(2),
+        imbalance_penalty=[(TokenAmount(0), FeeAmount(10)), (TokenAmount(100), FeeAmount(0))],
+        timestamp=datetime(2020, 1, 1),
+    )
+    database.upsert_channels(
+        [
+            Channel(
+                token_network_address=token_network_address,
+                channel_id=ChannelID(1),
+                participant1=parts[0],
+                participant2=parts[1],
+                settle_timeout=BlockTimeout(100),
+                fee_schedule1=fee_schedule,
+                capacity1=TokenAmount(100),
+                capacity2=TokenAmount(2 ** 255),
+                update_nonce1=Nonce(3),
+                reveal_timeout2=BlockTimeout(20),
+            ),
+            Channel(
+                token_network_address=token_network_address,
+                channel_id=ChannelID(2 ** 200),
+                participant1=parts[1],
+                participant2=parts[2],
+                settle_timeout=BlockTimeout(100),
+            ),
+        ]
+    )
+
+    channels = list(database.load_channels())
+    assert [Channel.Schema().dump(channel) for channel in channels] == [
+        Channel.Schema().dump(channel) for channel in database.get_channels()
+    ]
+    # Participants of both channels are shared
+    assert channels[0].participant2 is channels[1].participant1
+
+
 def test_channel_constraints(pathfinding_service_mock):
     """ Regression test for https://github.com/raiden-network/raiden-services/issues/693"""
 
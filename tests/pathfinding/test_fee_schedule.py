@@ -5,6 +5,7 @@ from typing import List
 import pytest
 
 from pathfinding_service.model import ChannelView
+from pathfinding_service.model.fee_estimation import get_capped_fee
 from pathfinding_service.model.token_network import TokenNetwork
 from raiden.constants import EMPTY_SIGNATURE
 from raiden.messages.path_finding_service import PFSFeeUpdate
@@ -412,3 +413,78 @@ def test_fee_estimate(flat_fee, prop_fee_cli, max_lin_imbalance_fee, target_amou
     tn.set_fee(2, 1, flat=flat_fee, proportional=prop_fee, imbalance_penalty=imbalance_fee)
     tn.set_fee(2, 3, flat=flat_fee, proportional=prop_fee, imbalance_penalty=imbalance_fee)
     assert tn.estimate_fee(1, 3, value=PA(target_amount)) == expected_fee
+
+
+@pytest.mark.parametrize(
+    "fee_params",
+    [
+        dict(),
+        dict(flat=FA(10)),
+        dict(proportional=ProportionalFeeAmount(4_975)),
+        dict(flat=FA(100), proportional=ProportionalFeeAmount(200_000)),
+        dict(flat=FA(-10)),
+        dict(imbalance_penalty=[(TA(0), FA(0)), (TA(2000), FA(200))]),
+        dict(imbalance_penalty=[(TA(0), FA(200)), (TA(2000), FA(0))]),
+    ],
+)
+@pytest.mark.parametrize("amount", [PA(1), PA(100), PA(967), PA(999), PA(5_000)])
+def test_batch_fee_estimation(fee_params, amount):
+    """ The batched fee estimation must match the scalar calculation for all channel views """
+    tn = TokenNetworkForTests(
+        channels=[
+            dict(participant1=1, participant2=2),
+            dict(participant1=2, participant2=3, capacity1=0),
+            dict(participant1=3, participant2=4, capacity1=1000, capacity2=1500),
+        ]
+    )
+    views = list(tn.fee_estimator.views)
+
+    def check_fees():
+        expected_fees = [get_capped_fee(view, amount) for view in views]
+        assert tn.fee_estimator.get_fees(amount) == expected_fees
+
+    check_fees()
+
+    # Fee updates are applied to the sender and receiver schedules
+    tn.set_fee(2, 1, **fee_params)
+    tn.set_fee(3, 4, **fee_params)
+    check_fees()
+
+    # Capacity updates
+    view: ChannelView = tn.G[a(1)][a(2)]["view"]
+    view.capacity = TA(200)
+    tn.fee_estimator.update_view(view)
+    check_fees()
+
+    # Closed channels are removed
+    tn.handle_channel_closed_event(view.channel_id)
+    views = list(tn.fee_estimator.views)
+    assert len(views) == 4
+    check_fees()
+
+
+def test_fee_curve_cache():
+    """ Compiled fee curves are reused until the fee schedules or the capacity change """
+    tn = TokenNetworkForTests(channels=[dict(participant1=1, participant2=2)])
+    view: ChannelView = tn.G[a(1)][a(2)]["view"]
+    view_partner: ChannelView = tn.G[a(2)][a(1)]["view"]
+
+    fee_curve, fee_curve_partner = view.fee_curve, view_partner.fee_curve
+    assert view.fee_curve is fee_curve
+    assert view.fee_curve is not fee_curve_partner
+
+    # Fee updates change the sender schedule of one view and the receiver
+    # schedule of the other one
+    tn.set_fee(1, 2, flat=FA(5), imbalance_penalty=[(TA(0), FA(0)), (TA(2000), FA(200))])
+    assert view.fee_curve is not fee_curve
+    assert view_partner.fee_curve is not fee_curve_partner
+    for amount in [PA(1), PA(100), PA(999)]:
+        assert view.fee_curve.get_fee(amount) == get_capped_fee(view, amount)
+        assert view_partner.fee_curve.get_fee(amount) == get_capped_fee(view_partner, amount)
+
+    # Capacity updates only affect the updated view
+    fee_curve, fee_curve_partner = view.fee_curve, view_partner.fee_curve
+    view.update_capacity(capacity=TA(500))
+    assert view.fee_curve is not fee_curve
+    assert view_partner.fee_curve is fee_curve_partner
+    assert view.fee_curve.get_fee(PA(100)) == get_capped_fee(view, PA(100))
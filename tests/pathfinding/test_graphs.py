@@ -2,26 +2,40 @@ import random
 import time
 from copy import deepcopy
 from datetime import timedelta
-from typing import List
+from itertools import chain, islice, repeat
+from typing import List, Optional, Tuple
+from unittest.mock import patch
 
+import networkx as nx
 import pytest
 from eth_utils import to_canonical_address, to_checksum_address
 
+from pathfinding_service import metrics
 from pathfinding_service.constants import DIVERSITY_PEN_DEFAULT
-from pathfinding_service.model import ChannelView, TokenNetwork
+from pathfinding_service.exceptions import PathSearchBudgetExceeded
+from pathfinding_service.model import ChannelView, RoutingEngine, TokenNetwork
 from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.route_cache import value_bucket
+from pathfinding_service.model.shortest_paths import CompactGraph, shortest_simple_paths
+from pathfinding_service.model.token_network import Path, RoutingSnapshot
+from raiden.constants import EMPTY_SIGNATURE
+from raiden.messages.path_finding_service import PFSCapacityUpdate
 from raiden.network.transport.matrix import AddressReachability
+from raiden.transfer.identifiers import CanonicalIdentifier
 from raiden.utils.typing import (
     Address,
     BlockTimeout,
+    ChainID,
     ChannelID,
     FeeAmount,
+    Nonce,
     PaymentAmount,
     ProportionalFeeAmount,
     TokenAmount,
     TokenNetworkAddress,
 )
 from tests.pathfinding.utils import SimpleReachabilityContainer
+from tests.utils import save_metrics_state
 
 
 def test_edge_weight(addresses):
@@ -105,12 +119,15 @@ def test_edge_weight(addresses):
     )
 
 
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
 @pytest.mark.usefixtures("populate_token_network_case_1")
 def test_routing_simple(
     token_network_model: TokenNetwork,
     reachability_state: SimpleReachabilityContainer,
     addresses: List[Address],
+    routing_engine: RoutingEngine,
 ):
+    token_network_model.routing_engine = routing_engine
     hex_addrs = [to_checksum_address(addr) for addr in addresses]
     view01: ChannelView = token_network_model.G[addresses[0]][addresses[1]]["view"]
     view10: ChannelView = token_network_model.G[addresses[1]][addresses[0]]["view"]
@@ -142,6 +159,190 @@ def test_routing_simple(
     assert [] == no_paths
 
 
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_routing_max_hops(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    token_network_model.routing_engine = routing_engine
+
+    def get_paths(max_hops):
+        paths = token_network_model.get_paths(
+            source=addresses[0],
+            target=addresses[4],
+            value=PaymentAmount(10),
+            max_paths=2,
+            reachability_state=reachability_state,
+            max_hops=max_hops,
+        )
+        return [path.nodes for path in paths]
+
+    assert get_paths(max_hops=None) == [
+        [addresses[0], addresses[1], addresses[4]],
+        [addresses[0], addresses[1], addresses[2], addresses[3], addresses[4]],
+    ]
+    assert get_paths(max_hops=3) == [[addresses[0], addresses[1], addresses[4]]]
+    assert get_paths(max_hops=1) == []
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+def test_routing_max_hops_many_long_paths(routing_engine: RoutingEngine):
+    """ Hop limited searches don't enumerate the paths which are too long """
+    size = 8
+    grid = [[Address(bytes([row, column]) * 10) for column in range(size)] for row in range(size)]
+    token_network = TokenNetwork(
+        token_network_address=TokenNetworkAddress(bytes([1] * 20)), routing_engine=routing_engine
+    )
+    neighbours = [
+        (grid[row][column], grid[row][column + 1])
+        for row in range(size)
+        for column in range(size - 1)
+    ] + [
+        (grid[row][column], grid[row + 1][column])
+        for row in range(size - 1)
+        for column in range(size)
+    ]
+    for channel_id, (participant1, participant2) in enumerate(neighbours):
+        channel = token_network.handle_channel_opened_event(
+            channel_identifier=ChannelID(channel_id),
+            participant1=participant1,
+            participant2=participant2,
+            settle_timeout=BlockTimeout(1000),
+        )
+        channel.capacity1 = channel.capacity2 = TokenAmount(100)
+    reachability_state = SimpleReachabilityContainer(
+        {node: AddressReachability.REACHABLE for row in grid for node in row}
+    )
+
+    # Only one path has two channels, but there is a huge number of longer paths
+    paths = token_network.get_paths(
+        source=grid[0][0],
+        target=grid[0][2],
+        value=PaymentAmount(10),
+        max_paths=3,
+        reachability_state=reachability_state,
+        max_hops=2,
+    )
+    assert [path.nodes for path in paths] == [[grid[0][0], grid[0][1], grid[0][2]]]
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_path_request_metrics(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    paths = token_network_model.get_paths(
+        source=addresses[0],
+        target=addresses[4],
+        value=PaymentAmount(10),
+        max_paths=2,
+        reachability_state=reachability_state,
+    )
+    assert len(paths) == 2
+
+    # Each phase is observed once per request
+    for phase in ("pruning", "weights", "search", "fees", "matrix_users"):
+        assert (
+            metrics_state.get_delta(
+                "path_requests_phase_duration_seconds_count",
+                labels={"path_request_phase": phase},
+            )
+            == 1
+        )
+    assert (
+        metrics_state.get_delta(
+            "path_requests_candidates_total", labels={"path_candidate": "valid"}
+        )
+        == 2
+    )
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_path_search_budget(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    def get_paths():
+        return token_network_model.get_paths(
+            source=addresses[0],
+            target=addresses[4],
+            value=PaymentAmount(10),
+            max_paths=2,
+            reachability_state=reachability_state,
+            time_budget=1,
+        )
+
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    # The time runs out after the first path has been found
+    clock = chain([0.0, 0.5], repeat(2.0))
+    with patch("pathfinding_service.model.token_network.monotonic", side_effect=clock):
+        paths = get_paths()
+    assert [path.nodes for path in paths] == [[addresses[0], addresses[1], addresses[4]]]
+    assert metrics_state.get_delta("path_searches_truncated_total") == 1
+    # Truncated results are not cached
+    assert len(token_network_model.route_cache) == 0
+
+    # Without any path found, the search fails
+    clock = chain([0.0], repeat(2.0))
+    with patch("pathfinding_service.model.token_network.monotonic", side_effect=clock):
+        with pytest.raises(PathSearchBudgetExceeded):
+            get_paths()
+    assert metrics_state.get_delta("path_searches_truncated_total") == 2
+
+    # Searches within the budget return all paths
+    assert len(get_paths()) == 2
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_path_search_budget_during_search(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ The budget is enforced while generating candidates, not only when checking them """
+    token_network_model.routing_engine = RoutingEngine.NATIVE
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    # Candidates are always checked in time, but the engine runs out of time
+    # when searching for deviations from the first path.
+    with patch("pathfinding_service.model.token_network.monotonic", return_value=0.0), patch(
+        "pathfinding_service.model.shortest_paths.monotonic", return_value=2.0
+    ), patch.object(
+        TokenNetwork, "_check_candidate", side_effect=TokenNetwork._check_candidate
+    ) as check_candidate:
+        paths = token_network_model.get_paths(
+            source=addresses[0],
+            target=addresses[4],
+            value=PaymentAmount(10),
+            max_paths=2,
+            reachability_state=reachability_state,
+            time_budget=1,
+        )
+    assert [path.nodes for path in paths] == [[addresses[0], addresses[1], addresses[4]]]
+    # The first path and its repetition by the search for the second one
+    assert check_candidate.call_count == 2
+    assert metrics_state.get_delta("path_searches_truncated_total") == 1
+
+    # The native searches can be stopped by themselves
+    graph = CompactGraph(token_network_model.G)
+    search = shortest_simple_paths(
+        graph=graph,
+        source=graph.node_ids[addresses[0]],
+        target=graph.node_ids[addresses[4]],
+        weight=lambda edge: 1.0,
+        enabled_nodes=bytearray([True]) * len(graph),
+        deadline=time.monotonic() - 1,
+    )
+    assert next(search)
+    with pytest.raises(PathSearchBudgetExceeded):
+        next(search)
+
+
 @pytest.mark.usefixtures("populate_token_network_case_1")
 def test_capacity_check(
     token_network_model: TokenNetwork,
@@ -226,13 +427,16 @@ def get_paths(  # pylint: disable=too-many-arguments
     return index_paths
 
 
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
 @pytest.mark.usefixtures("populate_token_network_case_3")
 def test_diversity_penalty(
     token_network_model: TokenNetwork,
     reachability_state: SimpleReachabilityContainer,
     addresses: List[Address],
+    routing_engine: RoutingEngine,
 ):
     """ Check changes in routing when increasing diversity penalty """
+    token_network_model.routing_engine = routing_engine
 
     assert get_paths(
         token_network_model=token_network_model,
@@ -314,12 +518,15 @@ def test_reachability_initiator(
     )
 
 
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
 @pytest.mark.usefixtures("populate_token_network_case_3")
 def test_reachability_mediator(
     token_network_model: TokenNetwork,
     reachability_state: SimpleReachabilityContainer,
     addresses: List[Address],
+    routing_engine: RoutingEngine,
 ):
+    token_network_model.routing_engine = routing_engine
 
     assert get_paths(
         token_network_model=token_network_model,
@@ -393,6 +600,161 @@ def test_reachability_target(
     )
 
 
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_3")
+def test_lazy_edge_weights(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ Fee based edge weights are only calculated once per edge and request """
+    token_network_model.routing_engine = routing_engine
+    with patch.object(
+        TokenNetwork, "fee_and_refund_weights", wraps=TokenNetwork.fee_and_refund_weights
+    ) as fee_and_refund_weights:
+        paths = get_paths(token_network_model, reachability_state, addresses, max_paths=5)
+        assert len(paths) == 5
+
+    calculated_edges = [
+        (call[1]["view"].participant1, call[1]["view"].participant2)
+        for call in fee_and_refund_weights.call_args_list
+    ]
+    assert len(calculated_edges) == len(set(calculated_edges))
+    assert len(calculated_edges) <= token_network_model.G.number_of_edges()
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_3")
+def test_lazy_fee_estimate(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ The fees of all channel views are only estimated at once for batches and large searches """
+    token_network_model.routing_engine = routing_engine
+    fee_estimator = token_network_model.fee_estimator
+
+    def find_paths(min_share: float, batch: bool = False) -> Tuple[List, int]:
+        snapshot = RoutingSnapshot(token_network_model, reachability_state, batch=batch)
+        with patch(
+            "pathfinding_service.model.token_network.FEE_ESTIMATE_MIN_SHARE", min_share
+        ), patch.object(fee_estimator, "estimate", wraps=fee_estimator.estimate) as estimate:
+            paths = token_network_model.get_paths(
+                source=addresses[0],
+                target=addresses[8],
+                value=PaymentAmount(10),
+                max_paths=5,
+                reachability_state=reachability_state,
+                snapshot=snapshot,
+            )
+        return [path.nodes for path in paths], estimate.call_count
+
+    # Single requests calculate the fees of the used edges only
+    lazy_paths, estimates = find_paths(min_share=1.0)
+    assert len(lazy_paths) == 5
+    assert estimates == 0
+
+    # Searches which weigh many edges switch to the batched estimate
+    assert find_paths(min_share=0.0) == (lazy_paths, 1)
+
+    # Batches estimate all fees up front
+    assert find_paths(min_share=1.0, batch=True) == (lazy_paths, 1)
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_3")
+def test_reachability_tracked(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ Reachability changes must be applied to the live view of reachable channels """
+    token_network_model.routing_engine = routing_engine
+    token_network_model.track_reachability(reachability_state)
+    assert len(get_paths(token_network_model, reachability_state, addresses)) == 5
+
+    reachability_state.reachabilities[addresses[7]] = AddressReachability.UNREACHABLE
+    token_network_model.handle_address_reachability_change(
+        addresses[7], AddressReachability.UNREACHABLE
+    )
+    assert get_paths(token_network_model, reachability_state, addresses) == [
+        [0, 1, 2, 3, 4, 8],
+    ]
+
+    reachability_state.reachabilities[addresses[7]] = AddressReachability.REACHABLE
+    token_network_model.handle_address_reachability_change(
+        addresses[7], AddressReachability.REACHABLE
+    )
+    assert len(get_paths(token_network_model, reachability_state, addresses)) == 5
+
+
+@pytest.mark.usefixtures("populate_token_network_random")
+def test_native_shortest_simple_paths(token_network_model: TokenNetwork):
+    """ The native engine must yield paths in the same order of lengths as networkx """
+    random.seed(1)
+    G = token_network_model.G
+    for node1, node2 in G.edges:
+        G[node1][node2]["weight"] = random.choice([1, 1.5, 2, 3.25])
+
+    compact_graph = CompactGraph(G)
+    assert len(compact_graph) == G.number_of_nodes()
+    assert compact_graph.number_of_edges == G.number_of_edges()
+    weights = [
+        G[compact_graph.addresses[node1]][compact_graph.addresses[node2]]["weight"]
+        for node1, node2 in zip(compact_graph.sources, compact_graph.targets)
+    ]
+    enabled_nodes = bytearray([1] * len(compact_graph))
+
+    def path_length(path: List[Address]) -> float:
+        return sum(G[node1][node2]["weight"] for node1, node2 in zip(path[:-1], path[1:]))
+
+    for _ in range(20):
+        source, target = random.sample(sorted(G.nodes), 2)
+        try:
+            expected = [
+                path_length(p)
+                for p in islice(nx.shortest_simple_paths(G, source, target, "weight"), 10)
+            ]
+        except nx.NetworkXNoPath:
+            expected = []
+        native_paths = shortest_simple_paths(
+            graph=compact_graph,
+            source=compact_graph.node_ids[source],
+            target=compact_graph.node_ids[target],
+            weight=weights.__getitem__,
+            enabled_nodes=enabled_nodes,
+        )
+        lengths = [
+            path_length([compact_graph.addresses[node] for node in path])
+            for path in islice(native_paths, 10)
+        ]
+        assert lengths == pytest.approx(expected)
+
+
+@pytest.mark.usefixtures("populate_token_network_random")
+def test_landmark_hop_bounds(token_network_model: TokenNetwork):
+    """ The landmark bounds never exceed the number of hops between two nodes """
+    random.seed(1)
+    G = token_network_model.G
+    compact_graph = CompactGraph(G)
+    landmarks = compact_graph.landmarks
+    assert landmarks.distances
+
+    for target in random.sample(sorted(G.nodes), 5):
+        hop_bound = landmarks.hop_bound(compact_graph.node_ids[target])
+        hops = nx.single_source_shortest_path_length(G.reverse(copy=False), target)
+        for node in G.nodes:
+            bound = hop_bound(compact_graph.node_ids[node])
+            if node in hops:
+                assert bound is not None and bound <= hops[node]
+            else:
+                assert bound is None or bound == 0
+        assert hop_bound(compact_graph.node_ids[target]) == 0
+
+
 @pytest.mark.skip("Just run it locally for now")
 @pytest.mark.usefixtures("populate_token_network_random")
 def test_routing_benchmark(token_network_model: TokenNetwork):  # pylint: disable=too-many-locals
@@ -452,7 +814,9 @@ def test_suggest_partner(
     reachability = SimpleReachabilityContainer(
         {a[i]: AddressReachability.REACHABLE for i in range(3)}
     )
+    # The centralities are calculated on demand before the first update
     suggestions = token_network_model.suggest_partner(reachability)
+    assert token_network_model.centrality_version == token_network_model.topology_version
     assert len(suggestions) == 3
     assert set(s["address"] for s in suggestions) == set(
         to_checksum_address(a[i]) for i in range(3)
@@ -463,3 +827,289 @@ def test_suggest_partner(
     reachability.times[a[0]] -= timedelta(seconds=10)
     suggestions = token_network_model.suggest_partner(reachability)
     assert suggestions[0]["address"] == to_checksum_address(a[0])
+
+
+@pytest.mark.usefixtures("populate_token_network_case_2")
+def test_centrality_update(token_network_model: TokenNetwork, addresses: List[Address]):
+    """ Centralities are calculated in steps on the topology at the start of the update """
+    graph = token_network_model.G.copy()
+    update = token_network_model.iter_centrality_update()
+    next(update)
+    assert token_network_model.centrality == {}
+
+    # Opening a channel during the calculation doesn't restart it
+    token_network_model.handle_channel_opened_event(
+        channel_identifier=ChannelID(100),
+        participant1=addresses[0],
+        participant2=addresses[6],
+        settle_timeout=BlockTimeout(15),
+    )
+    assert len(list(update)) == len(graph) - 1
+    assert token_network_model.centrality == nx.closeness_centrality(graph)
+
+    # The next update takes the new channel into account
+    assert len(list(token_network_model.iter_centrality_update())) == len(token_network_model.G)
+    assert token_network_model.centrality == nx.closeness_centrality(token_network_model.G)
+
+    # Nothing to do without topology changes
+    assert list(token_network_model.iter_centrality_update()) == []
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_insufficient_capacity_not_searched(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ Channels with less capacity than the payment value are not used by the search """
+    token_network_model.routing_engine = routing_engine
+    value = PaymentAmount(10)
+    with patch("pathfinding_service.model.token_network.Path", wraps=Path) as path_mock:
+        paths = token_network_model.get_paths(
+            source=addresses[0],
+            target=addresses[3],
+            value=value,
+            max_paths=5,
+            reachability_state=reachability_state,
+        )
+    assert paths
+
+    # 0->2->3 is the shortest path, but has no capacity and must not be generated
+    searched_paths = [call[0][1] for call in path_mock.call_args_list]
+    assert [addresses[0], addresses[2], addresses[3]] not in searched_paths
+    for nodes in searched_paths:
+        for node1, node2 in zip(nodes[:-1], nodes[1:]):
+            assert token_network_model.G[node1][node2]["view"].capacity >= value
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_search_confined_to_component(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ Paths are only searched within the connected component of the source """
+    token_network_model.routing_engine = routing_engine
+    with patch.object(TokenNetwork, "_find_paths", autospec=True) as find_paths:
+        paths = get_paths(token_network_model, reachability_state, addresses, target_index=5)
+    assert paths == []
+    assert not find_paths.called
+
+    component = token_network_model.connectivity.component(addresses[0])
+    assert component == set(addresses[:5])
+    snapshot = RoutingSnapshot(token_network_model, reachability_state, nodes=component)
+    if snapshot.compact_graph is not None:
+        enabled = {
+            address
+            for address, is_enabled in zip(
+                snapshot.compact_graph.addresses, snapshot.enabled_nodes
+            )
+            if is_enabled
+        }
+    else:
+        assert snapshot.pruned_graph is not None
+        enabled = set(snapshot.pruned_graph.nodes)
+    assert enabled <= component
+    assert addresses[0] in enabled
+
+    assert get_paths(token_network_model, reachability_state, addresses, target_index=4)
+
+
+@pytest.mark.usefixtures("populate_token_network_case_3")
+def test_route_cache(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ Repeated path requests are answered from the cache until a channel changes """
+    assert value_bucket(PaymentAmount(5)) == 5
+    assert value_bucket(PaymentAmount(1234)) == 1200
+
+    token_network_model.track_reachability(reachability_state)
+    with patch.object(
+        TokenNetwork, "_find_paths", autospec=True, side_effect=TokenNetwork._find_paths
+    ) as find_paths:
+        paths = get_paths(token_network_model, reachability_state, addresses, max_paths=1)
+        assert paths == [[0, 7, 8]]
+        assert get_paths(token_network_model, reachability_state, addresses, max_paths=1) == paths
+        assert find_paths.call_count == 1
+
+        # Other parameters are cached separately
+        get_paths(token_network_model, reachability_state, addresses, max_paths=2)
+        assert find_paths.call_count == 2
+
+        # Channels opened between other nodes keep the cached result
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(100),
+            participant1=addresses[2],
+            participant2=addresses[9],
+            settle_timeout=BlockTimeout(15),
+        )
+        get_paths(token_network_model, reachability_state, addresses, max_paths=1)
+        assert find_paths.call_count == 2
+
+        # Channels opened by a node on the path invalidate it
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(101),
+            participant1=addresses[1],
+            participant2=addresses[7],
+            settle_timeout=BlockTimeout(15),
+        )
+        get_paths(token_network_model, reachability_state, addresses, max_paths=1)
+        assert find_paths.call_count == 3
+
+        # Closing a channel on the path invalidates the cached result
+        channel_id = token_network_model.G[addresses[7]][addresses[8]]["view"].channel_id
+        token_network_model.handle_channel_closed_event(channel_id)
+        assert channel_id not in token_network_model.route_cache.channel_versions
+        paths = get_paths(token_network_model, reachability_state, addresses, max_paths=1)
+        assert paths == [[0, 7, 6, 8]]
+        assert find_paths.call_count == 4
+
+    # Requests without the tracked reachability state don't use the cache
+    assert len(token_network_model.route_cache) == 2
+    get_paths(
+        token_network_model, deepcopy(reachability_state), addresses, value=PaymentAmount(20)
+    )
+    assert len(token_network_model.route_cache) == 2
+
+
+@pytest.mark.usefixtures("populate_token_network_case_3")
+def test_route_cache_warmup(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ Routes for the most requested values are precomputed """
+    pairs = [(addresses[0], addresses[8])]
+    # Nothing to do without a tracked reachability state
+    assert list(token_network_model.iter_route_cache_warmup(pairs, 1, max_paths=1)) == []
+
+    token_network_model.track_reachability(reachability_state)
+    for value in (10, 10, 1234):
+        token_network_model.record_path_request(PaymentAmount(value))
+    assert token_network_model.requested_values == {10: 2, 1200: 1}
+
+    with patch.object(
+        TokenNetwork, "_find_paths", autospec=True, side_effect=TokenNetwork._find_paths
+    ) as find_paths:
+        warmup = token_network_model.iter_route_cache_warmup(pairs, num_values=1, max_paths=1)
+        assert len(list(warmup)) == 1
+        assert find_paths.call_count == 1
+        assert find_paths.call_args[1]["value"] == 10
+
+        paths = get_paths(token_network_model, reachability_state, addresses, max_paths=1)
+        assert paths == [[0, 7, 8]]
+        assert find_paths.call_count == 1
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_payment_split(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ Payments exceeding the capacity of single paths are split over distinct channels """
+
+    def get_split(value: int, max_paths: int) -> Optional[List[Tuple[List[int], int]]]:
+        paths = token_network_model.get_payment_split(
+            source=addresses[2],
+            target=addresses[1],
+            value=PaymentAmount(value),
+            max_paths=max_paths,
+            reachability_state=reachability_state,
+        )
+        if paths is None:
+            return None
+        return [([addresses.index(node) for node in path.nodes], path.value) for path in paths]
+
+    assert get_split(10, max_paths=2) == [([2, 1], 10)]
+    # The direct channel can carry 40 tokens, the path over node 0 up to 90 tokens
+    assert get_split(100, max_paths=1) is None
+    assert get_split(100, max_paths=2) == [([2, 0, 1], 90), ([2, 1], 10)]
+    assert get_split(130, max_paths=3) == [([2, 0, 1], 90), ([2, 1], 40)]
+    assert get_split(131, max_paths=3) is None
+
+    # A partial split is of no use, so running out of time is an error
+    metrics_state = save_metrics_state(metrics.REGISTRY)
+    with patch("pathfinding_service.model.token_network.monotonic", return_value=0.0), patch(
+        "pathfinding_service.model.shortest_paths.monotonic", return_value=2.0
+    ), pytest.raises(PathSearchBudgetExceeded):
+        token_network_model.get_payment_split(
+            source=addresses[2],
+            target=addresses[1],
+            value=PaymentAmount(100),
+            max_paths=2,
+            reachability_state=reachability_state,
+            time_budget=1,
+        )
+    assert metrics_state.get_delta("path_searches_truncated_total") == 1
+
+
+@pytest.mark.parametrize("routing_engine", list(RoutingEngine))
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_routing_snapshot_epoch(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    routing_engine: RoutingEngine,
+):
+    """ Updates of the token network are not visible to pinned routing snapshots """
+    token_network_model.routing_engine = routing_engine
+    old_view = token_network_model.G[addresses[0]][addresses[1]]["view"]
+    snapshot = RoutingSnapshot(token_network_model, reachability_state)
+
+    # Use up the capacity of the only usable channel from 0
+    token_network_model.handle_channel_balance_update_message(
+        PFSCapacityUpdate(
+            canonical_identifier=CanonicalIdentifier(
+                chain_identifier=ChainID(61),
+                channel_identifier=ChannelID(0),
+                token_network_address=token_network_model.address,
+            ),
+            updating_participant=addresses[0],
+            other_participant=addresses[1],
+            updating_nonce=Nonce(3),
+            other_nonce=Nonce(3),
+            updating_capacity=TokenAmount(0),
+            other_capacity=TokenAmount(60),
+            reveal_timeout=BlockTimeout(2),
+            signature=EMPTY_SIGNATURE,
+        ),
+        updating_capacity_partner=TokenAmount(60),
+        other_capacity_partner=TokenAmount(0),
+    )
+    assert token_network_model.epoch == snapshot.epoch + 1
+    assert token_network_model.G[addresses[0]][addresses[1]]["view"].capacity == 0
+    assert old_view.capacity == 90
+    assert snapshot.graph[addresses[0]][addresses[1]]["view"] is old_view
+    # Only the updated channel has been copied
+    assert (
+        token_network_model.G[addresses[1]][addresses[2]]["view"]
+        is snapshot.graph[addresses[1]][addresses[2]]["view"]
+    )
+    assert snapshot.fee_estimate(PaymentAmount(10))[old_view] is not None
+
+    def get_paths_0_to_2(**kwargs) -> List:
+        paths = token_network_model.get_paths(
+            source=addresses[0],
+            target=addresses[2],
+            value=PaymentAmount(10),
+            max_paths=1,
+            reachability_state=reachability_state,
+            **kwargs,
+        )
+        return [addresses_to_indexes(p.nodes, addresses) for p in paths]
+
+    assert get_paths_0_to_2(snapshot=snapshot) == [[0, 1, 2]]
+    assert get_paths_0_to_2() == []
+
+    # Without newly pinned snapshots, the state is modified in place
+    graph = token_network_model.G
+    token_network_model.handle_channel_closed_event(ChannelID(1))
+    assert token_network_model.G is graph
+    assert token_network_model.epoch == snapshot.epoch + 1
@@ -0,0 +1,164 @@
+import os
+import pickle
+from typing import List
+from unittest.mock import patch
+
+import pytest
+
+from pathfinding_service.model import TokenNetwork
+from pathfinding_service.routing_pool import (
+    NetworkSnapshot,
+    PathResult,
+    ReachabilitySnapshot,
+    RoutingPool,
+    find_paths,
+    load_token_network,
+    update_path,
+    write_snapshot,
+)
+from raiden.network.transport.matrix import AddressReachability
+from raiden.utils.typing import Address, ChannelID, PaymentAmount
+from tests.pathfinding.utils import SimpleReachabilityContainer
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_channel_pickling(token_network_model: TokenNetwork, addresses: List[Address]):
+    """ Compiled fee curves are not pickled, since path searches may add them meanwhile """
+    view = token_network_model.G[addresses[0]][addresses[1]]["view"]
+    assert view.fee_curve.get_fee(PaymentAmount(10)) is not None
+    assert view.channel.fee_curves
+
+    channel = pickle.loads(pickle.dumps(view.channel))
+    assert channel.fee_curves == {}
+    assert channel.views[view.reverse].capacity == view.capacity
+    assert channel.fee_schedule1 == view.channel.fee_schedule1
+
+
+@pytest.mark.usefixtures("populate_token_network_case_2")
+def test_snapshot_paths(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+    tmp_path,
+):
+    """ Paths found on a published snapshot equal the ones of the token network """
+    snapshot_path = str(tmp_path / "snapshot")
+    request = dict(
+        source=addresses[0],
+        target=addresses[4],
+        value=PaymentAmount(10),
+        max_paths=3,
+        diversity_penalty=5,
+        fee_penalty=100,
+    )
+
+    def expected_paths() -> List[PathResult]:
+        return [
+            PathResult.from_path(path)
+            for path in token_network_model.get_paths(
+                reachability_state=reachability_state, **request  # type: ignore
+            )
+        ]
+
+    write_snapshot(
+        snapshot_path, NetworkSnapshot.from_token_network(token_network_model, reachability_state)
+    )
+    paths = find_paths(snapshot_path, **request)  # type: ignore
+    assert paths == expected_paths()
+    assert len(paths) > 1
+
+    # Workers reload replaced snapshots
+    token_network_model.handle_channel_closed_event(ChannelID(1))
+    write_snapshot(
+        snapshot_path, NetworkSnapshot.from_token_network(token_network_model, reachability_state)
+    )
+    assert find_paths(snapshot_path, **request) == expected_paths()  # type: ignore
+
+
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_routing_pool(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ The routing pool answers requests only for published token networks """
+    routing_pool = RoutingPool(num_workers=1)
+    try:
+        assert not routing_pool.is_published(token_network_model.address)
+        routing_pool.publish([token_network_model], reachability_state)
+        assert routing_pool.is_published(token_network_model.address)
+
+        paths = routing_pool.get_paths(
+            token_network_address=token_network_model.address,
+            source=addresses[0],
+            target=addresses[2],
+            value=PaymentAmount(10),
+            max_paths=1,
+        )
+        assert [path.nodes for path in paths] == [[addresses[0], addresses[1], addresses[2]]]
+    finally:
+        routing_pool.stop()
+
+
+@pytest.mark.usefixtures("populate_token_network_case_2")
+def test_routing_updates(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ Changes are published as updates, which are applied without rebuilding the network """
+    token_network_model.track_reachability(reachability_state)
+    request = dict(
+        source=addresses[0],
+        target=addresses[4],
+        value=PaymentAmount(10),
+        max_paths=3,
+        diversity_penalty=5,
+        fee_penalty=100,
+    )
+
+    def expected_paths() -> List[PathResult]:
+        return [
+            PathResult.from_path(path)
+            for path in token_network_model.get_paths(
+                reachability_state=reachability_state, **request  # type: ignore
+            )
+        ]
+
+    routing_pool = RoutingPool(num_workers=1)
+    try:
+        routing_pool.publish([token_network_model], reachability_state)
+        snapshot_path = routing_pool.snapshot_path(token_network_model.address)
+        worker_network = load_token_network(snapshot_path)
+        assert not os.path.exists(update_path(snapshot_path))
+
+        token_network_model.handle_channel_closed_event(ChannelID(1))
+        reachability_state.reachabilities[addresses[5]] = AddressReachability.UNKNOWN
+        token_network_model.handle_address_reachability_change(
+            addresses[5], AddressReachability.UNKNOWN
+        )
+        with patch("pathfinding_service.routing_pool.ROUTING_MAX_UPDATE_SHARE", 1):
+            routing_pool.publish([token_network_model], reachability_state)
+        assert os.path.exists(update_path(snapshot_path))
+        assert load_token_network(snapshot_path) is worker_network
+        # The presences of unreachable nodes are dropped
+        worker_reachability = worker_network.tracked_reachability_state
+        assert isinstance(worker_reachability, ReachabilitySnapshot)
+        assert not set(worker_reachability.presences) & set(
+            reachability_state.get_userids_for_address(addresses[5])
+        )
+        assert find_paths(snapshot_path, **request) == expected_paths()  # type: ignore
+        assert len(expected_paths()) == 1
+
+        # Too many changes are published as a new snapshot
+        reachability_state.reachabilities[addresses[5]] = AddressReachability.REACHABLE
+        token_network_model.handle_address_reachability_change(
+            addresses[5], AddressReachability.REACHABLE
+        )
+        with patch("pathfinding_service.routing_pool.ROUTING_MAX_UPDATE_SHARE", 0):
+            routing_pool.publish([token_network_model], reachability_state)
+        assert load_token_network(snapshot_path) is not worker_network
+        assert find_paths(snapshot_path, **request) == expected_paths()  # type: ignore
+        assert len(expected_paths()) == 2
+    finally:
+        routing_pool.stop()
@@ -1,8 +1,15 @@
+import random
+import tracemalloc
+from itertools import combinations
 from typing import List
+from unittest.mock import patch
 
+import pytest
 from networkx import DiGraph
 
 from pathfinding_service.model import TokenNetwork
+from pathfinding_service.model.channel import Channel
+from pathfinding_service.model.graph import CopyOnWriteDiGraph
 from pathfinding_service.model.token_network import Path, prune_graph
 from raiden.network.transport.matrix import AddressReachability
 from raiden.tests.utils.factories import make_address
@@ -58,6 +65,97 @@ def test_tn_multiple_channels_for_two_participants_opened(
     assert len(token_network_model.channel_id_to_addresses) == 1
 
 
+def test_tn_shares_participant_addresses(
+    token_network_model: TokenNetwork, addresses: List[Address]
+):
+    """ Channels of the same node share one address object """
+    channels = [
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(channel_id),
+            participant1=Address(bytes(bytearray(addresses[0]))),
+            participant2=Address(bytes(bytearray(partner))),
+            settle_timeout=BlockTimeout(15),
+        )
+        for channel_id, partner in enumerate(addresses[1:4])
+    ]
+    node_objects = {
+        id(participant)
+        for channel in channels
+        for participant in (channel.participant1, channel.participant2)
+        if participant == addresses[0]
+    }
+    assert len(node_objects) == 1
+
+    view = token_network_model.G[addresses[0]][addresses[1]]["view"]
+    assert view == channels[0].views[view.reverse]
+
+
+def test_tn_memory_per_channel(token_network_model: TokenNetwork):
+    """ The routing structures don't hold the channels a second time """
+    num_channels = 1000
+    nodes = [Address(bytes([0, node]) * 10) for node in range(100)]
+    pairs = random.Random(42).sample(list(combinations(nodes, 2)), num_channels)
+    reachability = SimpleReachabilityContainer(
+        {node: AddressReachability.REACHABLE for node in nodes}
+    )
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        token_network_model.add_channels(
+            Channel(
+                token_network_address=token_network_model.address,
+                channel_id=ChannelID(channel_id),
+                participant1=participant1,
+                participant2=participant2,
+                settle_timeout=BlockTimeout(15),
+            )
+            for channel_id, (participant1, participant2) in enumerate(pairs)
+        )
+        loaded = tracemalloc.get_traced_memory()[0]
+        token_network_model.track_reachability(reachability)
+        assert len(token_network_model.online_graph.edges) == 2 * num_channels
+        assert sum(token_network_model.online_mask) == len(nodes)
+        tracked = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert (loaded - start) / num_channels < 4096
+    # Only per node structures and the edge arrays of the compact graph are added
+    assert (tracked - loaded) / num_channels < 256
+
+
+def test_tn_add_channels(token_network_model: TokenNetwork, addresses: List[Address]):
+    """ Adding channels in bulk gives the same state as opening them one by one """
+    a = sorted(addresses)  # pylint: disable=invalid-name
+    pairs = [(a[0], a[1]), (a[1], a[2]), (a[3], a[4])]
+    for channel_id, (participant1, participant2) in enumerate(pairs):
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(channel_id),
+            participant1=participant1,
+            participant2=participant2,
+            settle_timeout=BlockTimeout(15),
+        )
+
+    bulk_loaded = TokenNetwork(token_network_address=token_network_model.address)
+    bulk_loaded.add_channels(
+        Channel(
+            token_network_address=token_network_model.address,
+            channel_id=ChannelID(channel_id),
+            participant1=participant1,
+            participant2=participant2,
+            settle_timeout=BlockTimeout(15),
+        )
+        for channel_id, (participant1, participant2) in enumerate(pairs)
+    )
+
+    assert bulk_loaded.channel_id_to_addresses == token_network_model.channel_id_to_addresses
+    assert list(bulk_loaded.G.edges(data="view")) == list(token_network_model.G.edges(data="view"))
+    assert len(bulk_loaded.fee_estimator.views) == 2 * len(pairs)
+    assert bulk_loaded.connectivity.is_connected(a[0], a[2])
+    assert not bulk_loaded.connectivity.is_connected(a[0], a[3])
+
+
 def test_graph_pruning():
     participant1 = make_address()
     participant2 = make_address()
@@ -97,6 +195,99 @@ def test_graph_pruning():
     )  # just the two edges between 2 and 3 left
 
 
+def test_copy_on_write_graph():
+    """ Modifications of a copy on write graph don't affect the original one """
+    graph = CopyOnWriteDiGraph()
+    graph.add_edges_from([(1, 2, {"view": 12}), (2, 1, {"view": 21})])
+    graph.add_edges_from([(2, 3, {"view": 23}), (3, 2, {"view": 32})])
+    graph.add_edges_from([(4, 5, {"view": 45}), (5, 4, {"view": 54})])
+    edges = set(graph.edges(data="view"))
+
+    copy = graph.copy_on_write()
+    copy.add_edge(1, 2, view=120)
+    copy.add_edges_from([(1, 3, {"view": 13}), (3, 1, {"view": 31})])
+    copy.remove_edge(2, 3)
+    copy.remove_node(4)
+    assert set(graph.edges(data="view")) == edges
+    assert set(copy.edges(data="view")) == {
+        (1, 2, 120),
+        (2, 1, 21),
+        (1, 3, 13),
+        (3, 1, 31),
+        (3, 2, 32),
+    }
+    assert set(copy.predecessors(2)) == {1, 3}
+    assert set(graph.nodes) == {1, 2, 3, 4, 5}
+
+    # Only the adjacency of modified nodes is copied
+    assert copy.adj[5] == {}
+    assert copy._succ[3] is not graph._succ[3]  # pylint: disable=protected-access
+    copy.add_node(6)
+    copy_of_copy = copy.copy_on_write()
+    assert copy_of_copy._succ[1] is copy._succ[1]  # pylint: disable=protected-access
+
+
+def test_online_graph_tracking(token_network_model: TokenNetwork, addresses: List[Address]):
+    """ The live view of reachable channels must match the result of `prune_graph` """
+    a = addresses  # pylint: disable=invalid-name
+    reachability = SimpleReachabilityContainer(
+        {a[i]: AddressReachability.REACHABLE for i in range(3)}
+    )
+
+    def set_reachability(address: Address, reachability_value: AddressReachability) -> None:
+        reachability.reachabilities[address] = reachability_value
+        token_network_model.handle_address_reachability_change(address, reachability_value)
+
+    def assert_matches_pruned_graph() -> None:
+        pruned_graph = prune_graph(graph=token_network_model.G, reachability_state=reachability)
+        assert set(token_network_model.online_graph.edges) == set(pruned_graph.edges)
+        online_addresses = {
+            address
+            for address, is_online in zip(
+                token_network_model.compact_graph.addresses, token_network_model.online_mask
+            )
+            if is_online
+        }
+        assert online_addresses == token_network_model.online_nodes
+
+    token_network_model.handle_channel_opened_event(
+        channel_identifier=ChannelID(1),
+        participant1=a[0],
+        participant2=a[1],
+        settle_timeout=BlockTimeout(15),
+    )
+    token_network_model.track_reachability(reachability)
+    assert_matches_pruned_graph()
+    assert len(token_network_model.online_graph.edges) == 2
+
+    # channel opened after tracking started
+    for channel_id, (p1, p2) in enumerate([(1, 2), (2, 3), (3, 0)], start=2):
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(channel_id),
+            participant1=a[p1],
+            participant2=a[p2],
+            settle_timeout=BlockTimeout(15),
+        )
+    assert_matches_pruned_graph()
+    assert len(token_network_model.online_graph.edges) == 4
+
+    # nodes going on- and offline
+    set_reachability(a[3], AddressReachability.REACHABLE)
+    assert_matches_pruned_graph()
+    assert len(token_network_model.online_graph.edges) == 8
+    set_reachability(a[1], AddressReachability.UNREACHABLE)
+    assert_matches_pruned_graph()
+    assert len(token_network_model.online_graph.edges) == 4
+    set_reachability(a[1], AddressReachability.UNKNOWN)
+    set_reachability(a[5], AddressReachability.REACHABLE)  # not part of the network
+    assert_matches_pruned_graph()
+
+    # closed channels
+    token_network_model.handle_channel_closed_event(ChannelID(3))
+    assert_matches_pruned_graph()
+    assert len(token_network_model.online_graph.edges) == 2
+
+
 def test_path_without_capacity(token_network_model: TokenNetwork, addresses: List[Address]):
     """Channels without capacity must not cause unexpected exceptions.
 
@@ -125,6 +316,30 @@ def test_path_without_capacity(token_network_model: TokenNetwork, addresses: Lis
     assert not path.is_valid
 
 
+@pytest.mark.usefixtures("populate_token_network_case_1")
+def test_path_validated_lazily(
+    token_network_model: TokenNetwork,
+    reachability_state: SimpleReachabilityContainer,
+    addresses: List[Address],
+):
+    """ Fees and Matrix users are only calculated for paths which are used """
+    with patch.object(
+        Path, "_get_matrix_users", autospec=True, side_effect=Path._get_matrix_users
+    ) as get_matrix_users:
+        path = Path(
+            G=token_network_model.G,
+            nodes=[addresses[0], addresses[1], addresses[4]],
+            value=PaymentAmount(10),
+            reachability_state=reachability_state,
+        )
+        get_matrix_users.assert_not_called()
+
+        assert path.is_valid
+        assert path.fees == [0, 0]
+        assert path.matrix_users is not None and len(path.matrix_users) == 3
+        get_matrix_users.assert_called_once()
+
+
 def test_check_path_request_errors(token_network_model, addresses):
     a = addresses  # pylint: disable=invalid-name
 
@@ -194,3 +409,56 @@ def test_check_path_request_errors(token_network_model, addresses):
         token_network_model.check_path_request_errors(a[0], a[4], 100, reachability)
         == "No route from source to target"
     )
+
+    # The connectivity is updated when channels are opened and closed
+    token_network_model.handle_channel_opened_event(
+        channel_identifier=ChannelID(3),
+        participant1=a[2],
+        participant2=a[3],
+        settle_timeout=BlockTimeout(15),
+    )
+    assert token_network_model.check_path_request_errors(a[0], a[4], 100, reachability) is None
+    token_network_model.handle_channel_closed_event(ChannelID(3))
+    assert (
+        token_network_model.check_path_request_errors(a[0], a[4], 100, reachability)
+        == "No route from source to target"
+    )
+
+
+def test_connected_components(token_network_model: TokenNetwork, addresses: List[Address]):
+    """ Component labels are updated when channels are opened and closed """
+    a = addresses
+    connectivity = token_network_model.connectivity
+    # Topology: triangle 0 - 1 - 2 - 0 and separate channel 3 - 4
+    for channel_id, (p1, p2) in enumerate([(0, 1), (1, 2), (2, 0), (3, 4)]):
+        token_network_model.handle_channel_opened_event(
+            channel_identifier=ChannelID(channel_id),
+            participant1=a[p1],
+            participant2=a[p2],
+            settle_timeout=BlockTimeout(15),
+        )
+    assert len(connectivity) == 2
+    assert connectivity.component(a[0]) == {a[0], a[1], a[2]}
+    assert connectivity.component(a[4]) == {a[3], a[4]}
+    assert not connectivity.is_connected(a[0], a[3])
+
+    # Closing a channel within a cycle keeps the component
+    token_network_model.handle_channel_closed_event(ChannelID(0))
+    assert len(connectivity) == 2
+    assert connectivity.is_connected(a[0], a[1])
+
+    # Closing a bridge splits it
+    token_network_model.handle_channel_closed_event(ChannelID(1))
+    assert len(connectivity) == 3
+    assert connectivity.component(a[1]) == {a[1]}
+    assert connectivity.component(a[0]) == {a[0], a[2]}
+
+    # Opening a channel merges components
+    token_network_model.handle_channel_opened_event(
+        channel_identifier=ChannelID(4),
+        participant1=a[1],
+        participant2=a[4],
+        settle_timeout=BlockTimeout(15),
+    )
+    assert len(connectivity) == 2
+    assert connectivity.component(a[3]) == {a[1], a[3], a[4]}